@@ -0,0 +1,146 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from gemini_client import GeminiError
+
+# ---------- Agent Loop ----------
+# Offers the tools to Gemini as function declarations, runs the calls the
+# model asks for concurrently and feeds the results back until it answers in
+# text or the step cap is reached.
+
+
+class ToolRunner:
+    """Runs tool calls on a shared pool with per-tool timeouts.
+
+    Results are remembered by idempotency key for `ttl` seconds, so a call the
+    model repeats (or a retried request with the same key) is not executed twice.
+    A call still running under the same key (a duplicate in the same step, or
+    one that outlived its timeout) is waited on instead of started again; a
+    call that finishes after its timeout is remembered when it completes.
+    """
+
+    def __init__(self, tool_map, max_workers=4, default_timeout=10.0, timeouts=None,
+                 ttl=3600.0, max_cached=10000):
+        self.tool_map = tool_map
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts or {}
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self.completed = OrderedDict()
+        self.inflight = {}  # key -> future of a call not yet finished
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def idempotency_key(scope, name, args):
+        digest = hashlib.sha256(json.dumps([name, args], sort_keys=True, default=str).encode()).hexdigest()
+        return f"{scope}:{digest}"
+
+    def _remember(self, key, result):
+        """Store a result; the caller holds self.lock."""
+        self.completed[key] = (time.monotonic(), result)
+        self.completed.move_to_end(key)
+        while len(self.completed) > self.max_cached:
+            self.completed.popitem(last=False)
+
+    def _settle(self, key, future):
+        result = future.result()  # _invoke never raises
+        with self.lock:
+            if result["ok"]:
+                self._remember(key, result)
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+
+    def _start(self, key, name, args):
+        """(result, future, replay): a remembered result, or the call's
+        in-flight future, or a new one (replay False)."""
+        with self.lock:
+            entry = self.completed.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                return entry[1], None, True
+            future = self.inflight.get(key)
+            if future is not None:
+                return None, future, True
+            future = self.inflight[key] = self.pool.submit(self._invoke, name, args)
+        # Outside the lock: the callback runs right here if the call already finished.
+        future.add_done_callback(lambda f: self._settle(key, f))
+        return None, future, False
+
+    def _invoke(self, name, args):
+        try:
+            return {"ok": True, "result": self.tool_map[name](**args)}
+        except TypeError as e:
+            return {"ok": False, "error": f"Invalid arguments: {e}"}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+    def run_all(self, calls, scope):
+        """Execute `calls` ([(name, args)]) concurrently; results come back in call order."""
+        results = [None] * len(calls)
+        pending = {}
+        for i, (name, args) in enumerate(calls):
+            if name not in self.tool_map:
+                results[i] = {"ok": False, "error": f"Unknown tool '{name}'"}
+                continue
+            cached, future, replay = self._start(self.idempotency_key(scope, name, args), name, args)
+            if cached is not None:
+                results[i] = {**cached, "idempotent_replay": True}
+                continue
+            pending[i] = (time.monotonic(), future, replay)
+
+        for i, (submitted, future, replay) in pending.items():
+            name = calls[i][0]
+            timeout = self.timeouts.get(name, self.default_timeout)
+            try:
+                # Calls run in parallel, so each wait only covers the time it has left.
+                result = future.result(timeout=max(0.0, timeout - (time.monotonic() - submitted)))
+            except FutureTimeout:
+                # A running call can't be stopped; it is remembered when it finishes.
+                results[i] = {"ok": False, "error": f"Tool '{name}' timed out after {timeout}s (still running)"}
+                continue
+            results[i] = {**result, "idempotent_replay": True} if replay else result
+        return results
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+
+def function_calls(response_json):
+    try:
+        parts = response_json["candidates"][0]["content"]["parts"]
+    except (KeyError, IndexError, TypeError):
+        raise GeminiError("Failed to parse Gemini response", details=response_json)
+    calls = [p["functionCall"] for p in parts if "functionCall" in p]
+    text = "".join(p.get("text", "") for p in parts if "text" in p)
+    return parts, calls, text
+
+
+def run_agent(client, prompt, runner, tool_declarations, scope, max_steps=4):
+    """Returns (reply_text, trace). Raises GeminiError if Gemini fails."""
+    contents = [{"role": "user", "parts": [{"text": prompt}]}]
+    tools = [{"functionDeclarations": tool_declarations}]
+    trace = []
+
+    for step in range(max_steps):
+        response = client.generate(contents, tools=tools)
+        parts, calls, text = function_calls(response)
+        if not calls:
+            return text, trace
+
+        contents.append({"role": "model", "parts": parts})
+        results = runner.run_all([(c["name"], c.get("args") or {}) for c in calls], scope)
+        for call, result in zip(calls, results):
+            trace.append({"step": step, "tool": call["name"], "args": call.get("args") or {}, **result})
+        contents.append({"role": "user", "parts": [
+            {"functionResponse": {"name": call["name"], "response": json.loads(json.dumps(result, default=str))}}
+            for call, result in zip(calls, results)
+        ]})
+
+    # Out of steps: ask for a final answer with tools disabled.
+    contents.append({"role": "user", "parts": [{"text": "Summarize the outcome for the user without calling more tools."}]})
+    response = client.generate(contents, tools=tools, toolConfig={"functionCallingConfig": {"mode": "NONE"}})
+    return function_calls(response)[2], trace
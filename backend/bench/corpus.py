@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+# ---------- Synthetic Corpus ----------
+# Deterministic (seeded) advisor-flavoured data shaped like the Gmail, HubSpot
+# and Calendar API payloads the backend ingests.
+
+FIRST_NAMES = [
+    "Maria", "Greg", "Sara", "John", "Priya", "Wei", "Ahmed", "Olivia", "Liam", "Fatima",
+    "Noah", "Elena", "Kenji", "Chloe", "Mateo", "Aisha", "Lucas", "Hannah", "Ravi", "Zoe",
+]
+LAST_NAMES = [
+    "Smith", "Johnson", "Garcia", "Chen", "Patel", "Khan", "Williams", "Brown", "Nguyen", "Lopez",
+    "Miller", "Davis", "Rossi", "Tanaka", "Muller", "Silva", "Okafor", "Cohen", "Singh", "Martin",
+]
+TICKERS = ["AAPL", "MSFT", "NVDA", "AMZN", "TSLA", "GOOG", "VTI", "BND", "SPY", "QQQ"]
+TOPICS = [
+    "rebalancing my portfolio", "selling some {ticker} stock", "the quarterly review",
+    "my daughter's college fund", "rolling over my 401(k)", "tax-loss harvesting",
+    "moving cash into bonds", "our retirement timeline", "buying more {ticker}",
+    "the estate planning documents", "my son's baseball tournament", "a Roth conversion",
+]
+SUBJECTS = [
+    "Question about {topic}", "Follow up: {topic}", "Re: {topic}", "Meeting to discuss {topic}",
+    "Quick note on {topic}", "Fwd: {topic}",
+]
+SNIPPETS = [
+    "Hi, I wanted to ask about {topic} before the end of the month.",
+    "Can we find time next week to talk through {topic}? Thursday works for me.",
+    "Thanks for the call yesterday. I've been thinking more about {topic}.",
+    "My accountant suggested I check with you on {topic}. Let me know your thoughts.",
+    "Just confirming we're still on for Friday to go over {topic}.",
+]
+EVENT_TITLES = ["Review with {name}", "Call: {name}", "Planning session - {name}", "Intro meeting with {name}"]
+
+
+def _topic(rng):
+    return rng.choice(TOPICS).format(ticker=rng.choice(TICKERS))
+
+
+def _person(rng, i):
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    return first, last, f"{first.lower()}.{last.lower()}{i}@example.com"
+
+
+def generate_contacts(n, seed=0):
+    rng = random.Random(seed)
+    for i in range(n):
+        first, last, email = _person(rng, i)
+        yield {
+            "id": str(100000 + i),
+            "properties": {"firstname": first, "lastname": last, "email": email},
+        }
+
+
+def generate_threads(n, seed=0, contacts=None, now=None):
+    rng = random.Random(seed + 1)
+    now = now or datetime.now(timezone.utc)
+    if isinstance(contacts, int):
+        contacts = list(generate_contacts(contacts, seed))
+    known = [c["properties"] for c in contacts or []]
+    for i in range(n):
+        # A share of senders are existing contacts, the rest are strangers.
+        if known and rng.random() < 0.7:
+            props = rng.choice(known)
+            first, last, email = props["firstname"], props["lastname"], props["email"]
+        else:
+            first, last, email = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), f"new.sender{i}@example.org"
+        topic = _topic(rng)
+        sent = now - timedelta(minutes=rng.randrange(0, 60 * 24 * 730))
+        yield {
+            "id": f"t{seed:02d}{i:08x}",
+            "historyId": str(1000 + i),
+            "snippet": rng.choice(SNIPPETS).format(topic=topic),
+            "messages": [{
+                "id": f"m{seed:02d}{i:08x}",
+                "internalDate": str(int(sent.timestamp() * 1000)),
+                "payload": {"headers": [
+                    {"name": "Subject", "value": rng.choice(SUBJECTS).format(topic=topic)},
+                    {"name": "From", "value": f'"{first} {last}" <{email}>'},
+                    {"name": "Date", "value": sent.strftime("%a, %d %b %Y %H:%M:%S +0000")},
+                ]},
+            }],
+        }
+
+
+def generate_events(n, seed=0, now=None):
+    rng = random.Random(seed + 2)
+    now = now or datetime.now(timezone.utc)
+    for i in range(n):
+        first, last, email = _person(rng, i)
+        start = now + timedelta(hours=rng.randrange(-24 * 365, 24 * 90))
+        yield {
+            "id": f"e{seed:02d}{i:08x}",
+            "summary": rng.choice(EVENT_TITLES).format(name=f"{first} {last}"),
+            "description": f"Discuss {_topic(rng)}.",
+            "start": {"dateTime": start.isoformat()},
+            "end": {"dateTime": (start + timedelta(minutes=30)).isoformat()},
+            "attendees": [{"email": email}],
+        }
+
+
+def generate_prompts(n, seed=0):
+    rng = random.Random(seed + 3)
+    templates = [
+        "Who mentioned {topic}?", "Summarize what {name} said about {topic}.",
+        "Which clients asked about {ticker} recently?", "When is my next meeting with {name}?",
+    ]
+    for _ in range(n):
+        yield rng.choice(templates).format(
+            topic=_topic(rng), name=rng.choice(FIRST_NAMES), ticker=rng.choice(TICKERS)
+        )
+
+
+def write_jsonl(path, rows):
+    count = 0
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Gmail/HubSpot/Calendar corpus as JSONL.")
+    parser.add_argument("--out", default="bench_corpus")
+    parser.add_argument("--threads", type=int, default=1000)
+    parser.add_argument("--contacts", type=int, default=500)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--prompts", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    counts = {
+        "threads": write_jsonl(os.path.join(args.out, "threads.jsonl"),
+                               generate_threads(args.threads, args.seed, args.contacts)),
+        "contacts": write_jsonl(os.path.join(args.out, "contacts.jsonl"), generate_contacts(args.contacts, args.seed)),
+        "events": write_jsonl(os.path.join(args.out, "events.jsonl"), generate_events(args.events, args.seed)),
+        "prompts": write_jsonl(os.path.join(args.out, "prompts.jsonl"), generate_prompts(args.prompts, args.seed)),
+    }
+    print(f"✅ Wrote {counts} to {args.out}/")
+
+
+if __name__ == "__main__":
+    main()
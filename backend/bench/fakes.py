@@ -0,0 +1,330 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from bench import corpus
+
+# ---------- Local Fakes ----------
+# Minimal stand-ins for Gemini, the Gmail/Calendar APIs and the HubSpot
+# contacts API, so the backend can be exercised without live credentials.
+# Point the backend at them with GEMINI_BASE_URL, GMAIL_API_BASE,
+# CALENDAR_API_BASE and HUBSPOT_API_BASE.
+
+
+class FakeServer:
+    def __init__(self, host="127.0.0.1", port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self, "GET")
+
+            def do_POST(self):
+                fake.handle(self, "POST")
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, req, method):
+        with self.lock:
+            self.requests += 1
+        parsed = urlparse(req.path)
+        query = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        body = None
+        length = int(req.headers.get("Content-Length") or 0)
+        if length:
+            raw = req.rfile.read(length)
+            try:
+                body = json.loads(raw)
+            except ValueError:
+                body = raw
+        try:
+            self.route(req, method, parsed.path, query, body)
+        except Exception as e:
+            send_json(req, 500, {"error": str(e)})
+
+    def route(self, req, method, path, query, body):
+        send_json(req, 404, {"error": "not found"})
+
+
+def send_json(req, status, payload):
+    data = json.dumps(payload).encode()
+    req.send_response(status)
+    req.send_header("Content-Type", "application/json")
+    req.send_header("Content-Length", str(len(data)))
+    req.end_headers()
+    req.wfile.write(data)
+
+
+class FakeGemini(FakeServer):
+    """generateContent / streamGenerateContent with configurable latency.
+
+    `latency_ms` (+/- `jitter_ms`) is spent before the first byte; streaming
+    replies are split into `stream_chunks` pieces `chunk_delay_ms` apart.
+    `error_rate` of requests answer 503 to exercise client retries. With
+    `call_tools`, a request that declares tools first gets a functionCall for
+    every declared function, and a text answer once results are sent back.
+    """
+
+    def __init__(self, latency_ms=500, jitter_ms=100, reply_chars=600, stream_chunks=8,
+                 chunk_delay_ms=50, error_rate=0.0, call_tools=False, seed=0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.reply_chars = reply_chars
+        self.stream_chunks = stream_chunks
+        self.chunk_delay_ms = chunk_delay_ms
+        self.error_rate = error_rate
+        self.call_tools = call_tools
+        self.rng = random.Random(seed)
+
+    def reply_text(self, body):
+        prompt = ""
+        try:
+            prompt = body["contents"][-1]["parts"][0].get("text", "")
+        except (KeyError, IndexError, TypeError):
+            pass
+        base = f"Based on your records, here is what I found regarding: {prompt[-80:]} "
+        return (base * (self.reply_chars // len(base) + 1))[: self.reply_chars]
+
+    def tool_calls(self, body):
+        answered = any("functionResponse" in p for c in body["contents"] for p in c.get("parts", []))
+        if answered or body.get("toolConfig", {}).get("functionCallingConfig", {}).get("mode") == "NONE":
+            return []
+        calls = []
+        for tool in body["tools"]:
+            for decl in tool.get("functionDeclarations", []):
+                props = decl.get("parameters", {}).get("properties", {})
+                args = {
+                    name: ["fake@example.com"] if spec.get("type") == "ARRAY" else f"fake-{name}"
+                    for name, spec in props.items()
+                }
+                calls.append({"functionCall": {"name": decl["name"], "args": args}})
+        return calls
+
+    def sleep_latency(self):
+        delay = self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)
+        time.sleep(max(0.0, delay) / 1000)
+
+    def route(self, req, method, path, query, body):
+        if method != "POST" or ":" not in path:
+            return send_json(req, 404, {"error": "not found"})
+        action = path.rsplit(":", 1)[1]
+        self.sleep_latency()
+        if self.rng.random() < self.error_rate:
+            return send_json(req, 503, {"error": {"code": 503, "message": "fake overload"}})
+
+        if action == "generateContent" and self.call_tools and body.get("tools"):
+            calls = self.tool_calls(body)
+            if calls:
+                return send_json(req, 200, {"candidates": [{"content": {"role": "model", "parts": calls}}]})
+
+        text = self.reply_text(body)
+        if action == "generateContent":
+            return send_json(req, 200, candidate(text))
+        if action == "streamGenerateContent":
+            return self.stream(req, text, sse=query.get("alt") == "sse")
+        return send_json(req, 404, {"error": f"unknown action {action}"})
+
+    def stream(self, req, text, sse):
+        size = max(1, -(-len(text) // self.stream_chunks))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        req.send_response(200)
+        req.send_header("Content-Type", "text/event-stream" if sse else "application/json")
+        req.send_header("Transfer-Encoding", "chunked")
+        req.end_headers()
+
+        def write(data):
+            req.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            req.wfile.flush()
+
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(self.chunk_delay_ms / 1000)
+            chunk = json.dumps(candidate(piece))
+            if sse:
+                write(f"data: {chunk}\r\n\r\n".encode())
+            else:
+                write((("[" if i == 0 else ",") + chunk).encode())
+        if not sse:
+            write(b"]")
+        req.wfile.write(b"0\r\n\r\n")
+
+
+def candidate(text):
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+
+
+class FakeGoogle(FakeServer):
+    """Gmail threads (list/get), history and watch, plus Calendar events, backed
+    by a synthetic corpus. POST /_fake/threads {"count": n} delivers n new
+    threads and returns the new historyId, for driving push notifications."""
+
+    def __init__(self, threads=None, events=None, latency_ms=20, **kwargs):
+        super().__init__(**kwargs)
+        self.threads = {t["id"]: t for t in (threads or [])}
+        self.thread_ids = list(self.threads)
+        self.events = list(events or [])
+        self.latency_ms = latency_ms
+        self.history_id = max((int(t.get("historyId", 0)) for t in self.threads.values()), default=1000)
+        self.history = []
+        self.batches = 0
+
+    def add_threads(self, threads):
+        with self.lock:
+            for thread in threads:
+                self.history_id += 1
+                thread["historyId"] = str(self.history_id)
+                self.threads[thread["id"]] = thread
+                self.thread_ids.insert(0, thread["id"])
+                self.history.append({
+                    "id": str(self.history_id),
+                    "messagesAdded": [{"message": {"id": m["id"], "threadId": thread["id"]}}
+                                      for m in thread["messages"]],
+                })
+            return self.history_id
+
+    def route(self, req, method, path, query, body):
+        time.sleep(self.latency_ms / 1000)
+        if method == "POST" and path == "/_fake/threads":
+            self.batches += 1
+            count = int((body or {}).get("count", 1))
+            new = list(corpus.generate_threads(count, seed=50 + self.batches))
+            history_id = self.add_threads(new)
+            return send_json(req, 200, {"historyId": str(history_id), "thread_ids": [t["id"] for t in new]})
+        if method == "POST" and path == "/gmail/v1/users/me/watch":
+            return send_json(req, 200, {"historyId": str(self.history_id),
+                                        "expiration": str(int((time.time() + 7 * 86400) * 1000))})
+        if path == "/gmail/v1/users/me/history":
+            start = int(query.get("startHistoryId", 0))
+            entries = [h for h in self.history if int(h["id"]) > start]
+            return send_json(req, 200, {"history": entries, "historyId": str(self.history_id)})
+        prefix = "/gmail/v1/users/me/threads"
+        if path == prefix:
+            start = int(query.get("pageToken") or 0)
+            end = start + int(query.get("maxResults", 100))
+            page = [{"id": tid, "snippet": self.threads[tid]["snippet"]} for tid in self.thread_ids[start:end]]
+            payload = {"threads": page, "resultSizeEstimate": len(self.thread_ids)}
+            if end < len(self.thread_ids):
+                payload["nextPageToken"] = str(end)
+            return send_json(req, 200, payload)
+        if path.startswith(prefix + "/"):
+            thread = self.threads.get(path[len(prefix) + 1:])
+            if not thread:
+                return send_json(req, 404, {"error": {"code": 404, "message": "Not Found"}})
+            return send_json(req, 200, thread)
+        if path == "/calendar/v3/calendars/primary/events":
+            limit = int(query.get("maxResults", 250))
+            return send_json(req, 200, {"items": self.events[:limit]})
+        return send_json(req, 404, {"error": "not found"})
+
+
+class FakeHubSpot(FakeServer):
+    """CRM v3 contacts list with `limit`/`after` paging."""
+
+    def __init__(self, contacts=None, latency_ms=20, **kwargs):
+        super().__init__(**kwargs)
+        self.contacts = list(contacts or [])
+        self.latency_ms = latency_ms
+
+    def route(self, req, method, path, query, body):
+        time.sleep(self.latency_ms / 1000)
+        if path != "/crm/v3/objects/contacts":
+            return send_json(req, 404, {"status": "error", "message": "not found"})
+        start = int(query.get("after") or 0)
+        end = start + min(int(query.get("limit", 10)), 100)
+        payload = {"results": self.contacts[start:end]}
+        if end < len(self.contacts):
+            payload["paging"] = {"next": {"after": str(end)}}
+        return send_json(req, 200, payload)
+
+
+def start_fakes(threads=1000, contacts=500, events=200, seed=0, host="127.0.0.1",
+                gemini_port=0, google_port=0, hubspot_port=0, **gemini_options):
+    contact_rows = list(corpus.generate_contacts(contacts, seed))
+    fakes = {
+        "gemini": FakeGemini(host=host, port=gemini_port, seed=seed, **gemini_options).start(),
+        "google": FakeGoogle(
+            threads=corpus.generate_threads(threads, seed, contact_rows),
+            events=corpus.generate_events(events, seed),
+            host=host, port=google_port,
+        ).start(),
+        "hubspot": FakeHubSpot(contacts=contact_rows, host=host, port=hubspot_port).start(),
+    }
+    return fakes
+
+
+def backend_env(fakes):
+    return {
+        "GEMINI_BASE_URL": f"{fakes['gemini'].url}/v1beta",
+        "GEMINI_API_KEY": "fake-key",
+        "GMAIL_API_BASE": fakes["google"].url,
+        "CALENDAR_API_BASE": fakes["google"].url,
+        "HUBSPOT_API_BASE": fakes["hubspot"].url,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run local fake Gemini, Gmail/Calendar and HubSpot servers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--gemini-port", type=int, default=9101)
+    parser.add_argument("--google-port", type=int, default=9102)
+    parser.add_argument("--hubspot-port", type=int, default=9103)
+    parser.add_argument("--threads", type=int, default=1000)
+    parser.add_argument("--contacts", type=int, default=500)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gemini-latency-ms", type=float, default=500)
+    parser.add_argument("--gemini-jitter-ms", type=float, default=100)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-call-tools", action="store_true")
+    parser.add_argument("--stream-chunks", type=int, default=8)
+    parser.add_argument("--chunk-delay-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    fakes = start_fakes(
+        threads=args.threads, contacts=args.contacts, events=args.events, seed=args.seed,
+        host=args.host, gemini_port=args.gemini_port, google_port=args.google_port,
+        hubspot_port=args.hubspot_port, latency_ms=args.gemini_latency_ms,
+        jitter_ms=args.gemini_jitter_ms, error_rate=args.gemini_error_rate, call_tools=args.gemini_call_tools,
+        stream_chunks=args.stream_chunks, chunk_delay_ms=args.chunk_delay_ms,
+    )
+    print("🧪 Fakes running. Start the backend with:")
+    for key, value in backend_env(fakes).items():
+        print(f"export {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for fake in fakes.values():
+            fake.stop()
+
+
+if __name__ == "__main__":
+    main()
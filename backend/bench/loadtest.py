@@ -0,0 +1,174 @@
+import argparse
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import cycle
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from bench import corpus
+
+# ---------- Load Driver ----------
+# Drives a running backend (pointed at bench.fakes) and reports latency
+# percentiles and throughput per endpoint. Results are written as JSON and can
+# be compared against a previous run with --baseline.
+
+SCENARIOS = {
+    "chat": ("POST", "/chat", lambda q: {"prompt": q, "email": "bench@example.com"}),
+    "search": ("GET", "/search", lambda q: {"query": q}),
+    "gmail_search": ("GET", "/gmail/search", lambda q: {"query": q}),
+    "search_all": ("GET", "/search/all", lambda q: {"query": q}),
+    "gmail_ingest": ("GET", "/gmail/ingest", lambda q: {"token": "fake-token"}),
+    "hubspot_ingest": ("GET", "/hubspot/ingest", lambda q: {"token": "fake-token"}),
+    "calendar_ingest": ("GET", "/calendar/ingest", lambda q: {"token": "fake-token"}),
+}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    ms = lambda v: None if v is None else round(v * 1000, 2)
+    return {
+        "requests": len(values) + errors,
+        "errors": errors,
+        "p50_ms": ms(percentile(values, 50)),
+        "p95_ms": ms(percentile(values, 95)),
+        "p99_ms": ms(percentile(values, 99)),
+        "mean_ms": ms(sum(values) / len(values)) if values else None,
+        "max_ms": ms(values[-1]) if values else None,
+        "throughput_rps": round(len(values) / elapsed, 2) if elapsed else None,
+    }
+
+
+def run_scenario(base_url, name, concurrency, duration=None, requests_total=None, timeout=120, prompts=None):
+    method, path, params_for = SCENARIOS[name]
+    prompts = cycle(prompts or list(corpus.generate_prompts(200)))
+    prompt_lock = threading.Lock()
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    remaining = [requests_total]
+    deadline = time.monotonic() + duration if duration else None
+
+    def next_ticket():
+        with lock:
+            if remaining[0] is not None:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+            return deadline is None or time.monotonic() < deadline
+
+    def worker():
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(pool_maxsize=1))
+        while next_ticket():
+            with prompt_lock:
+                params = params_for(next(prompts))
+            start = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, params=params, timeout=timeout)
+                ok = response.status_code == 200 and "error" not in response.json()
+            except (requests.RequestException, ValueError):
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+        session.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(worker) for _ in range(concurrency)]
+    # A worker that died outside the request (e.g. a bad scenario) would
+    # otherwise just shrink the load silently.
+    for future in futures:
+        future.result()
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline):
+    print(f"\n{'scenario':<18}{'metric':<16}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, stats in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            a, b = old.get(metric), stats.get(metric)
+            if a is None or b is None:
+                continue
+            change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+            print(f"{name:<18}{metric:<16}{a:>12}{b:>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the backend and report p50/p95/p99 per endpoint.")
+    parser.add_argument("--base-url", default=os.getenv("BACKEND_URL", "http://localhost:8000"))
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30, help="seconds per scenario")
+    parser.add_argument("--requests", type=int, default=None, help="stop each scenario after N requests")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed requests per scenario")
+    parser.add_argument("--out", default=None, help="write results JSON here")
+    parser.add_argument("--baseline", default=None, help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {unknown}")
+
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "base_url": args.base_url,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "requests": args.requests,
+        },
+        "results": {},
+    }
+    for name in names:
+        if args.warmup:
+            run_scenario(args.base_url, name, 1, requests_total=args.warmup)
+        stats = run_scenario(args.base_url, name, args.concurrency,
+                             duration=None if args.requests else args.duration,
+                             requests_total=args.requests)
+        report["results"][name] = stats
+        print(f"📊 {name:<16} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms "
+              f"rps={stats['throughput_rps']} errors={stats['errors']}")
+
+    out = args.out or f"bench_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Results written to {out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import base64
+import json
+import os
+import uuid
+
+import requests
+
+# ---------- Pub/Sub Stand-in ----------
+# Posts Gmail watch notifications to /gmail/push in the Pub/Sub push format,
+# optionally after delivering new threads to a running bench.fakes Google fake.
+
+
+def envelope(email, history_id, message_id=None, subscription="projects/local/subscriptions/gmail-push"):
+    data = base64.b64encode(json.dumps({"emailAddress": email, "historyId": int(history_id)}).encode()).decode()
+    return {
+        "message": {"data": data, "messageId": message_id or str(uuid.uuid4()), "attributes": {}},
+        "subscription": subscription,
+    }
+
+
+def publish(backend_url, email, history_id, message_id=None, token=None, timeout=10):
+    params = {"token": token} if token else None
+    response = requests.post(f"{backend_url}/gmail/push", json=envelope(email, history_id, message_id),
+                             params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish Gmail push notifications to the backend.")
+    parser.add_argument("--backend-url", default=os.getenv("BACKEND_URL", "http://localhost:8000"))
+    parser.add_argument("--google-url", default=os.getenv("GMAIL_API_BASE", "http://127.0.0.1:9102"),
+                        help="bench.fakes Google server to deliver new threads to")
+    parser.add_argument("--email", default="advisor@example.com")
+    parser.add_argument("--new-threads", type=int, default=5, help="threads to deliver before notifying")
+    parser.add_argument("--history-id", type=int, default=None, help="notify with this historyId instead")
+    parser.add_argument("--duplicates", type=int, default=0, help="redeliver the same message N extra times")
+    parser.add_argument("--token", default=os.getenv("GMAIL_PUSH_TOKEN"))
+    args = parser.parse_args()
+
+    history_id = args.history_id
+    if history_id is None:
+        delivered = requests.post(f"{args.google_url}/_fake/threads", json={"count": args.new_threads}, timeout=10).json()
+        history_id = int(delivered["historyId"])
+        print(f"📨 Delivered {len(delivered['thread_ids'])} threads, historyId={history_id}")
+
+    message_id = str(uuid.uuid4())
+    for _ in range(1 + args.duplicates):
+        print(publish(args.backend_url, args.email, history_id, message_id, args.token))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import psycopg2
+
+from bench import corpus
+from bench.loadtest import git_revision, percentile
+from ingest import copy_buffer
+
+# ---------- Retrieval Benchmark ----------
+# Offline benchmark for the pgvector queries behind /search, /gmail/search and
+# /chat. For each corpus size it bulk-loads synthetic gmail_threads,
+# hubspot_contacts and calendar_events into a scratch schema with binary COPY,
+# then builds each index configuration and measures query latency, index build
+# time/size and recall@k against exact (unindexed) results. Embeddings are
+# synthetic: normalized points around topic centroids, so clusters behave like
+# real sentence embeddings without encoding millions of texts. Every statement
+# names the scratch schema explicitly: the app's tables of the same names must
+# never be touched, so the target database has to be given with --dsn.
+
+DIMENSIONS = 384  # all-MiniLM-L6-v2
+SCHEMA = "bench_retrieval"
+COPY_CHUNK = 10000
+
+TABLES = {
+    "gmail": {
+        "table": "gmail_threads",
+        "ddl": "thread_id text PRIMARY KEY, subject text, snippet text, embedding vector({dims})",
+        "columns": ("thread_id", "subject", "snippet", "embedding"),
+    },
+    "hubspot": {
+        "table": "hubspot_contacts",
+        "ddl": "hubspot_id text PRIMARY KEY, name text, email text, notes text, embedding vector({dims})",
+        "columns": ("hubspot_id", "name", "email", "notes", "embedding"),
+    },
+    "calendar": {
+        "table": "calendar_events",
+        "ddl": "event_id text PRIMARY KEY, summary text, description text, embedding vector({dims})",
+        "columns": ("event_id", "summary", "description", "embedding"),
+    },
+}
+
+# name -> (index DDL or None, [(variant label, session settings)])
+INDEX_CONFIGS = {
+    "none": (None, [("exact", {})]),
+    "ivfflat": (
+        "CREATE INDEX {name}_embedding_ivfflat ON {table} USING ivfflat (embedding vector_cosine_ops) "
+        "WITH (lists = {lists})",
+        [("probes=1", {"ivfflat.probes": 1}), ("probes=sqrt", {"ivfflat.probes": "{sqrt_lists}"})],
+    ),
+    "hnsw": (
+        "CREATE INDEX {name}_embedding_hnsw ON {table} USING hnsw (embedding vector_cosine_ops) "
+        "WITH (m = 16, ef_construction = 64)",
+        [("ef_search=40", {"hnsw.ef_search": 40}), ("ef_search=100", {"hnsw.ef_search": 100})],
+    ),
+}
+
+
+def qualified(name):
+    return f"{SCHEMA}.{name}"
+
+
+def parse_size(value):
+    value = value.strip().lower()
+    scale = {"k": 1000, "m": 1000000}.get(value[-1], 1)
+    return int(float(value.rstrip("km")) * scale)
+
+
+# --- synthetic data ---
+
+class VectorSpace:
+    """Deterministic clustered unit vectors; queries are drawn from the same clusters."""
+
+    def __init__(self, dims=DIMENSIONS, clusters=256, spread=1.0, seed=0):
+        rng = np.random.default_rng(seed)
+        self.dims = dims
+        self.spread = spread
+        self.centroids = rng.standard_normal((clusters, dims)).astype(np.float32)
+        self.seed = seed
+
+    def sample(self, n, rng):
+        labels = rng.integers(0, len(self.centroids), n)
+        points = self.centroids[labels] + self.spread * rng.standard_normal((n, self.dims)).astype(np.float32)
+        return points / np.linalg.norm(points, axis=1, keepdims=True)
+
+
+def text_rows(source, n, seed):
+    if source == "gmail":
+        for t in corpus.generate_threads(n, seed=seed, contacts=min(n, 5000)):
+            headers = t["messages"][0]["payload"]["headers"]
+            subject = next(h["value"] for h in headers if h["name"] == "Subject")
+            yield (t["id"], subject, t["snippet"])
+    elif source == "hubspot":
+        for c in corpus.generate_contacts(n, seed=seed):
+            p = c["properties"]
+            name = f"{p['firstname']} {p['lastname']}"
+            yield (c["id"], name, p["email"], f"Name: {name}, Email: {p['email']}")
+    else:
+        for e in corpus.generate_events(n, seed=seed):
+            yield (e["id"], e["summary"], e.get("description", ""))
+
+
+def load_table(cursor, source, n, space, seed):
+    spec = TABLES[source]
+    table = qualified(spec["table"])
+    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    cursor.execute(f"CREATE TABLE {table} ({spec['ddl'].format(dims=space.dims)})")
+    rng = np.random.default_rng(seed + list(TABLES).index(source) + 1)
+    rows = text_rows(source, n, seed)
+    copy_sql = f"COPY {table} ({', '.join(spec['columns'])}) FROM STDIN WITH (FORMAT binary)"
+    started = time.perf_counter()
+    copy_seconds, loaded = 0.0, 0
+    while loaded < n:
+        chunk = [next(rows) for _ in range(min(COPY_CHUNK, n - loaded))]
+        buffer = copy_buffer(chunk, space.sample(len(chunk), rng))
+        copy_started = time.perf_counter()
+        cursor.copy_expert(copy_sql, buffer)
+        copy_seconds += time.perf_counter() - copy_started
+        loaded += len(chunk)
+    elapsed = time.perf_counter() - started
+    cursor.execute(f"ANALYZE {table}")
+    # rows_per_sec is COPY alone; end_to_end includes generating and encoding the rows.
+    return {
+        "rows": loaded,
+        "seconds": round(copy_seconds, 2),
+        "rows_per_sec": round(loaded / copy_seconds, 1),
+        "end_to_end_rows_per_sec": round(loaded / elapsed, 1),
+    }
+
+
+# --- queries ---
+
+def run_queries(cursor, source, queries, k):
+    spec = TABLES[source]
+    sql = f"""
+        SELECT {spec['columns'][0]} FROM {qualified(spec['table'])}
+        ORDER BY embedding <=> %s::vector
+        LIMIT %s
+    """
+    latencies, results = [], []
+    for q in queries:
+        vector = "[" + ",".join(f"{x:.6f}" for x in q) + "]"
+        started = time.perf_counter()
+        cursor.execute(sql, (vector, k))
+        ids = [r[0] for r in cursor.fetchall()]
+        latencies.append(time.perf_counter() - started)
+        results.append(ids)
+    return latencies, results
+
+
+def latency_stats(latencies):
+    values = sorted(latencies)
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    total = sum(values)
+    return {
+        "p50_ms": ms(percentile(values, 50)),
+        "p95_ms": ms(percentile(values, 95)),
+        "p99_ms": ms(percentile(values, 99)),
+        "mean_ms": ms(total / len(values)) if values else None,
+        "qps": round(len(values) / total, 1) if total else None,
+    }
+
+
+def recall_at_k(results, truth):
+    hits = sum(len(set(r) & set(t)) for r, t in zip(results, truth))
+    expected = sum(len(t) for t in truth)
+    return round(hits / expected, 4) if expected else None
+
+
+def exact_results(cursor, source, queries, k):
+    cursor.execute("SET enable_indexscan = off")
+    try:
+        return run_queries(cursor, source, queries, k)
+    finally:
+        cursor.execute("RESET enable_indexscan")
+
+
+def bench_index(cursor, source, config, rows, queries, k, truth):
+    spec = TABLES[source]
+    ddl, variants = INDEX_CONFIGS[config]
+    lists = max(1, rows // 1000) if rows <= 1000000 else max(1, int(rows ** 0.5))
+    build = {}
+    if ddl:
+        started = time.perf_counter()
+        cursor.execute(ddl.format(name=spec["table"], table=qualified(spec["table"]), lists=lists))
+        build["index_build_s"] = round(time.perf_counter() - started, 2)
+        cursor.execute("SELECT pg_relation_size(%s::regclass)", (qualified(f"{spec['table']}_embedding_{config}"),))
+        build["index_size_mb"] = round(cursor.fetchone()[0] / 2 ** 20, 2)
+    out = {}
+    for label, settings in variants:
+        for name, value in settings.items():
+            value = str(value).format(sqrt_lists=max(1, round(lists ** 0.5)))
+            cursor.execute(f"SET {name} = {value}")
+            label = label.replace("sqrt", value)
+        run_queries(cursor, source, queries[: min(10, len(queries))], k)  # warm the cache
+        latencies, results = run_queries(cursor, source, queries, k)
+        out[f"{config}:{label}"] = {**latency_stats(latencies), "recall_at_k": recall_at_k(results, truth), **build}
+        for name in settings:
+            cursor.execute(f"RESET {name}")
+    if ddl:
+        cursor.execute(f"DROP INDEX {qualified(spec['table'] + '_embedding_' + config)}")
+    return out
+
+
+def versions(cursor):
+    cursor.execute("SHOW server_version")
+    server = cursor.fetchone()[0]
+    cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+    row = cursor.fetchone()
+    return server, row[0] if row else None
+
+
+def compare(current, baseline):
+    print(f"\n{'size/table/config':<42}{'metric':<14}{'baseline':>11}{'current':>11}{'change':>10}")
+    for size, tables in current["results"].items():
+        for source, configs in tables.items():
+            for config, stats in configs.items():
+                old = baseline.get("results", {}).get(size, {}).get(source, {}).get(config)
+                if not old:
+                    continue
+                for metric in ("p50_ms", "p95_ms", "p99_ms", "recall_at_k"):
+                    a, b = old.get(metric), stats.get(metric)
+                    if a is None or b is None:
+                        continue
+                    change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+                    print(f"{f'{size}/{source}/{config}':<42}{metric:<14}{a:>11}{b:>11}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pgvector retrieval (latency, ingest, recall@k) per index config.")
+    parser.add_argument("--dsn", required=True,
+                        help=f"libpq DSN of a scratch database (tables go in its {SCHEMA} schema)")
+    parser.add_argument("--sizes", default="10k,100k,1M", help="comma-separated row counts per table")
+    parser.add_argument("--tables", default=",".join(TABLES), help=f"subset of: {', '.join(TABLES)}")
+    parser.add_argument("--configs", default=",".join(INDEX_CONFIGS), help=f"subset of: {', '.join(INDEX_CONFIGS)}")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5, help="LIMIT used by the app's queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--spread", type=float, default=1.0,
+                        help="noise around each topic centroid; higher overlaps clusters and lowers ANN recall")
+    parser.add_argument("--maintenance-work-mem", default="512MB", help="for index builds")
+    parser.add_argument("--keep", action="store_true", help=f"leave the last tables in the {SCHEMA} schema")
+    parser.add_argument("--out", default=None, help="write the report JSON here")
+    parser.add_argument("--baseline", default=None, help="previous report JSON to compare against")
+    args = parser.parse_args()
+
+    sizes = [parse_size(s) for s in args.sizes.split(",") if s.strip()]
+    sources = [s.strip() for s in args.tables.split(",") if s.strip()]
+    configs = [c.strip() for c in args.configs.split(",") if c.strip()]
+    unknown = [s for s in sources if s not in TABLES] + [c for c in configs if c not in INDEX_CONFIGS]
+    if unknown:
+        parser.error(f"unknown tables/configs: {unknown}")
+
+    conn = psycopg2.connect(args.dsn)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA}")
+    cursor.execute(f"SET search_path = {SCHEMA}, public")  # for pgvector's type and operators
+    cursor.execute(f"SET maintenance_work_mem = '{args.maintenance_work_mem}'")
+    server_version, vector_version = versions(cursor)
+
+    space = VectorSpace(spread=args.spread, seed=args.seed)
+    query_vectors = space.sample(args.queries, np.random.default_rng(args.seed + 7))
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "postgres": server_version,
+            "pgvector": vector_version,
+            "dimensions": space.dims,
+            "spread": space.spread,
+            "queries": args.queries,
+            "k": args.k,
+            "seed": args.seed,
+        },
+        "ingest": {},
+        "results": {},
+    }
+    try:
+        for size in sizes:
+            label = f"{size:,}"
+            report["ingest"][label], report["results"][label] = {}, {}
+            for source in sources:
+                ingest = load_table(cursor, source, size, space, args.seed)
+                report["ingest"][label][source] = ingest
+                print(f"📥 {source:<9} {label:>10} rows  {ingest['rows_per_sec']:>10} rows/s (COPY)")
+
+                _, truth = exact_results(cursor, source, query_vectors, args.k)
+                results = {}
+                for config in configs:
+                    results.update(bench_index(cursor, source, config, size, query_vectors, args.k, truth))
+                report["results"][label][source] = results
+                for name, stats in results.items():
+                    extra = f" build={stats['index_build_s']}s" if "index_build_s" in stats else ""
+                    print(f"📊 {source:<9} {label:>10} {name:<22} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms "
+                          f"p99={stats['p99_ms']}ms recall@{args.k}={stats['recall_at_k']}{extra}")
+                if not args.keep:
+                    cursor.execute(f"DROP TABLE {qualified(TABLES[source]['table'])}")
+    finally:
+        if not args.keep:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.close()
+
+    out = args.out or f"retrieval_bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Report written to {out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from bench import corpus
+from bench.loadtest import git_revision, percentile
+
+# ---------- Worker Memory Benchmark ----------
+# Measures what each EMBEDDING_MODE costs per API worker. For every mode and
+# worker count it forks that many workers (as gunicorn would), lets each
+# encode query-sized batches for --duration seconds, and reports per-worker
+# RSS and PSS from /proc/<pid>/smaps_rollup together with aggregate texts/s
+# and per-call latency. PSS divides shared pages among the processes mapping
+# them, so the total PSS (workers + master or sidecar) is the real footprint
+# on the node; RSS counts shared weights again in every worker.
+
+MODES = ("local", "preload", "sidecar")
+
+
+def memory(pid):
+    """(rss_mb, pss_mb) of a process."""
+    fields = {}
+    path = f"/proc/{pid}/smaps_rollup"
+    if not os.path.exists(path):
+        path = f"/proc/{pid}/smaps"  # kernels before 4.14: sum every mapping
+    with open(path) as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if name in ("Rss", "Pss"):
+                fields[name] = fields.get(name, 0) + int(rest.split()[0])
+    return round(fields.get("Rss", 0) / 1024, 1), round(fields.get("Pss", 0) / 1024, 1)
+
+
+def set_threads(threads):
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+
+
+def worker(mode, model_name, socket_path, texts, batch, threads, ready, start, results, release):
+    from embeddings import load_sentence_transformer
+
+    if mode == "sidecar":
+        from embed_server import SidecarModel
+
+        model = SidecarModel(socket_path, model_name)
+    else:
+        set_threads(threads)
+        model = load_sentence_transformer(model_name)  # shared when the parent preloaded it
+    model.encode(texts[:batch])  # warm up (and, locally, start this process's thread pool)
+    ready.put(os.getpid())
+    duration = start.get()
+
+    latencies, count, i = [], 0, 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        chunk = [texts[(i + j) % len(texts)] for j in range(batch)]
+        i += batch
+        started = time.perf_counter()
+        model.encode(chunk)
+        latencies.append(time.perf_counter() - started)
+        count += len(chunk)
+    results.put((os.getpid(), count, latencies))
+    release.wait()
+
+
+def sidecar(model_name, socket_path, threads, max_wait_ms):
+    from embed_server import serve
+
+    set_threads(threads)
+    serve(socket_path, [model_name], max_wait_ms=max_wait_ms)
+
+
+def run_mode(mode, counts, args, report):
+    """Benchmark one mode at every worker count; runs in a process of its own
+    so that one mode's loaded model can't leak into another's numbers."""
+    ctx = multiprocessing.get_context("fork")
+    texts = list(corpus.generate_prompts(500, seed=args.seed))
+    socket_path = os.path.join(tempfile.mkdtemp(), "embed.sock")
+    server = None
+    if mode == "preload":
+        from embeddings import preload
+
+        preload([args.model])
+    elif mode == "sidecar":
+        server = ctx.Process(target=sidecar, args=(args.model, socket_path, args.sidecar_threads, args.max_wait_ms),
+                             daemon=True)
+        server.start()
+        while not os.path.exists(socket_path):
+            time.sleep(0.05)
+
+    results = {}
+    try:
+        for count in counts:
+            ready, start, done, release = ctx.Queue(), ctx.Queue(), ctx.Queue(), ctx.Event()
+            procs = [ctx.Process(target=worker, args=(mode, args.model, socket_path, texts, args.batch,
+                                                      args.threads, ready, start, done, release))
+                     for _ in range(count)]
+            for p in procs:
+                p.start()
+            for _ in procs:
+                ready.get(timeout=600)
+            for _ in procs:
+                start.put(args.duration)
+            runs = [done.get(timeout=args.duration + 600) for _ in procs]
+            # Measured after the run, while every worker is still alive and warm.
+            workers = [memory(pid) for pid, _, _ in runs]
+            extra = memory(server.pid if server else os.getpid())
+            release.set()
+            for p in procs:
+                p.join()
+
+            latencies = sorted(l for _, _, ls in runs for l in ls)
+            texts_done = sum(c for _, c, _ in runs)
+            rss = [m[0] for m in workers]
+            pss = [m[1] for m in workers]
+            results[str(count)] = {
+                "workers": count,
+                "rss_mb_per_worker": round(sum(rss) / count, 1),
+                "pss_mb_per_worker": round(sum(pss) / count, 1),
+                "sidecar_or_master_rss_mb": extra[0],
+                "total_pss_mb": round(sum(pss) + (extra[1] if mode != "local" else 0), 1),
+                "texts_per_sec": round(texts_done / args.duration, 1),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+                "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            }
+            stats = results[str(count)]
+            print(f"📊 {mode:<8} workers={count:<3} rss/worker={stats['rss_mb_per_worker']}MB "
+                  f"pss/worker={stats['pss_mb_per_worker']}MB total_pss={stats['total_pss_mb']}MB "
+                  f"{stats['texts_per_sec']} texts/s p95={stats['p95_ms']}ms")
+    except Exception as e:
+        print(f"❌ {mode}: {e}")
+        results["error"] = str(e)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        report.put((mode, results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-worker memory and throughput of each EMBEDDING_MODE.")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"subset of: {', '.join(MODES)}")
+    parser.add_argument("--workers", default="1,2,4,8", help="comma-separated worker counts")
+    parser.add_argument("--model", default=None, help="defaults to EMBEDDING_MODEL or all-MiniLM-L6-v2")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of encoding per run")
+    parser.add_argument("--batch", type=int, default=1, help="texts per encode call (1 = a search query)")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per local/preload worker")
+    parser.add_argument("--sidecar-threads", type=int, default=os.cpu_count(), help="torch threads in the sidecar")
+    parser.add_argument("--max-wait-ms", type=float, default=0.0, help="sidecar batching window")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="write the report JSON here")
+    args = parser.parse_args()
+
+    from embeddings import DEFAULT_MODEL
+
+    args.model = args.model or os.getenv("EMBEDDING_MODEL", DEFAULT_MODEL)
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    counts = [int(c) for c in args.workers.split(",") if c.strip()]
+    if any(m not in MODES for m in modes):
+        parser.error(f"modes must be a subset of {', '.join(MODES)}")
+
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "model": args.model,
+            "cpus": os.cpu_count(),
+            "duration_s": args.duration,
+            "batch": args.batch,
+            "threads": args.threads,
+            "sidecar_threads": args.sidecar_threads,
+        },
+        "results": {},
+    }
+    # A fresh interpreter per mode (spawn), which then forks its workers.
+    ctx = multiprocessing.get_context("spawn")
+    for mode in modes:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_mode, args=(mode, counts, args, queue))
+        proc.start()
+        name, results = queue.get()
+        proc.join()
+        report["results"][name] = results
+
+    out = args.out or f"workers_bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Report written to {out}")
+
+
+if __name__ == "__main__":
+    main()
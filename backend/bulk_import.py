@@ -0,0 +1,357 @@
+import argparse
+import email
+import json
+import os
+import time
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+from conditional import CALENDAR_SCOPE, GMAIL_SCOPE
+from contact_index import SCHEMA as VERSIONS_SCHEMA, SCOPE as CONTACTS_SCOPE, bump_version
+from dedup import NearDuplicates, backfill
+from ingest import contact_record, copy_buffer, event_record, gmail_thread_record, mbox_thread_record
+
+# ---------- Bulk Import ----------
+# Loads mail, contact and event exports without the Gmail/HubSpot/Calendar
+# APIs. Input is streamed; every `batch_size` records are normalized with the
+# same functions the API ingests use, de-duplicated, embedded in one encode
+# call, binary-COPYed into a temp staging table and merged with a single
+# INSERT ... SELECT ... ON CONFLICT. The byte offset of the last record in a
+# batch is committed with the batch, so an interrupted import resumes exactly
+# where the last committed batch ended. Mail imports end by fingerprinting the
+# new threads into near-duplicate groups (dedup.backfill).
+
+CHECKPOINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS import_checkpoints (
+    source text NOT NULL,
+    path text NOT NULL,
+    file_size bigint,
+    byte_offset bigint NOT NULL DEFAULT 0,
+    rows_written bigint NOT NULL DEFAULT 0,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    completed_at timestamptz,
+    PRIMARY KEY (source, path)
+)
+"""
+
+# Mail keeps the first message of a thread (as the API ingest does); contact
+# and event dumps are snapshots, so a newer import overwrites. Non-text
+# columns are staged as text (the binary COPY writes text) and cast on merge;
+# `fill` columns are set on already-stored mail rows that lack them.
+TARGETS = {
+    "gmail": {
+        "table": "gmail_threads", "key": "thread_id", "columns": ("thread_id", "subject", "snippet", "message_at"),
+        "types": {"message_at": "timestamptz"}, "fill": ("message_at",),
+        "keep": "first", "conflict": "DO NOTHING", "scope": GMAIL_SCOPE,
+    },
+    "hubspot": {
+        "table": "hubspot_contacts", "key": "hubspot_id", "columns": ("hubspot_id", "name", "email", "notes"),
+        "keep": "last", "scope": CONTACTS_SCOPE,
+        "conflict": "DO UPDATE SET name = EXCLUDED.name, email = EXCLUDED.email, "
+                    "notes = EXCLUDED.notes, embedding = EXCLUDED.embedding, "
+                    "embedding_model = EXCLUDED.embedding_model",
+    },
+    "calendar": {
+        "table": "calendar_events", "key": "event_id",
+        "columns": ("event_id", "summary", "description", "start_at"), "types": {"start_at": "timestamptz"},
+        "keep": "last", "scope": CALENDAR_SCOPE,
+        "conflict": "DO UPDATE SET summary = EXCLUDED.summary, description = EXCLUDED.description, "
+                    "start_at = EXCLUDED.start_at, embedding = EXCLUDED.embedding, "
+                    "embedding_model = EXCLUDED.embedding_model",
+    },
+}
+
+
+class BulkImportError(Exception):
+    pass
+
+
+# --- readers: yield (object or None, byte offset just past it) ---
+
+def read_jsonl(path, start=0):
+    with open(path, "rb") as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            offset += len(line)
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line), offset
+            except ValueError:
+                yield None, offset
+
+
+def read_mbox(path, start=0):
+    """Messages of an mbox file (mboxo/mboxrd "From " separators). `start`
+    must be a message boundary, which every checkpoint is."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        offset = start
+        lines, blank = [], True
+        for line in f:
+            if line.startswith(b"From ") and blank:
+                if lines:
+                    yield parse_message(lines), offset
+                lines = []
+            elif line.startswith(b">") and line.lstrip(b">").startswith(b"From "):
+                lines.append(line[1:])  # mboxrd quoting
+            else:
+                lines.append(line)
+            blank = not line.strip()
+            offset += len(line)
+        if lines:
+            yield parse_message(lines), offset
+
+
+def parse_message(lines):
+    try:
+        return email.message_from_bytes(b"".join(lines))
+    except Exception:
+        return None
+
+
+SOURCES = {
+    "mbox": ("gmail", read_mbox, mbox_thread_record),
+    "gmail-jsonl": ("gmail", read_jsonl, gmail_thread_record),
+    "contacts": ("hubspot", read_jsonl, contact_record),
+    "events": ("calendar", read_jsonl, event_record),
+}
+
+
+# --- checkpoints ---
+
+def load_checkpoint(cursor, source, path, size):
+    cursor.execute(
+        "SELECT byte_offset, rows_written, file_size FROM import_checkpoints WHERE source = %s AND path = %s",
+        (source, path),
+    )
+    row = cursor.fetchone()
+    if not row:
+        return 0, 0
+    offset, rows, previous_size = row
+    if offset > size or (previous_size is not None and size < previous_size):
+        raise BulkImportError(f"{path} is smaller than when it was last imported; rerun with --restart")
+    return offset, rows
+
+
+def save_checkpoint(cursor, source, path, size, offset, rows, completed=False):
+    cursor.execute("""
+        INSERT INTO import_checkpoints (source, path, file_size, byte_offset, rows_written, completed_at)
+        VALUES (%s, %s, %s, %s, %s, CASE WHEN %s THEN now() END)
+        ON CONFLICT (source, path) DO UPDATE
+        SET file_size = EXCLUDED.file_size, byte_offset = EXCLUDED.byte_offset,
+            rows_written = EXCLUDED.rows_written, completed_at = EXCLUDED.completed_at, updated_at = now()
+    """, (source, path, size, offset, rows, completed))
+
+
+# --- batches ---
+
+def normalize(objects, to_record, target):
+    """Records keyed by primary key (first or last occurrence wins) and the number dropped."""
+    key, keep = target["key"], target["keep"]
+    records, invalid, duplicates = {}, 0, 0
+    for obj in objects:
+        record = to_record(obj) if obj is not None else None
+        if record is None or not record.get(key):
+            invalid += 1
+            continue
+        if record[key] in records:
+            duplicates += 1
+            if keep == "first":
+                continue
+        records[record[key]] = record
+    return records, invalid, duplicates
+
+
+def staged(target, column, cast=False):
+    """`column` of the staging table, as text or (cast) back to its real type."""
+    kind = target.get("types", {}).get(column)
+    if not kind:
+        return column
+    return f"{column}::{kind}" if cast else f"{column}::text AS {column}"
+
+
+def fill_existing(cursor, target, records):
+    """Set the target's `fill` columns on stored rows where they are NULL."""
+    table, key = target["table"], target["key"]
+    for column in target.get("fill", ()):
+        rows = [(r[key], r[column]) for r in records if r.get(column) is not None]
+        if rows:
+            execute_values(cursor, f"""
+                UPDATE {table} t SET {column} = v.value::{target['types'].get(column, 'text')}
+                FROM (VALUES %s) AS v(key, value)
+                WHERE t.{key} = v.key AND t.{column} IS NULL
+            """, rows)
+
+
+def write_batch(cursor, target, records, embed, stats):
+    table, key, columns = target["table"], target["key"], target["columns"]
+    if target["keep"] == "first" and records:
+        # Rows that exist already would be skipped by the upsert; don't pay to embed them.
+        cursor.execute(f"SELECT {key} FROM {table} WHERE {key} = ANY(%s)", (list(records),))
+        existing = [records.pop(k) for (k,) in cursor.fetchall() if k in records]
+        stats["existing"] += len(existing)
+        fill_existing(cursor, target, existing)
+    if not records:
+        return 0
+    rows = list(records.values())
+
+    started = time.perf_counter()
+    vectors, model_name = embed([r["notes"] for r in rows])
+    vectors = np.asarray(vectors, dtype=np.float32)
+    stats["embed_s"] += time.perf_counter() - started
+    stats["embedded"] += len(rows)
+
+    started = time.perf_counter()
+    cursor.copy_expert(
+        f"COPY import_{table} ({', '.join(columns)}, embedding) FROM STDIN WITH (FORMAT binary)",
+        copy_buffer([[r.get(c) for c in columns] for r in rows], vectors),
+    )
+    stats["copy_s"] += time.perf_counter() - started
+
+    started = time.perf_counter()
+    cursor.execute(f"""
+        INSERT INTO {table} ({', '.join(columns)}, embedding, embedding_model)
+        SELECT {', '.join(staged(target, c, cast=True) for c in columns)}, embedding, %s FROM import_{table}
+        ON CONFLICT ({key}) {target['conflict']}
+    """, (model_name,))
+    written = cursor.rowcount
+    cursor.execute(f"TRUNCATE import_{table}")
+    stats["upsert_s"] += time.perf_counter() - started
+    return written
+
+
+def run_import(db, source, path, embed, batch_size=2000, restart=False, log=print, dedup=None):
+    """Import `path` as `source` (see SOURCES). `embed(texts)` returns one
+    vector per text and the name of the model (Embedder.embed). Mail is then
+    grouped by `dedup` (a NearDuplicates) when given. Returns the stats dict."""
+    if source not in SOURCES:
+        raise BulkImportError(f"Unknown source '{source}' (use {', '.join(SOURCES)})")
+    kind, reader, to_record = SOURCES[source]
+    target = TARGETS[kind]
+    path = os.path.realpath(path)
+    size = os.path.getsize(path)
+
+    with db.cursor() as cur:
+        cur.execute(CHECKPOINT_SCHEMA)
+        cur.execute(VERSIONS_SCHEMA)
+        # Untyped vector: the dimension may change if the active model is switched mid-import.
+        cur.execute(f"""
+            CREATE TEMP TABLE IF NOT EXISTS import_{target['table']} AS
+            SELECT {', '.join(staged(target, c) for c in target['columns'])}, embedding::vector AS embedding
+            FROM {target['table']} WITH NO DATA
+        """)
+        offset, total_written = (0, 0) if restart else load_checkpoint(cur, source, path, size)
+        db.commit()
+    if offset:
+        log(f"↪️ Resuming {os.path.basename(path)} at byte {offset:,} of {size:,} ({total_written:,} rows written)")
+
+    stats = {"read": 0, "invalid": 0, "duplicates": 0, "existing": 0, "embedded": 0, "written": 0,
+             "embed_s": 0.0, "copy_s": 0.0, "upsert_s": 0.0}
+    started = time.perf_counter()
+    batch, batch_end, committed = [], offset, offset
+
+    def flush():
+        nonlocal total_written, committed
+        records, invalid, duplicates = normalize(batch, to_record, target)
+        stats["invalid"] += invalid
+        stats["duplicates"] += duplicates
+        with db.cursor() as cur:
+            try:
+                written = write_batch(cur, target, records, embed, stats)
+                if written:
+                    bump_version(cur, target["scope"])
+                total_written += written
+                save_checkpoint(cur, source, path, size, batch_end, total_written, completed=batch_end >= size)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        committed = batch_end
+        stats["written"] += written
+        elapsed = time.perf_counter() - started
+        log(f"📥 {batch_end / (size or 1):6.1%}  read={stats['read']:,} written={stats['written']:,} "
+            f"({stats['read'] / elapsed:,.0f} rows/s)")
+        batch.clear()
+
+    for obj, end in reader(path, offset):
+        batch.append(obj)
+        batch_end = end
+        stats["read"] += 1
+        if len(batch) >= batch_size:
+            flush()
+    batch_end = size  # anything after the last record (blank lines) is consumed too
+    if batch or committed < size:
+        flush()
+    if kind == "gmail" and dedup is not None:
+        stats["near_duplicates"] = backfill(db, dedup, log=log)["duplicates"]
+
+    elapsed = time.perf_counter() - started
+    stats.update({
+        "source": source,
+        "path": path,
+        "table": target["table"],
+        "seconds": round(elapsed, 2),
+        "rows_per_sec": round(stats["read"] / elapsed, 1) if elapsed else None,
+        "embed_rows_per_sec": round(stats["embedded"] / stats["embed_s"], 1) if stats["embed_s"] else None,
+        "load_rows_per_sec": round(stats["embedded"] / (stats["copy_s"] + stats["upsert_s"]), 1)
+        if stats["copy_s"] + stats["upsert_s"] else None,
+    })
+    for name in ("embed_s", "copy_s", "upsert_s"):
+        stats[name] = round(stats[name], 2)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-import mbox / JSONL exports into the vector tables.")
+    parser.add_argument("source", choices=SOURCES, help="mbox, gmail-jsonl (Gmail API threads), "
+                                                        "contacts (HubSpot objects) or events (Calendar events)")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--dsn", default=None, help="libpq DSN; defaults to the backend's PG_* environment")
+    parser.add_argument("--batch-size", type=int, default=2000, help="records per embed/COPY/upsert transaction")
+    parser.add_argument("--encode-batch-size", type=int, default=256, help="sentence-transformers batch size")
+    parser.add_argument("--model", default=None, help="seed model for a fresh database; "
+                                                      "otherwise the active model (embedding_state) is used")
+    parser.add_argument("--restart", action="store_true", help="ignore saved offsets and start from the beginning")
+    parser.add_argument("--max-distance", type=int, default=int(os.getenv("GMAIL_DEDUP_MAX_DISTANCE", "3")),
+                        help="max differing SimHash bits for near-duplicate mail")
+    args = parser.parse_args()
+
+    from embeddings import DEFAULT_MODEL, Embedder
+
+    if args.dsn:
+        import psycopg2
+
+        def connect():
+            return psycopg2.connect(args.dsn)
+    else:
+        from db import connect  # backend/db.py, from the PG_* environment
+
+    db = connect()
+    embedder = Embedder(connect, args.model or DEFAULT_MODEL)
+    with db.cursor() as cur:
+        embedder.ensure_schema(cur)
+    db.commit()
+
+    def embed(texts):
+        return embedder.embed(texts, batch_size=args.encode_batch_size, convert_to_numpy=True,
+                              show_progress_bar=False)
+
+    dedup = NearDuplicates(args.max_distance)
+    try:
+        for path in args.paths:
+            stats = run_import(db, args.source, path, embed, args.batch_size, args.restart, dedup=dedup)
+            print(f"✅ {os.path.basename(path)} → {stats['table']}: {stats['written']:,} written, "
+                  f"{stats['existing'] + stats['duplicates']:,} already present or repeated, "
+                  f"{stats['invalid']:,} unusable; {stats['rows_per_sec']:,} rows/s "
+                  f"(embed {stats['embed_rows_per_sec']} rows/s, load {stats['load_rows_per_sec']} rows/s)")
+            print(json.dumps(stats, indent=2))
+    finally:
+        embedder.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import threading
+import time
+from email.utils import format_datetime, parsedate_to_datetime
+
+from contact_index import SCHEMA, bump_version
+
+# ---------- Conditional GET ----------
+# Read endpoints derive an ETag from the data_versions rows their results
+# depend on (plus the query string), so a repeat request can be answered with
+# 304 before the query is embedded or the vector search runs. Writers bump the
+# scope in the same transaction as the rows. Versions are cached per worker
+# for `max_staleness` seconds: another worker's write may be answered with 304
+# for at most that long, the same trade-off the contact index makes.
+
+GMAIL_SCOPE = "gmail_threads"
+CALENDAR_SCOPE = "calendar_events"
+
+
+def tasks_scope(email):
+    return f"user_tasks:{email}"
+
+
+class DataVersions:
+    def __init__(self, max_staleness=2.0):
+        self.max_staleness = max_staleness
+        self.cache = {}  # scope -> (version, updated_at, checked_at)
+        self.lock = threading.Lock()
+
+    def ensure_schema(self, cursor):
+        cursor.execute(SCHEMA)
+
+    def get(self, cursor, scopes):
+        """{scope: (version, updated_at)}; scopes never written are (0, None)."""
+        now = time.monotonic()
+        with self.lock:
+            fresh = {s: self.cache[s][:2] for s in scopes
+                     if s in self.cache and now - self.cache[s][2] < self.max_staleness}
+        missing = [s for s in scopes if s not in fresh]
+        if missing:
+            cursor.execute(
+                "SELECT scope, version, updated_at FROM data_versions WHERE scope = ANY(%s)", (missing,)
+            )
+            found = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+            with self.lock:
+                for scope in missing:
+                    fresh[scope] = found.get(scope, (0, None))
+                    self.cache[scope] = (*fresh[scope], now)
+        return fresh
+
+    def bump(self, cursor, scope):
+        """Publish a change to `scope` (committed with the caller's transaction)."""
+        version = bump_version(cursor, scope)
+        self.forget(scope)
+        return version
+
+    def forget(self, *scopes):
+        """Drop cached versions, e.g. after a scope was bumped elsewhere."""
+        with self.lock:
+            for scope in scopes:
+                self.cache.pop(scope, None)
+
+    def validators(self, cursor, scopes, request, as_of=None):
+        """ETag and Last-Modified headers for a response built from `scopes`
+        and, for responses that also depend on the time (recency ranking),
+        the clock value `as_of` they were computed for."""
+        versions = self.get(cursor, scopes)
+        key = [request.url.path, sorted(request.query_params.multi_items()),
+               sorted((s, v[0]) for s, v in versions.items())]
+        if as_of is not None:
+            key.append(as_of.isoformat())
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:20]
+        headers = {"ETag": f'W/"{digest}"', "Cache-Control": "private, no-cache"}
+        modified = [v[1] for v in versions.values() if v[1] is not None] + ([as_of] if as_of else [])
+        if modified:
+            headers["Last-Modified"] = format_datetime(max(modified), usegmt=True)
+        return headers
+
+
+def not_modified(request, headers):
+    """True if the request's validators still match `headers` (If-None-Match
+    takes precedence over If-Modified-Since, as in RFC 9110)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        return "*" in tags or headers["ETag"].removeprefix("W/") in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "Last-Modified" in headers:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return parsedate_to_datetime(headers["Last-Modified"]) <= since
+    return False
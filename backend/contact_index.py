@@ -0,0 +1,115 @@
+import threading
+import time
+
+# ---------- HubSpot Contact Index ----------
+# In-process set of normalized contact emails so "is this sender a client?"
+# is a set lookup instead of a query per email. Writers bump a shared version
+# row in data_versions; other workers notice the bump on their next staleness
+# check and reload.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS data_versions (
+    scope text PRIMARY KEY,
+    version bigint NOT NULL DEFAULT 0,
+    updated_at timestamptz NOT NULL DEFAULT now()
+)
+"""
+
+SCOPE = "hubspot_contacts"
+
+
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+
+def bump_version(cursor, scope):
+    cursor.execute("""
+        INSERT INTO data_versions (scope, version) VALUES (%s, 1)
+        ON CONFLICT (scope) DO UPDATE
+        SET version = data_versions.version + 1, updated_at = now()
+        RETURNING version
+    """, (scope,))
+    return cursor.fetchone()[0]
+
+
+def current_version(cursor, scope):
+    cursor.execute("SELECT version FROM data_versions WHERE scope = %s", (scope,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+class ContactIndex:
+    def __init__(self, max_staleness=30.0):
+        self.max_staleness = max_staleness
+        self.emails = set()
+        self.version = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.version is not None
+
+    def ensure_schema(self, cursor):
+        cursor.execute(SCHEMA)
+
+    def load(self, cursor):
+        version = current_version(cursor, SCOPE)
+        cursor.execute("SELECT email FROM hubspot_contacts WHERE email IS NOT NULL AND email <> ''")
+        emails = {normalize_email(row[0]) for row in cursor.fetchall()}
+        with self.lock:
+            self.emails = emails
+            self.version = version
+            self.checked_at = time.monotonic()
+        return len(emails)
+
+    def ensure_fresh(self, cursor):
+        """Reload if another worker has written since we last looked."""
+        if self.loaded and time.monotonic() - self.checked_at < self.max_staleness:
+            return
+        if not self.loaded or current_version(cursor, SCOPE) != self.version:
+            self.load(cursor)
+        else:
+            self.checked_at = time.monotonic()
+
+    def add(self, emails, cursor=None):
+        """Record new contacts locally; with a cursor also publish a version bump
+        (the caller commits it together with the contact rows)."""
+        normalized = {normalize_email(e) for e in emails if e}
+        if not normalized:
+            return
+        new_version = bump_version(cursor, SCOPE) if cursor is not None else None
+        with self.lock:
+            self.emails |= normalized
+            # Only adopt the new version if nothing else changed in between,
+            # otherwise leave ours behind so the next check reloads.
+            if new_version is not None and self.version == new_version - 1:
+                self.version = new_version
+
+    def contains(self, email):
+        return normalize_email(email) in self.emails
+
+    def existing(self, cursor, emails):
+        """Subset of `emails` that are known contacts. Falls back to the
+        database if the index could not be loaded."""
+        emails = [e for e in emails if e]
+        if not emails:
+            return set()
+        try:
+            self.ensure_fresh(cursor)
+        except Exception as e:
+            print(f"⚠️ Contact index refresh failed: {e}")
+        if not self.loaded:
+            cursor.execute("SELECT email FROM hubspot_contacts WHERE email = ANY(%s)", (list(emails),))
+            found = {normalize_email(row[0]) for row in cursor.fetchall()}
+            return {e for e in emails if normalize_email(e) in found}
+        known = self.emails
+        return {e for e in emails if normalize_email(e) in known}
+
+    def stats(self):
+        return {
+            "loaded": self.loaded,
+            "size": len(self.emails),
+            "version": self.version,
+            "age_s": round(time.monotonic() - self.checked_at, 1) if self.loaded else None,
+        }
@@ -0,0 +1,46 @@
+import os
+import weakref
+
+import psycopg2
+from psycopg2 import extensions
+
+# ---------- PostgreSQL Connection (Vector DB) ----------
+
+# Every connection this process has opened and not yet garbage collected, so
+# connection counts and states can be reported without querying the server.
+_connections = weakref.WeakSet()
+opened = 0
+
+_STATES = {
+    extensions.TRANSACTION_STATUS_IDLE: "idle",
+    extensions.TRANSACTION_STATUS_ACTIVE: "active",
+    extensions.TRANSACTION_STATUS_INTRANS: "in_transaction",
+    extensions.TRANSACTION_STATUS_INERROR: "in_error",
+    extensions.TRANSACTION_STATUS_UNKNOWN: "unknown",
+}
+
+
+def connect():
+    global opened
+    db = psycopg2.connect(
+        host=os.getenv("PG_HOST"),
+        database=os.getenv("PG_NAME"),
+        user=os.getenv("PG_USER"),
+        password=os.getenv("PG_PASSWORD"),
+        port=os.getenv("PG_PORT", "5432")
+    )
+    _connections.add(db)
+    opened += 1
+    return db
+
+
+def connection_states():
+    """Open connections by transaction state, plus closed-but-referenced ones."""
+    counts = {state: 0 for state in _STATES.values()}
+    counts["closed"] = 0
+    for db in list(_connections):
+        if db.closed:
+            counts["closed"] += 1
+        else:
+            counts[_STATES.get(db.info.transaction_status, "unknown")] += 1
+    return counts
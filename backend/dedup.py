@@ -0,0 +1,287 @@
+import argparse
+import hashlib
+import re
+
+from psycopg2.extras import execute_values
+
+# ---------- Near-Duplicate Detection ----------
+# Newsletters, notifications and reply chains produce many Gmail threads whose
+# subject/snippet differ only in a date, a number or a "Re:". Each thread gets
+# a 64-bit SimHash of its normalized text; two threads are near-duplicates when
+# the fingerprints differ in at most `max_distance` bits. Candidates are found
+# through an LSH table: the fingerprint is cut into `max_distance + 1` bands,
+# and (pigeonhole) any fingerprint within that distance matches at least one
+# band exactly. Only canonical threads are banded. A duplicate is stored
+# with its canonical's vector instead of being embedded, and queries keep
+# only the closest thread of each group (`distinct_matches`).
+
+BITS = 64
+MIN_FEATURES = 6  # shorter texts are too ambiguous to call duplicates
+DEFAULT_OVERFETCH = 4
+GROUP = "COALESCE(canonical_thread_id, thread_id)"
+
+SCHEMA = """
+ALTER TABLE gmail_threads ADD COLUMN IF NOT EXISTS simhash bigint;
+ALTER TABLE gmail_threads ADD COLUMN IF NOT EXISTS canonical_thread_id text;
+CREATE TABLE IF NOT EXISTS gmail_simhash_bands (
+    band smallint NOT NULL,
+    value integer NOT NULL,
+    thread_id text NOT NULL,
+    PRIMARY KEY (band, value, thread_id)
+);
+"""
+
+REPLY_PREFIX = re.compile(r"^\s*((re|fwd?|aw|sv)\s*(\[\d+\])?\s*:\s*)+", re.IGNORECASE)
+URL = re.compile(r"https?://\S+|www\.\S+")
+TOKEN = re.compile(r"[^\W\d_]+|\d+")
+
+
+def normalize(subject, snippet):
+    """Tokens of subject + snippet with reply prefixes, URLs and numbers
+    (dates, order ids, counts) neutralized."""
+    text = f"{REPLY_PREFIX.sub('', subject or '')} {snippet or ''}".lower()
+    text = URL.sub(" url ", text)
+    return ["0" if t.isdigit() else t for t in TOKEN.findall(text)]
+
+
+def feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "big")
+
+
+def simhash(tokens):
+    """64-bit SimHash over unigrams and bigrams, or None for too little text."""
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    if len(features) < MIN_FEATURES:
+        return None
+    weights = [0] * BITS
+    for h in map(feature_hash, features):
+        for bit in range(BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(BITS) if weights[bit] > 0)
+
+
+def to_signed(value):
+    """Unsigned 64-bit fingerprint -> Postgres bigint."""
+    return value - (1 << BITS) if value >= 1 << (BITS - 1) else value
+
+
+def to_unsigned(value):
+    return value + (1 << BITS) if value < 0 else value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class NearDuplicates:
+    def __init__(self, max_distance=3):
+        # gmail_simhash_bands.value is an integer: three or more bands keep each
+        # band under 32 bits.
+        if max_distance < 2:
+            raise ValueError(f"max_distance must be at least 2, got {max_distance}")
+        self.max_distance = max_distance
+        count = max_distance + 1
+        width, extra = divmod(BITS, count)
+        # (shift, mask) per band; the first `extra` bands are a bit wider.
+        self.bands, shift = [], 0
+        for i in range(count):
+            size = width + (i < extra)
+            self.bands.append((shift, (1 << size) - 1))
+            shift += size
+        self.stats = {"checked": 0, "duplicates": 0, "existing": 0, "unhashable": 0}
+
+    def ensure_schema(self, cursor):
+        cursor.execute(SCHEMA)
+
+    def band_values(self, fingerprint):
+        return [(i, fingerprint >> shift & mask) for i, (shift, mask) in enumerate(self.bands)]
+
+    def fingerprint(self, subject, snippet):
+        return simhash(normalize(subject, snippet))
+
+    def assign(self, cursor, records):
+        """Annotate gmail records (ingest.thread_record dicts) in place with
+        `simhash` (signed, or None) and `canonical` — the thread whose vector
+        they can reuse: an earlier record of the same batch or a stored
+        canonical thread, their own id if already stored, or None (embed it)."""
+        prints = [self.fingerprint(r["subject"], r["snippet"]) for r in records]
+        stored = self.candidates(cursor, [p for p in prints if p is not None])
+        batch = {}  # (band, value) -> [(fingerprint, thread_id)] of this batch's canonicals
+        for record, fingerprint in zip(records, prints):
+            self.stats["checked"] += 1
+            record["simhash"] = None if fingerprint is None else to_signed(fingerprint)
+            record["canonical"] = None
+            if fingerprint is None:
+                self.stats["unhashable"] += 1
+                continue
+            keys = self.band_values(fingerprint)
+            seen = {c for key in keys for c in stored.get(key, ())} | {c for key in keys for c in batch.get(key, ())}
+            match = min(((hamming(fingerprint, other), thread_id) for other, thread_id in seen), default=None)
+            if match is not None and match[0] > self.max_distance:
+                match = None
+            if match is None:
+                for key in keys:
+                    batch.setdefault(key, []).append((fingerprint, record["thread_id"]))
+            elif match[1] == record["thread_id"]:
+                record["canonical"] = record["thread_id"]
+                self.stats["existing"] += 1
+            else:
+                record["canonical"] = match[1]
+                self.stats["duplicates"] += 1
+        return records
+
+    def candidates(self, cursor, fingerprints):
+        """{(band, value): [(fingerprint, thread_id)]} of stored canonical threads."""
+        keys = {key for f in fingerprints for key in self.band_values(f)}
+        if not keys:
+            return {}
+        bands, values = zip(*keys)
+        cursor.execute("""
+            SELECT b.band, b.value, g.simhash, g.thread_id
+            FROM unnest(%s::smallint[], %s::integer[]) AS k(band, value)
+            JOIN gmail_simhash_bands b ON b.band = k.band AND b.value = k.value
+            JOIN gmail_threads g ON g.thread_id = b.thread_id
+        """, (list(bands), list(values)))
+        found = {}
+        for band, value, fingerprint, thread_id in cursor.fetchall():
+            found.setdefault((band, value), []).append((to_unsigned(fingerprint), thread_id))
+        return found
+
+    def index(self, cursor, records):
+        """Band the records that were stored as canonical threads."""
+        rows = [(band, value, r["thread_id"]) for r in records
+                if r["simhash"] is not None and r["canonical"] is None
+                for band, value in self.band_values(to_unsigned(r["simhash"]))]
+        if rows:
+            execute_values(cursor, """
+                INSERT INTO gmail_simhash_bands (band, value, thread_id) VALUES %s
+                ON CONFLICT DO NOTHING
+            """, rows)
+
+    def insert_duplicates(self, cursor, records):
+        """Store duplicates with their canonical's vector (and its model tag); returns how many were new."""
+        rows = [(r["thread_id"], r["subject"], r["snippet"], r.get("message_at"), r["simhash"], r["canonical"])
+                for r in records if r["canonical"] not in (None, r["thread_id"])]
+        if rows:
+            execute_values(cursor, """
+                INSERT INTO gmail_threads (thread_id, subject, snippet, message_at, simhash, canonical_thread_id,
+                                           embedding, embedding_model)
+                SELECT v.thread_id, v.subject, v.snippet, v.message_at::timestamptz, v.simhash::bigint, v.canonical,
+                       c.embedding, c.embedding_model
+                FROM (VALUES %s) AS v(thread_id, subject, snippet, message_at, simhash, canonical)
+                JOIN gmail_threads c ON c.thread_id = v.canonical
+                ON CONFLICT (thread_id) DO NOTHING
+            """, rows, page_size=len(rows))
+            return cursor.rowcount
+        return 0
+
+    def report(self, cursor, top=10):
+        """Stored groups, duplicates (= embeddings not computed) and the largest groups."""
+        cursor.execute(f"""
+            SELECT count(*), count(DISTINCT {GROUP}), count(*) FILTER (WHERE simhash IS NULL)
+            FROM gmail_threads
+        """)
+        rows, groups, unhashed = cursor.fetchone()
+        cursor.execute(f"""
+            SELECT {GROUP} AS grp, count(*), min(subject)
+            FROM gmail_threads
+            WHERE canonical_thread_id IS NOT NULL
+            GROUP BY grp HAVING count(*) > 1
+            ORDER BY count(*) DESC
+            LIMIT %s
+        """, (top,))
+        largest = [{"canonical_thread_id": g, "threads": n, "subject": s} for g, n, s in cursor.fetchall()]
+        return {
+            "threads": rows,
+            "groups": groups,
+            "duplicates": rows - groups,
+            "duplicate_ratio": round((rows - groups) / rows, 4) if rows else 0.0,
+            "not_fingerprinted": unhashed,
+            "largest_groups": largest,
+            "max_distance": self.max_distance,
+            "this_process": dict(self.stats),
+        }
+
+
+def distinct_matches(columns, vector, where="TRUE", score="distance"):
+    """A FROM-clause subquery over the nearest gmail_threads to `vector` (an
+    SQL expression) that keeps the best-scoring thread of each near-duplicate
+    group. Yields `columns`, `distance`, `score` (an expression over the
+    columns and distance; lower is better) and `duplicates` (other group
+    members among the candidates). Takes the parameters of `where`, then the
+    number of ANN candidates (k * overfetch)."""
+    names = ", ".join(columns)
+    return f"""(
+        SELECT DISTINCT ON (dup_group) {names}, distance, {score} AS score,
+               count(*) OVER (PARTITION BY dup_group) - 1 AS duplicates
+        FROM (
+            SELECT {names}, {GROUP} AS dup_group, embedding <=> {vector} AS distance
+            FROM gmail_threads
+            WHERE {where}
+            ORDER BY embedding <=> {vector}
+            LIMIT %s
+        ) candidates
+        ORDER BY dup_group, {score}
+    )"""
+
+
+def backfill(db, dedup, batch_size=5000, log=print):
+    """Fingerprint and group stored threads that predate deduplication (or
+    came in through bulk_import.py). Vectors are left as they are."""
+    with db.cursor() as cur:
+        dedup.ensure_schema(cur)
+    db.commit()
+    last, total, duplicates = "", 0, 0
+    while True:
+        with db.cursor() as cur:
+            cur.execute("""
+                SELECT thread_id, subject, snippet FROM gmail_threads
+                WHERE simhash IS NULL AND thread_id > %s
+                ORDER BY thread_id LIMIT %s
+            """, (last, batch_size))
+            records = [{"thread_id": t, "subject": s, "snippet": n} for t, s, n in cur.fetchall()]
+            if not records:
+                break
+            dedup.assign(cur, records)
+            execute_values(cur, """
+                UPDATE gmail_threads g SET simhash = v.simhash::bigint, canonical_thread_id = v.canonical
+                FROM (VALUES %s) AS v(thread_id, simhash, canonical)
+                WHERE g.thread_id = v.thread_id
+            """, [(r["thread_id"], r["simhash"], r["canonical"] or r["thread_id"]) for r in records])
+            dedup.index(cur, records)
+            db.commit()
+        last = records[-1]["thread_id"]
+        total += len(records)
+        duplicates += sum(r["canonical"] is not None for r in records)
+        log(f"🔁 {total:,} threads fingerprinted, {duplicates:,} near-duplicates")
+    return {"threads": total, "duplicates": duplicates}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fingerprint stored Gmail threads and group near-duplicates.")
+    parser.add_argument("--dsn", default=None, help="libpq DSN; defaults to the backend's PG_* environment")
+    parser.add_argument("--max-distance", type=int, default=3, help="max differing SimHash bits")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.dsn:
+        import psycopg2
+
+        db = psycopg2.connect(args.dsn)
+    else:
+        import db as backend_db  # backend/db.py, from the PG_* environment
+
+        db = backend_db.connect()
+    dedup = NearDuplicates(args.max_distance)
+    try:
+        backfill(db, dedup, args.batch_size)
+        with db.cursor() as cur:
+            report = dedup.report(cur)
+        print(f"✅ {report['threads']:,} threads in {report['groups']:,} groups "
+              f"({report['duplicate_ratio']:.1%} near-duplicates)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
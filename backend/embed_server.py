@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+# ---------- Embedding Sidecar ----------
+# One process holds the model weights and the torch runtime; API workers
+# (EMBEDDING_MODE=sidecar) send it texts over a Unix socket instead of each
+# loading their own copy. Requests that queue up while a batch is being
+# encoded are encoded together next, so concurrent queries from different
+# workers share one forward pass while a lone request never waits.
+#
+# Wire format, both directions: 4-byte big-endian length + payload. A request
+# is one JSON frame ({"op": "encode", "model", "texts", "normalize"} or
+# {"op": "info", "model"} or {"op": "stats"}); the reply is a JSON frame and,
+# for encode, a second frame of float32 rows (shape in the JSON).
+
+DEFAULT_SOCKET = "/tmp/embed.sock"
+MAX_FRAME = 256 * 1024 * 1024
+
+
+class SidecarError(Exception):
+    pass
+
+
+def send_frame(sock, payload):
+    sock.sendall(struct.pack(">I", len(payload)) + payload)
+
+
+def recv_exact(sock, size):
+    chunks, remaining = [], size
+    while remaining:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise ConnectionError("embedding sidecar closed the connection")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_frame(sock):
+    (size,) = struct.unpack(">I", recv_exact(sock, 4))
+    if size > MAX_FRAME:
+        raise SidecarError(f"frame of {size} bytes exceeds {MAX_FRAME}")
+    return recv_exact(sock, size)
+
+
+# --- client ---
+
+class SidecarModel:
+    """Stands in for a SentenceTransformer (encode, get_sentence_embedding_dimension)
+    backed by the sidecar. One connection per calling thread."""
+
+    def __init__(self, path, name, timeout=30.0):
+        self.path = path
+        self.name = name
+        self.timeout = timeout
+        self.local = threading.local()
+        self.dimension = None
+
+    def connection(self):
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self.local.sock = sock
+        return sock
+
+    def call(self, request):
+        for attempt in range(2):
+            sock = self.connection()
+            try:
+                send_frame(sock, json.dumps(request).encode())
+                reply = json.loads(recv_frame(sock))
+                if "error" in reply:
+                    raise SidecarError(reply["error"])
+                if "shape" not in reply:
+                    return reply, None
+                data = recv_frame(sock)
+                return reply, np.frombuffer(data, dtype=np.float32).reshape(reply["shape"])
+            except (ConnectionError, BrokenPipeError, socket.timeout):
+                self.local.sock = None
+                sock.close()
+                if attempt:
+                    raise  # a restarted sidecar gets one reconnect
+        raise AssertionError("unreachable")
+
+    def encode(self, texts, normalize_embeddings=False, **kwargs):
+        """Like SentenceTransformer.encode with convert_to_numpy: a single string
+        gives one vector. Batching and progress options are the sidecar's."""
+        single = isinstance(texts, str)
+        _, vectors = self.call({"op": "encode", "model": self.name, "texts": [texts] if single else list(texts),
+                                "normalize": bool(normalize_embeddings)})
+        return vectors[0] if single else vectors
+
+    def get_sentence_embedding_dimension(self):
+        if self.dimension is None:
+            self.dimension = self.call({"op": "info", "model": self.name})[0]["dimension"]
+        return self.dimension
+
+
+def sidecar_loader(path=DEFAULT_SOCKET):
+    """An Embedder loader that resolves model names to the sidecar's."""
+    return lambda name: SidecarModel(path, name)
+
+
+# --- server ---
+
+class Batcher:
+    """Coalesces encode requests: takes every queued request (up to `max_batch`
+    texts), optionally waiting `max_wait_ms` for more, then encodes each
+    model's texts in one call."""
+
+    def __init__(self, loader, max_batch=256, max_wait_ms=0.0, encode_batch_size=64):
+        self.loader = loader
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.encode_batch_size = encode_batch_size
+        self.models = {}
+        self.models_lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.stats = {"requests": 0, "texts": 0, "batches": 0, "encode_s": 0.0}
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def model(self, name):
+        with self.models_lock:
+            if name not in self.models:
+                print(f"🧠 Loading {name}")
+                self.models[name] = self.loader(name)
+            return self.models[name]
+
+    def submit(self, name, texts, normalize):
+        future = Future()
+        self.jobs.put((name, texts, normalize, future))
+        return future
+
+    def loop(self):
+        while True:
+            jobs = [self.jobs.get()]
+            size = len(jobs[0][1])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    remaining = deadline - time.monotonic()
+                    job = self.jobs.get(timeout=remaining) if remaining > 0 else self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                size += len(job[1])
+            groups = {}
+            for job in jobs:
+                groups.setdefault((job[0], job[2]), []).append(job)
+            for (name, normalize), group in groups.items():
+                self.run(name, normalize, group)
+
+    def run(self, name, normalize, group):
+        texts = [t for job in group for t in job[1]]
+        try:
+            started = time.perf_counter()
+            vectors = np.asarray(self.model(name).encode(
+                texts, batch_size=self.encode_batch_size, normalize_embeddings=normalize,
+                convert_to_numpy=True, show_progress_bar=False,
+            ), dtype=np.float32)
+            self.stats["encode_s"] += time.perf_counter() - started
+        except Exception as e:
+            for job in group:
+                job[3].set_exception(e)
+            return
+        self.stats["requests"] += len(group)
+        self.stats["texts"] += len(texts)
+        self.stats["batches"] += 1
+        start = 0
+        for job in group:
+            job[3].set_result(vectors[start:start + len(job[1])])
+            start += len(job[1])
+
+
+class EmbedServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, batcher):
+        if os.path.exists(path):
+            os.unlink(path)  # stale socket from a previous run
+        self.batcher = batcher
+        super().__init__(path, Handler)
+        os.chmod(path, 0o660)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.batcher.thread.start()
+        super().serve_forever(poll_interval)
+
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        batcher = self.server.batcher
+        while True:
+            try:
+                request = json.loads(recv_frame(self.request))
+            except (ConnectionError, OSError, ValueError, SidecarError):
+                return
+            try:
+                op = request.get("op")
+                if op == "encode":
+                    vectors = batcher.submit(request["model"], request["texts"], request.get("normalize", False)).result()
+                    send_frame(self.request, json.dumps({"shape": list(vectors.shape)}).encode())
+                    send_frame(self.request, vectors.tobytes())
+                elif op == "info":
+                    dimension = batcher.model(request["model"]).get_sentence_embedding_dimension()
+                    send_frame(self.request, json.dumps({"dimension": dimension}).encode())
+                elif op == "stats":
+                    stats = dict(batcher.stats, models=list(batcher.models), pid=os.getpid())
+                    send_frame(self.request, json.dumps(stats).encode())
+                else:
+                    send_frame(self.request, json.dumps({"error": f"unknown op {op!r}"}).encode())
+            except OSError:
+                return
+            except Exception as e:
+                send_frame(self.request, json.dumps({"error": str(e)}).encode())
+
+
+def serve(path=DEFAULT_SOCKET, preload=(), max_batch=256, max_wait_ms=0.0, encode_batch_size=64, loader=None):
+    if loader is None:
+        from embeddings import load_sentence_transformer as loader
+    batcher = Batcher(loader, max_batch, max_wait_ms, encode_batch_size)
+    for name in preload:
+        batcher.model(name)
+    server = EmbedServer(path, batcher)
+    print(f"🧠 Embedding sidecar listening on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def main():
+    from embeddings import DEFAULT_MODEL
+
+    parser = argparse.ArgumentParser(description="Serve sentence-transformers embeddings to local workers.")
+    parser.add_argument("--socket", default=os.getenv("EMBEDDING_SOCKET", DEFAULT_SOCKET))
+    parser.add_argument("--model", action="append", default=None,
+                        help=f"model to load at startup (repeatable; default {DEFAULT_MODEL}); others load on demand")
+    parser.add_argument("--max-batch", type=int, default=256, help="max texts coalesced into one encode")
+    parser.add_argument("--max-wait-ms", type=float, default=0.0,
+                        help="extra wait for more requests before encoding (0: batch whatever is queued)")
+    parser.add_argument("--encode-batch-size", type=int, default=64)
+    args = parser.parse_args()
+    serve(args.socket, args.model or [os.getenv("EMBEDDING_MODEL", DEFAULT_MODEL)],
+          args.max_batch, args.max_wait_ms, args.encode_batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import gc
+import threading
+import time
+
+from contact_index import SCHEMA as VERSIONS_SCHEMA
+from ingest import event_record, thread_record
+
+# ---------- Embedding Models ----------
+# All encoding goes through Embedder, so the model is chosen in one place:
+# embedding_state.active_model. Every row records the model that produced
+# its vector in `embedding_model`. Moving to another model is a background
+# re-index into a shadow column (reindex.py); reads and writes stay on the
+# active model until that finishes and the columns are swapped in one
+# transaction. Each process re-reads the active model at most every
+# `max_staleness` seconds; search queries read it on the request's own
+# connection (encode_query), so they never compare against the other column.
+
+DEFAULT_MODEL = "all-MiniLM-L6-v2"
+STATE_SCOPE = "embeddings"
+# local: each process loads the models it uses (shared if preloaded, see below)
+# sidecar: models live in embed_server.py, reached over EMBEDDING_SOCKET
+MODES = ("local", "preload", "sidecar")
+
+# Models loaded before the server forks its workers (gunicorn.conf.py with
+# EMBEDDING_MODE=preload). Workers inherit them copy-on-write: the weight
+# tensors are never written, so their pages stay shared across workers.
+PRELOADED = {}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embedding_state (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    active_model text NOT NULL,
+    previous_model text,
+    target_model text,
+    target_dims integer,
+    status text NOT NULL DEFAULT 'idle',
+    rows_per_sec double precision,
+    started_at timestamptz,
+    switched_at timestamptz,
+    error text,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS embedding_reindex_progress (
+    table_name text PRIMARY KEY,
+    target_model text NOT NULL,
+    phase text NOT NULL DEFAULT 'backfill',
+    last_key text,
+    done bigint NOT NULL DEFAULT 0,
+    total bigint,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+# Embedded tables: primary key, the columns the embedded text is built from,
+# and how (the same text the ingests embed, via ingest.py).
+TABLES = {
+    "gmail_threads": {
+        "key": "thread_id", "columns": ("subject", "snippet"),
+        "text": lambda subject, snippet: thread_record(None, subject, snippet)["notes"],
+    },
+    "hubspot_contacts": {
+        "key": "hubspot_id", "columns": ("notes",),
+        "text": lambda notes: notes or "",
+    },
+    "calendar_events": {
+        "key": "event_id", "columns": ("summary", "description"),
+        "text": lambda summary, description: event_record(
+            {"summary": summary or "No Title", "description": description or ""})["notes"],
+    },
+}
+
+
+def load_sentence_transformer(name):
+    if name in PRELOADED:
+        return PRELOADED[name]
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(name)
+
+
+def preload(names):
+    """Load models in a pre-fork parent, then freeze the heap so the children's
+    garbage collector doesn't touch (and so copy) the parent's objects."""
+    for name in names:
+        PRELOADED[name] = load_sentence_transformer(name)
+    gc.collect()
+    gc.freeze()
+
+
+def make_loader(mode="local", socket_path=None):
+    if mode not in MODES:
+        raise ValueError(f"Unknown EMBEDDING_MODE '{mode}' (use {', '.join(MODES)})")
+    if mode == "sidecar":
+        from embed_server import DEFAULT_SOCKET, sidecar_loader
+
+        return sidecar_loader(socket_path or DEFAULT_SOCKET)
+    return load_sentence_transformer
+
+
+def read_state(cursor):
+    cursor.execute("""
+        SELECT active_model, previous_model, target_model, target_dims, status, rows_per_sec,
+               started_at, switched_at, error, updated_at
+        FROM embedding_state
+    """)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    columns = ("active_model", "previous_model", "target_model", "target_dims", "status", "rows_per_sec",
+               "started_at", "switched_at", "error", "updated_at")
+    return dict(zip(columns, row))
+
+
+class Embedder:
+    def __init__(self, connect, default_model=DEFAULT_MODEL, loader=load_sentence_transformer, max_staleness=2.0):
+        self.connect = connect
+        self.default_model = default_model
+        self.loader = loader
+        self.max_staleness = max_staleness
+        self.models = {}
+        self.active = default_model
+        self.checked_at = 0.0
+        self.db = None
+        self.lock = threading.Lock()
+
+    def ensure_schema(self, cursor):
+        """Create the state tables and tag columns. `default_model` only seeds a
+        fresh database; existing rows are tagged with it (they were all
+        encoded by the one model there was)."""
+        cursor.execute(SCHEMA)
+        cursor.execute(VERSIONS_SCHEMA)
+        cursor.execute("INSERT INTO embedding_state (active_model) VALUES (%s) ON CONFLICT (id) DO NOTHING",
+                       (self.default_model,))
+        for table in TABLES:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS embedding_model text DEFAULT %s",
+                           (self.default_model,))
+        cursor.execute("SELECT active_model FROM embedding_state")
+        self.active = cursor.fetchone()[0]
+        self.checked_at = time.monotonic()
+
+    # --- models ---
+
+    def model(self, name=None):
+        name = name or self.active_model()
+        with self.lock:
+            model = self.models.get(name)
+            if model is None:
+                model = self.models[name] = self.loader(name)
+            return model
+
+    def dims(self, name=None):
+        return self.model(name).get_sentence_embedding_dimension()
+
+    def active_model(self):
+        """The model reads and writes should use, re-read when stale."""
+        if time.monotonic() - self.checked_at >= self.max_staleness:
+            self.refresh()
+        return self.active
+
+    def refresh(self):
+        try:
+            if self.db is None or self.db.closed:
+                self.db = self.connect()
+                self.db.autocommit = True
+            with self.db.cursor() as cur:
+                self.adopt(cur)
+        except Exception as e:
+            print(f"⚠️ Embedding state check failed, keeping {self.active}: {e}")
+            self.db = None
+            self.checked_at = time.monotonic()
+
+    def adopt(self, cursor):
+        """Read the active model on `cursor` and switch to it."""
+        cursor.execute("SELECT active_model FROM embedding_state")
+        row = cursor.fetchone()
+        name = row[0] if row else self.active
+        if name != self.active:
+            print(f"🧠 Embedding model switched: {self.active} → {name}")
+            self.active = name
+        self.checked_at = time.monotonic()
+        return name
+
+    # --- encoding ---
+
+    def encode(self, texts, model=None, **kwargs):
+        """SentenceTransformer.encode with the active (or the given) model."""
+        return self.model(model).encode(texts, **kwargs)
+
+    def encode_query(self, cursor, texts, **kwargs):
+        """Encode search text for a vector query about to run on `cursor`. The
+        model is read on that connection first rather than taken from the
+        cached tag, which can lag a switch by up to `max_staleness`."""
+        return self.encode(texts, model=self.adopt(cursor), **kwargs)
+
+    def embed(self, texts, **kwargs):
+        """(vectors, model name) for rows that are about to be stored."""
+        name = self.active_model()
+        return self.encode(texts, model=name, **kwargs), name
+
+    def close(self):
+        if self.db is not None and not self.db.closed:
+            self.db.close()
@@ -0,0 +1,298 @@
+import argparse
+import json
+import os
+import struct
+import time
+from datetime import date, datetime
+
+import numpy as np
+
+# ---------- Corpus Export ----------
+# Streams an indexed table out through a server-side (named) cursor, so only
+# one batch is ever held in memory. Embeddings are fetched with
+# vector_send(), pgvector's binary wire format (int16 dim, int16 unused, then
+# big-endian float4s): a batch's buffers are joined and reinterpreted as one
+# (rows, dim) float32 array, with no per-row list of floats. Batches are
+# written as Arrow IPC or Parquet record batches (pyarrow, imported only when
+# needed) or as .npy + JSONL shard pairs.
+
+# `timestamps` are typed explicitly for Arrow: a batch of legacy rows holds only NULLs.
+TABLES = {
+    "gmail_threads": {"key": "thread_id", "timestamps": ("message_at",),
+                      "columns": ("thread_id", "subject", "snippet", "message_at", "embedding_model")},
+    "hubspot_contacts": {"key": "hubspot_id", "columns": ("hubspot_id", "name", "email", "notes", "embedding_model")},
+    "calendar_events": {"key": "event_id", "timestamps": ("start_at",),
+                        "columns": ("event_id", "summary", "description", "start_at", "embedding_model")},
+}
+FORMATS = ("parquet", "arrow", "npy")
+NPY_HEADER_BYTES = 128  # fixed, so the row count can be rewritten when a shard closes
+
+
+class ExportError(Exception):
+    pass
+
+
+def batches(db, table, batch_size=5000):
+    """Yield (columns, rows, embeddings) per batch; embeddings is a (rows, dim) float32 array."""
+    if table not in TABLES:
+        raise ExportError(f"Unknown table '{table}' (use {', '.join(TABLES)})")
+    spec = TABLES[table]
+    columns = spec["columns"]
+    # Rows without an embedding have nothing to export; keeping them out also
+    # keeps every row of a batch the same width.
+    sql = (f"SELECT {', '.join(columns)}, vector_send(embedding) FROM {table} "
+           f"WHERE embedding IS NOT NULL ORDER BY {spec['key']}")
+    with db.cursor(name=f"export_{table}_{os.getpid()}_{int(time.time() * 1000)}") as cur:
+        cur.itersize = batch_size
+        cur.execute(sql)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield columns, [r[:-1] for r in rows], decode_vectors([r[-1] for r in rows])
+
+
+def decode_vectors(buffers):
+    """vector_send() outputs -> (n, dim) little-endian float32, with a single copy of a joined buffer."""
+    if not buffers:
+        return np.empty((0, 0), dtype=np.float32)
+    dim = struct.unpack_from(">H", buffers[0])[0]
+    joined = b"".join(buffers)
+    width = 4 + 4 * dim
+    if len(joined) != width * len(buffers):
+        raise ExportError("Embeddings in one table have different dimensions")
+    # Strided big-endian view that skips each row's 4-byte header; astype does the one copy.
+    view = np.ndarray((len(buffers), dim), dtype=">f4", buffer=joined, offset=4, strides=(width, 4))
+    return view.astype(np.float32)
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+# --- writers ---
+
+class ArrowWriter:
+    """Arrow IPC file (`arrow`) or Parquet (`parquet`), one record batch per fetch."""
+
+    def __init__(self, sink, fmt, compression="zstd", timestamps=()):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ExportError("pyarrow is required for Arrow/Parquet export (pip install pyarrow)")
+        self.pa = pa
+        self.sink = sink
+        self.fmt = fmt
+        self.compression = compression
+        self.timestamps = set(timestamps)
+        self.writer = None
+
+    def write(self, columns, rows, embeddings):
+        pa = self.pa
+        arrays = [pa.array([r[i] for r in rows], type=pa.timestamp("us", tz="UTC") if name in self.timestamps else None)
+                  for i, name in enumerate(columns)]
+        # A zero-copy view of the float32 buffer; pyarrow wraps it as fixed-size lists.
+        flat = pa.array(embeddings.reshape(-1), type=pa.float32())
+        arrays.append(pa.FixedSizeListArray.from_arrays(flat, embeddings.shape[1]))
+        batch = pa.RecordBatch.from_arrays(arrays, names=[*columns, "embedding"])
+        if self.writer is None:
+            self.writer = self._open(batch.schema)
+        self.writer.write_batch(batch)
+
+    def _open(self, schema):
+        if self.fmt == "arrow":
+            # A path gets the random-access file format; a stream sink the IPC stream format.
+            if isinstance(self.sink, str):
+                return self.pa.ipc.new_file(self.sink, schema)
+            return self.pa.ipc.new_stream(self.sink, schema)
+        import pyarrow.parquet as pq
+
+        return pq.ParquetWriter(self.sink, schema, compression=self.compression)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class NpyShardWriter:
+    """`{prefix}-00000.npy` (float32 embeddings) + `.jsonl` (the other columns,
+    same row order) per shard of `shard_rows`."""
+
+    def __init__(self, prefix, shard_rows=100000):
+        self.prefix = prefix
+        self.shard_rows = shard_rows
+        self.shards = []
+        self.npy = self.jsonl = None
+        self.count = 0
+        self.dim = None
+
+    def write(self, columns, rows, embeddings):
+        start = 0
+        while start < len(rows):
+            if self.npy is None:
+                self._open(embeddings.shape[1])
+            take = min(len(rows) - start, self.shard_rows - self.count)
+            self.npy.write(embeddings[start:start + take].tobytes())
+            for row in rows[start:start + take]:
+                self.jsonl.write(json.dumps(dict(zip(columns, row)), default=json_default) + "\n")
+            self.count += take
+            start += take
+            if self.count == self.shard_rows:
+                self._close_shard()
+
+    def _open(self, dim):
+        self.dim = dim
+        name = f"{self.prefix}-{len(self.shards):05d}"
+        self.npy = open(name + ".npy", "wb")
+        self.npy.write(npy_header(0, dim))
+        self.jsonl = open(name + ".jsonl", "w", encoding="utf-8")
+        self.shards.append({"embeddings": os.path.basename(name + ".npy"),
+                            "rows": os.path.basename(name + ".jsonl"), "count": 0})
+        self.count = 0
+
+    def _close_shard(self):
+        self.npy.seek(0)
+        self.npy.write(npy_header(self.count, self.dim))
+        self.npy.close()
+        self.jsonl.close()
+        self.shards[-1]["count"] = self.count
+        self.npy = self.jsonl = None
+
+    def close(self):
+        if self.npy is not None:
+            self._close_shard()
+
+
+def npy_header(count, dim):
+    """.npy v1.0 header for a C-order (count, dim) float32 array, padded to NPY_HEADER_BYTES."""
+    header = f"{{'descr': '<f4', 'fortran_order': False, 'shape': ({count}, {dim}), }}"
+    header = header.ljust(NPY_HEADER_BYTES - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+# --- driver ---
+
+def export_table(db, table, out_dir, fmt="parquet", batch_size=5000, shard_rows=100000):
+    """Write `table` to `out_dir` and return a manifest (also written as
+    `{table}.manifest.json`)."""
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown format '{fmt}' (use {', '.join(FORMATS)})")
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = os.path.join(out_dir, table)
+    if fmt == "npy":
+        writer = NpyShardWriter(prefix, shard_rows)
+    else:
+        path = f"{prefix}.{fmt}"
+        writer = ArrowWriter(path, fmt, timestamps=TABLES[table].get("timestamps", ()))
+
+    started = time.perf_counter()
+    rows = dim = 0
+    try:
+        for columns, batch, embeddings in batches(db, table, batch_size):
+            writer.write(columns, batch, embeddings)
+            rows += len(batch)
+            dim = embeddings.shape[1]
+    finally:
+        writer.close()
+        db.rollback()  # ends the read-only transaction holding the named cursor
+    elapsed = time.perf_counter() - started
+
+    manifest = {
+        "table": table,
+        "format": fmt,
+        "rows": rows,
+        "dimensions": dim,
+        "columns": [*TABLES[table]["columns"], "embedding"],
+        "files": writer.shards if fmt == "npy" else [os.path.basename(path)] if rows else [],
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed else None,
+        "exported_at": datetime.utcnow().isoformat() + "Z",
+    }
+    with open(f"{prefix}.manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class ChunkSink:
+    """Write-only file object that hands back what was written since the last take()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def arrow_stream(connect, table, batch_size=5000):
+    """An iterator over `table` as an Arrow IPC stream, one chunk per fetched
+    batch, on a connection of its own. Raises ExportError up front."""
+    if table not in TABLES:
+        raise ExportError(f"Unknown table '{table}' (use {', '.join(TABLES)})")
+    sink = ChunkSink()
+    writer = ArrowWriter(sink, "arrow", timestamps=TABLES[table].get("timestamps", ()))
+
+    def chunks():
+        db = connect()
+        try:
+            for columns, rows, embeddings in batches(db, table, batch_size):
+                writer.write(columns, rows, embeddings)
+                yield sink.take()
+            writer.close()
+            yield sink.take()
+        finally:
+            db.close()
+
+    return chunks()
+
+
+def connect(dsn):
+    if dsn:
+        import psycopg2
+
+        return psycopg2.connect(dsn)
+    import db  # backend/db.py, from the PG_* environment
+
+    return db.connect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export indexed tables and their embeddings for offline use.")
+    parser.add_argument("--dsn", default=None, help="libpq DSN; defaults to the backend's PG_* environment")
+    parser.add_argument("--tables", default=",".join(TABLES), help=f"subset of: {', '.join(TABLES)}")
+    parser.add_argument("--format", default="parquet", choices=FORMATS)
+    parser.add_argument("--out", default="export", help="output directory")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows fetched (and held in memory) at a time")
+    parser.add_argument("--shard-rows", type=int, default=100000, help="rows per .npy/.jsonl shard")
+    args = parser.parse_args()
+
+    db = connect(args.dsn)
+    try:
+        for table in [t.strip() for t in args.tables.split(",") if t.strip()]:
+            manifest = export_table(db, table, args.out, args.format, args.batch_size, args.shard_rows)
+            print(f"✅ {table}: {manifest['rows']} rows × {manifest['dimensions']} dims "
+                  f"in {manifest['seconds']}s ({manifest['rows_per_sec']} rows/s)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ---------- Gemini Client ----------
+# One pooled session per process. Every call goes through the rate limiter and
+# the circuit breaker, and 429/5xx responses are retried with jittered backoff.
+
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-pro")
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class GeminiError(Exception):
+    def __init__(self, message, status_code=None, details=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.details = details
+
+
+class CircuitOpenError(GeminiError):
+    pass
+
+
+class TokenBucket:
+    """Client-side rate limiter: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and lets a single
+    probe through once `reset_timeout` seconds have passed."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """End a call that says nothing about upstream health; a probe's slot
+        goes back so the next call can probe."""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic() - self.reset_timeout
+
+
+class GeminiClient:
+    def __init__(
+        self,
+        api_key,
+        base_url=GEMINI_BASE_URL,
+        model=GEMINI_MODEL,
+        connect_timeout=3.05,
+        read_timeout=30.0,
+        max_retries=3,
+        backoff_base=0.5,
+        backoff_max=8.0,
+        rate_per_sec=5.0,
+        burst=10,
+        rate_limit_wait=10.0,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        pool_size=20,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limit_wait = rate_limit_wait
+        self.limiter = TokenBucket(rate_per_sec, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            api_key=os.getenv("GEMINI_API_KEY"),
+            base_url=GEMINI_BASE_URL,
+            model=GEMINI_MODEL,
+            connect_timeout=float(os.getenv("GEMINI_CONNECT_TIMEOUT", "3.05")),
+            read_timeout=float(os.getenv("GEMINI_READ_TIMEOUT", "30")),
+            max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "3")),
+            rate_per_sec=float(os.getenv("GEMINI_RATE_PER_SEC", "5")),
+            burst=int(os.getenv("GEMINI_BURST", "10")),
+            failure_threshold=int(os.getenv("GEMINI_BREAKER_FAILURES", "5")),
+            reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+            pool_size=int(os.getenv("GEMINI_POOL_SIZE", "20")),
+        )
+
+    def url(self, method):
+        return f"{self.base_url}/models/{self.model}:{method}"
+
+    def generate(self, prompt_or_contents, **extra):
+        """POST generateContent and return the decoded JSON body.
+
+        Accepts either a plain prompt string or a ready-made `contents` list;
+        extra keyword arguments (e.g. `tools`) are merged into the payload.
+        """
+        if isinstance(prompt_or_contents, str):
+            contents = [{"parts": [{"text": prompt_or_contents}]}]
+        else:
+            contents = prompt_or_contents
+        payload = {"contents": contents, **extra}
+        return self._post(self.url("generateContent"), payload).json()
+
+    def generate_text(self, prompt_or_contents, **extra):
+        return extract_text(self.generate(prompt_or_contents, **extra))
+
+    def stream(self, prompt_or_contents, **extra):
+        """POST streamGenerateContent (SSE) and return an iterator of text chunks.
+
+        The request is made before this returns, so connection, rate-limit and
+        HTTP errors raise here rather than part way through the stream.
+        """
+        if isinstance(prompt_or_contents, str):
+            contents = [{"parts": [{"text": prompt_or_contents}]}]
+        else:
+            contents = prompt_or_contents
+        payload = {"contents": contents, **extra}
+        response = self._post(self.url("streamGenerateContent") + "?alt=sse", payload, stream=True)
+        return iter_sse_text(response)
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), self.backoff_max))
+            except ValueError:
+                pass
+        return delay
+
+    def _acquire(self):
+        if not self.limiter.acquire(timeout=self.rate_limit_wait):
+            raise GeminiError("Gemini client-side rate limit exceeded", status_code=429)
+
+    def _post(self, url, payload, stream=False):
+        # Rate-limit before asking the breaker, so a local 429 never holds a half-open probe.
+        self._acquire()
+        if not self.breaker.allow():
+            raise CircuitOpenError("Gemini circuit breaker is open", status_code=503)
+
+        body = json.dumps(payload)
+        last_error = None
+        settled = False
+        try:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    self._acquire()
+
+                retry_after = None
+                try:
+                    response = self.session.post(
+                        url,
+                        data=body,
+                        headers={"X-goog-api-key": self.api_key or ""},
+                        timeout=self.timeout,
+                        stream=stream,
+                    )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    last_error = GeminiError(f"Gemini request failed: {e}", status_code=503)
+                else:
+                    if response.status_code == 200:
+                        self.breaker.record_success()
+                        settled = True
+                        return response
+                    details = _error_details(response)
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        # Caller errors (bad request, auth) are not upstream health problems.
+                        self.breaker.record_success()
+                        settled = True
+                        raise GeminiError("Gemini API call failed", response.status_code, details)
+                    retry_after = response.headers.get("Retry-After")
+                    last_error = GeminiError("Gemini API call failed", response.status_code, details)
+                    response.close()
+
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff(attempt, retry_after))
+
+            self.breaker.record_failure()
+            settled = True
+            raise last_error
+        finally:
+            if not settled:  # a local rate limit or an unexpected error: no verdict on Gemini
+                self.breaker.release()
+
+    def close(self):
+        self.session.close()
+
+
+def extract_text(response_json):
+    try:
+        return response_json["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        raise GeminiError("Failed to parse Gemini response", details=response_json)
+
+
+def iter_sse_text(response):
+    """Text of each `data:` event in a streamGenerateContent SSE response."""
+    response.encoding = "utf-8"  # text/event-stream without a charset would default to latin-1
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            try:
+                event = json.loads(line[5:])
+            except ValueError:
+                continue
+            parts = (event.get("candidates") or [{}])[0].get("content", {}).get("parts", [])
+            text = "".join(p.get("text", "") for p in parts)
+            if text:
+                yield text
+    finally:
+        response.close()
+
+
+def _error_details(response):
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
@@ -0,0 +1,244 @@
+import base64
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ---------- Gmail Push Notifications ----------
+# Gmail `users.watch` publishes {emailAddress, historyId} to a Pub/Sub topic
+# whose push subscription targets /gmail/push. Each notification is recorded
+# once (Pub/Sub delivers at least once), then `users.history.list` from the
+# last synced historyId yields only the threads that changed. Those are
+# fetched once, stored, and handed to the rule engine. The stored historyId
+# never moves past a thread that failed to fetch or a truncated listing.
+# Polling remains the fallback for anything push misses.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS gmail_push_events (
+    message_id text PRIMARY KEY,
+    email text NOT NULL,
+    history_id bigint NOT NULL,
+    received_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS gmail_sync_state (
+    email text PRIMARY KEY,
+    history_id bigint NOT NULL,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+
+class PushError(Exception):
+    pass
+
+
+def decode_envelope(envelope):
+    """Pub/Sub push body -> (message_id, email, history_id)."""
+    try:
+        message = envelope["message"]
+        data = json.loads(base64.b64decode(message["data"]))
+        return message.get("messageId") or message["message_id"], data["emailAddress"], int(data["historyId"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise PushError(f"Malformed Pub/Sub push envelope: {e}")
+
+
+class GmailPush:
+    def __init__(self, connect, gmail_api_base, token_provider, store_threads, on_threads=None,
+                 fetch_concurrency=8, max_history_pages=20, token_invalidator=None):
+        self.connect = connect
+        self.gmail_api_base = gmail_api_base
+        self.token_provider = token_provider
+        self.token_invalidator = token_invalidator
+        self.store_threads = store_threads
+        self.on_threads = on_threads
+        self.fetch_concurrency = fetch_concurrency
+        self.max_history_pages = max_history_pages
+        self.dbs = {}
+        # One sync at a time per process; concurrent notifications for the same
+        # mailbox would otherwise race on gmail_sync_state. Acks (and watch)
+        # use a connection and lock of their own, so a long sync never delays
+        # the webhook's reply past the Pub/Sub ack deadline.
+        self.lock = threading.Lock()
+        self.ack_lock = threading.Lock()
+        self.stats = {"received": 0, "duplicates": 0, "syncs": 0, "threads_fetched": 0, "last_sync_ms": None}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=fetch_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def ensure_schema(self, cursor):
+        cursor.execute(SCHEMA)
+
+    def connection(self, purpose="sync"):
+        """The connection for `purpose` ("sync" or "ack"); hold its lock."""
+        db = self.dbs.get(purpose)
+        if db is None or db.closed:
+            db = self.dbs[purpose] = self.connect()
+        return db
+
+    def record(self, cursor, message_id, email, history_id):
+        """False if this Pub/Sub message was already seen."""
+        cursor.execute("""
+            INSERT INTO gmail_push_events (message_id, email, history_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (message_id) DO NOTHING
+            RETURNING message_id
+        """, (message_id, email, history_id))
+        return cursor.fetchone() is not None
+
+    def accept(self, envelope):
+        """Validate and dedupe a push. Returns (email, history_id) or None for duplicates."""
+        message_id, email, history_id = decode_envelope(envelope)
+        with self.ack_lock:
+            db = self.connection("ack")
+            try:
+                with db.cursor() as cursor:
+                    fresh = self.record(cursor, message_id, email, history_id)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        self.stats["received"] += 1
+        if not fresh:
+            self.stats["duplicates"] += 1
+            return None
+        return email, history_id
+
+    def _get(self, path, email, params=None):
+        for attempt in range(2):
+            token = self.token_provider(email)
+            response = self.session.get(
+                f"{self.gmail_api_base}/gmail/v1/users/me/{path}",
+                headers={"Authorization": f"Bearer {token}"},
+                params=params,
+                timeout=(3.05, 15),
+            )
+            # Revoked server-side: drop the cached token and retry once with a fresh one.
+            if response.status_code != 401 or self.token_invalidator is None or attempt:
+                break
+            self.token_invalidator(email, token)
+        response.raise_for_status()
+        return response.json()
+
+    def changed_thread_ids(self, email, start_history_id):
+        """(thread_ids, resume_from). `resume_from` is the last history record
+        read when `max_history_pages` cut the listing short, else None."""
+        thread_ids, page_token, last_id = [], None, None
+        for _ in range(self.max_history_pages):
+            params = {"startHistoryId": start_history_id, "historyTypes": "messageAdded"}
+            if page_token:
+                params["pageToken"] = page_token
+            page = self._get("history", email, params)
+            for entry in page.get("history", []):
+                last_id = int(entry["id"]) if entry.get("id") else last_id
+                for added in entry.get("messagesAdded", []):
+                    thread_id = added.get("message", {}).get("threadId")
+                    if thread_id and thread_id not in thread_ids:
+                        thread_ids.append(thread_id)
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return thread_ids, None
+        return thread_ids, last_id or start_history_id
+
+    def fetch_threads(self, email, thread_ids):
+        """(details, failed_thread_ids)."""
+        def fetch(thread_id):
+            try:
+                return self._get(f"threads/{thread_id}", email)
+            except requests.RequestException as e:
+                print(f"❌ Failed to fetch thread {thread_id}: {e}")
+                return None
+
+        if not thread_ids:
+            return [], []
+        with ThreadPoolExecutor(max_workers=min(self.fetch_concurrency, len(thread_ids))) as pool:
+            fetched = list(pool.map(fetch, thread_ids))
+        return [d for d in fetched if d], [t for t, d in zip(thread_ids, fetched) if not d]
+
+    def sync(self, email, history_id):
+        """Fetch and store the threads changed since the last synced historyId."""
+        started = time.perf_counter()
+        with self.lock:
+            db = self.connection()
+            try:
+                with db.cursor() as cursor:
+                    cursor.execute("SELECT history_id FROM gmail_sync_state WHERE email = %s FOR UPDATE", (email,))
+                    row = cursor.fetchone()
+                    if row and row[0] >= history_id:
+                        db.commit()
+                        return []  # already synced past this point
+
+                    details, synced_to = [], history_id
+                    if row:
+                        try:
+                            thread_ids, resume_from = self.changed_thread_ids(email, row[0])
+                        except requests.HTTPError as e:
+                            if e.response is None or e.response.status_code != 404:
+                                raise
+                            # startHistoryId expired; polling/manual ingest covers the gap.
+                            print(f"⚠️ Gmail history for {email} expired, resetting to {history_id}")
+                            thread_ids, resume_from = [], None
+                        details, failed = self.fetch_threads(email, thread_ids)
+                        if details:
+                            self.store_threads(cursor, details)
+                        # Never move past threads we did not get: the next
+                        # notification lists history again from where we stopped.
+                        if failed:
+                            print(f"⚠️ {len(failed)} Gmail threads for {email} failed; keeping historyId {row[0]}")
+                            synced_to = row[0]
+                        elif resume_from is not None:
+                            print(f"⚠️ Gmail history for {email} truncated at {resume_from}")
+                            synced_to = min(resume_from, history_id)
+                    # Without a starting point there is nothing to diff against yet.
+                    cursor.execute("""
+                        INSERT INTO gmail_sync_state (email, history_id) VALUES (%s, %s)
+                        ON CONFLICT (email) DO UPDATE
+                        SET history_id = GREATEST(gmail_sync_state.history_id, EXCLUDED.history_id), updated_at = now()
+                    """, (email, synced_to))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+        self.stats["syncs"] += 1
+        self.stats["threads_fetched"] += len(details)
+        self.stats["last_sync_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        if details and self.on_threads:
+            self.on_threads({d["id"]: d for d in details})
+        return [d["id"] for d in details]
+
+    def handle(self, email, history_id):
+        try:
+            thread_ids = self.sync(email, history_id)
+            if thread_ids:
+                print(f"📬 Push sync for {email}: {len(thread_ids)} changed threads")
+        except Exception as e:
+            print(f"❌ Gmail push sync failed for {email}: {e}")
+
+    def watch(self, email, topic_name, label_ids=None):
+        token = self.token_provider(email)
+        response = self.session.post(
+            f"{self.gmail_api_base}/gmail/v1/users/me/watch",
+            headers={"Authorization": f"Bearer {token}"},
+            json={"topicName": topic_name, "labelIds": label_ids or ["INBOX"]},
+            timeout=(3.05, 15),
+        )
+        response.raise_for_status()
+        result = response.json()
+        with self.ack_lock:
+            db = self.connection("ack")
+            try:
+                with db.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO gmail_sync_state (email, history_id) VALUES (%s, %s)
+                        ON CONFLICT (email) DO NOTHING
+                    """, (email, int(result["historyId"])))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        return result
@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+
+# ---------- Gunicorn ----------
+# gunicorn -c gunicorn.conf.py main:app
+#
+# EMBEDDING_MODE decides where the sentence-transformers weights live:
+#   local    every worker loads its own copy (memory grows with workers)
+#   preload  the master loads them before forking; workers share the pages
+#   sidecar  only `python embed_server.py` holds them; workers call it over
+#            EMBEDDING_SOCKET (start the sidecar first)
+# Only the model is preloaded, not the app: main.py opens database
+# connections and starts threads at import, and neither survives a fork.
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", min(multiprocessing.cpu_count(), 4)))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+
+EMBEDDING_MODE = os.getenv("EMBEDDING_MODE", "local")
+# Intra-op threads per worker; torch defaults to one per core in every process.
+TORCH_THREADS = os.getenv("EMBEDDING_TORCH_THREADS")
+
+
+def on_starting(server):
+    if EMBEDDING_MODE != "preload":
+        return
+    from embeddings import DEFAULT_MODEL, preload
+
+    # Load only: running a forward pass here would start torch's thread pool,
+    # which forked children cannot use.
+    names = [n.strip() for n in os.getenv("EMBEDDING_PRELOAD", os.getenv("EMBEDDING_MODEL", DEFAULT_MODEL)).split(",")]
+    preload([n for n in names if n])
+    server.log.info("Preloaded embedding models %s; heap frozen for copy-on-write", names)
+
+
+def post_fork(server, worker):
+    if TORCH_THREADS and EMBEDDING_MODE != "sidecar":
+        import torch
+
+        torch.set_num_threads(int(TORCH_THREADS))
@@ -0,0 +1,164 @@
+import hashlib
+import html
+import io
+import re
+import struct
+from datetime import date, datetime, timezone
+from email.header import decode_header, make_header
+from email.utils import parsedate_to_datetime
+
+# ---------- Record Normalization ----------
+# One place that turns a source object (Gmail API thread, mbox message,
+# HubSpot contact, Calendar event) into the row we store and the text we
+# embed (`notes`), shared by the API ingests and bulk_import.py so both
+# produce identical rows for the same data.
+
+SNIPPET_CHARS = 200
+
+
+def thread_record(thread_id, subject, snippet, message_at=None):
+    subject = subject or "No Subject"
+    snippet = snippet or ""
+    return {"thread_id": thread_id, "subject": subject, "snippet": snippet, "message_at": message_at,
+            "notes": f"Subject: {subject}\nSnippet: {snippet}"}
+
+
+def from_epoch_ms(value):
+    try:
+        return datetime.fromtimestamp(int(value) / 1000, tz=timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
+def gmail_thread_record(detail):
+    """From a Gmail API threads.get response; `message_at` is the latest message's."""
+    messages = detail.get("messages") or [{}]
+    headers = messages[0].get("payload", {}).get("headers", [])
+    subject = next((h["value"] for h in headers if h["name"].lower() == "subject"), "No Subject")
+    sent = [t for t in (from_epoch_ms(m.get("internalDate")) for m in messages) if t is not None]
+    return thread_record(detail["id"], subject, detail.get("snippet", ""), max(sent, default=None))
+
+
+def mbox_thread_id(message):
+    """The Gmail thread id for a Takeout message (X-GM-THRID is the decimal
+    form of the API's hex id), else a stable id from the thread's root Message-ID."""
+    gm_thread = (message.get("X-GM-THRID") or "").strip()
+    if gm_thread.isdigit():
+        return format(int(gm_thread), "x")
+    references = (message.get("References") or "").split()
+    root = (references[0] if references else None) or message.get("In-Reply-To") or message.get("Message-ID")
+    if not root:
+        return None
+    return "mbox-" + hashlib.sha1(root.strip().encode()).hexdigest()[:16]
+
+
+def decode_subject(value):
+    try:
+        return str(make_header(decode_header(value or "")))
+    except (LookupError, UnicodeError, ValueError):
+        return value or ""
+
+
+def message_snippet(message, limit=SNIPPET_CHARS):
+    """Gmail-style snippet: the start of the plain-text (or de-tagged HTML) body."""
+    parts = [p for p in message.walk() if not p.is_multipart()]
+    for subtype in ("plain", "html"):
+        part = next((p for p in parts if p.get_content_type() == f"text/{subtype}"), None)
+        if part is None:
+            continue
+        payload = part.get_payload(decode=True) or b""
+        try:
+            text = payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+        except LookupError:
+            text = payload.decode("utf-8", errors="replace")
+        if subtype == "html":
+            text = html.unescape(re.sub(r"<[^>]+>", " ", text))
+        return " ".join(text.split())[:limit]
+    return ""
+
+
+def message_date(message):
+    try:
+        sent = parsedate_to_datetime(message.get("Date"))
+    except (TypeError, ValueError, IndexError):
+        return None
+    return sent if sent.tzinfo else sent.replace(tzinfo=timezone.utc)
+
+
+def mbox_thread_record(message):
+    """From an email.message.Message (the default compat32 policy, which is
+    several times faster to parse than policy.default); None without a thread id."""
+    thread_id = mbox_thread_id(message)
+    if not thread_id:
+        return None
+    return thread_record(thread_id, decode_subject(message.get("Subject")), message_snippet(message),
+                         message_date(message))
+
+
+def contact_record(contact):
+    """From a HubSpot contact object ({"id", "properties"}); None without an email."""
+    props = contact.get("properties", {})
+    name = f"{props.get('firstname') or ''} {props.get('lastname') or ''}".strip()
+    email = props.get("email") or ""
+    if not email:
+        return None
+    return {"hubspot_id": contact["id"], "name": name, "email": email,
+            "notes": f"Name: {name}, Email: {email}"}
+
+
+def event_start(event):
+    """Start of a Calendar event: `dateTime`, or midnight UTC of an all-day `date`."""
+    start = event.get("start") or {}
+    try:
+        if start.get("dateTime"):
+            value = datetime.fromisoformat(start["dateTime"].replace("Z", "+00:00"))
+            return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+        if start.get("date"):
+            day = date.fromisoformat(start["date"])
+            return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    except ValueError:
+        pass
+    return None
+
+
+def event_record(event):
+    """From a Google Calendar event resource."""
+    summary = event.get("summary", "No Title")
+    description = event.get("description", "")
+    return {"event_id": event.get("id"), "summary": summary, "description": description,
+            "start_at": event_start(event), "notes": f"Summary: {summary}\nDescription: {description}"}
+
+
+# ---------- Binary COPY ----------
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+COPY_NULL = struct.pack(">i", -1)
+
+
+def encode_vector(vector, dims):
+    # pgvector's binary wire format: int16 dims, int16 unused, float4[dims] (big endian).
+    return struct.pack(">hh", dims, 0) + vector.astype(">f4").tobytes()
+
+
+def copy_buffer(rows, vectors):
+    """A `COPY ... FROM STDIN WITH (FORMAT binary)` payload of text columns
+    followed by one vector column."""
+    out = io.BytesIO()
+    out.write(COPY_HEADER)
+    dims = vectors.shape[1]
+    vector_len = struct.pack(">i", 4 + 4 * dims)
+    for row, vector in zip(rows, vectors):
+        out.write(struct.pack(">h", len(row) + 1))
+        for value in row:
+            if value is None:
+                out.write(COPY_NULL)
+                continue
+            data = str(value).encode()
+            out.write(struct.pack(">i", len(data)))
+            out.write(data)
+        out.write(vector_len)
+        out.write(encode_vector(vector, dims))
+    out.write(COPY_TRAILER)
+    out.seek(0)
+    return out
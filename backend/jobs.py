@@ -0,0 +1,246 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+# ---------- Scheduler Coordination ----------
+# Every uvicorn/gunicorn worker runs its own BackgroundScheduler, each firing
+# at its own offset. A job takes a Postgres advisory lock (keyed by job id) so
+# runs never overlap, and under the lock claims the tick in job_schedule: a
+# scheduled run is skipped if any worker started the job within the last
+# interval (less MIN_GAP_SLACK, for timer jitter), so N workers still run it
+# once per interval. Locks are session-scoped on a dedicated connection per
+# job, so a crashed worker releases its lock with its connection. Every
+# executed run is recorded in job_runs. Unscheduled runs (run_now) that find
+# the job busy are queued and retried rather than dropped.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_runs (
+    id bigserial PRIMARY KEY,
+    job_id text NOT NULL,
+    worker text NOT NULL,
+    scheduled_at timestamptz,
+    started_at timestamptz NOT NULL,
+    finished_at timestamptz,
+    duration_ms double precision,
+    lag_ms double precision,
+    status text NOT NULL,
+    error text
+);
+CREATE INDEX IF NOT EXISTS job_runs_job_started_idx ON job_runs (job_id, started_at DESC);
+CREATE TABLE IF NOT EXISTS job_schedule (
+    job_id text PRIMARY KEY,
+    last_started_at timestamptz NOT NULL
+);
+"""
+
+MIN_GAP_SLACK = 0.1    # fraction of the interval
+RETRY_DELAY = 5.0      # seconds before a queued run_now is retried
+MAX_PENDING = 100      # queued run_now calls kept per job
+
+JOB_DEFAULTS = {
+    "coalesce": True,          # collapse a backlog of missed ticks into one run
+    "max_instances": 1,        # never overlap a job with itself in this process
+    "misfire_grace_time": 60,
+}
+
+
+def advisory_key(job_id):
+    digest = hashlib.sha1(f"job:{job_id}".encode()).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+class JobCoordinator:
+    def __init__(self, connect, worker_id=None, on_run=None):
+        """`on_run(job_id, status, duration_ms, lag_ms)` is called after every run,
+        and with status "skipped" when another worker holds the lock."""
+        self.connect = connect
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.on_run = on_run
+        self.scheduler = BackgroundScheduler(job_defaults=JOB_DEFAULTS)
+        self.connections = {}
+        self.job_locks = {}
+        self.pending = {}  # job_id -> [fn] of run_now calls waiting for the job
+        self.lock = threading.Lock()
+
+    def ensure_schema(self, cursor):
+        cursor.execute(SCHEMA)
+
+    def connection(self, job_id):
+        with self.lock:
+            db = self.connections.get(job_id)
+            if db is None or db.closed:
+                db = self.connect()
+                db.autocommit = True
+                self.connections[job_id] = db
+            return db
+
+    def interval(self, job_id):
+        job = self.scheduler.get_job(job_id)
+        return getattr(job.trigger, "interval", None) if job else None
+
+    def scheduled_time(self, job_id):
+        job = self.scheduler.get_job(job_id)
+        interval = self.interval(job_id)
+        if job is None or job.next_run_time is None or interval is None:
+            return None
+        # next_run_time has already moved on to the following tick.
+        return job.next_run_time - interval
+
+    def add_interval_job(self, job_id, fn, **trigger_args):
+        """Schedule `fn(db)` on an interval; `db` is the job's dedicated connection."""
+        self.scheduler.add_job(
+            self.run_locked, "interval", args=[job_id, fn], id=job_id,
+            replace_existing=True, **trigger_args,
+        )
+
+    def run_now(self, job_id, fn):
+        """Run a job outside its schedule (e.g. on a push event), under the same
+        locks. Returns the run's status; "queued" if the job was busy here or in
+        another worker, in which case it is retried every RETRY_DELAY seconds."""
+        status = self.run_locked(job_id, fn, scheduled=False)
+        if status != "skipped":
+            return status
+        with self.lock:
+            queue = self.pending.setdefault(job_id, [])
+            first = not queue
+            queue.append(fn)
+            if len(queue) > MAX_PENDING:
+                print(f"⚠️ Job {job_id}: {len(queue) - MAX_PENDING} queued run(s) dropped")
+                del queue[:-MAX_PENDING]
+        if first:
+            self._retry_later(job_id)
+        return "queued"
+
+    def _retry_later(self, job_id):
+        timer = threading.Timer(RETRY_DELAY, self._run_pending, args=[job_id])
+        timer.daemon = True
+        timer.start()
+
+    def _run_pending(self, job_id):
+        with self.lock:
+            fns = self.pending.pop(job_id, [])
+        if not fns:
+            return
+
+        def run_all(db):
+            for fn in fns:
+                fn(db)
+
+        if self.run_locked(job_id, run_all, scheduled=False) == "skipped":
+            with self.lock:
+                self.pending[job_id] = fns + self.pending.get(job_id, [])
+            self._retry_later(job_id)
+
+    def run_locked(self, job_id, fn, scheduled=True):
+        """Returns "ok", "error" or "skipped" (busy, or already run this interval)."""
+        # The advisory lock is re-entrant within a session, so runs sharing this
+        # process's job connection are serialized with a thread lock first.
+        with self.lock:
+            job_lock = self.job_locks.setdefault(job_id, threading.Lock())
+        if not job_lock.acquire(blocking=False):
+            return "skipped"
+        try:
+            interval = self.interval(job_id) if scheduled else None
+            min_gap = interval.total_seconds() * (1 - MIN_GAP_SLACK) if interval else 0.0
+            return self._run_locked(job_id, fn, self.scheduled_time(job_id) if scheduled else None, min_gap)
+        finally:
+            job_lock.release()
+
+    def _run_locked(self, job_id, fn, scheduled_at, min_gap=0.0):
+        try:
+            db = self.connection(job_id)
+            with db.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (advisory_key(job_id),))
+                acquired = cur.fetchone()[0]
+                claimed = False
+                if acquired:
+                    cur.execute("""
+                        INSERT INTO job_schedule (job_id, last_started_at) VALUES (%s, now())
+                        ON CONFLICT (job_id) DO UPDATE SET last_started_at = now()
+                        WHERE job_schedule.last_started_at <= now() - %s * interval '1 second'
+                        RETURNING 1
+                    """, (job_id, min_gap))
+                    claimed = cur.fetchone() is not None
+                    if not claimed:
+                        cur.execute("SELECT pg_advisory_unlock(%s)", (advisory_key(job_id),))
+        except Exception as e:
+            print(f"❌ Job {job_id}: could not acquire lock: {e}")
+            stale = self.connections.pop(job_id, None)
+            if stale is not None:
+                stale.close()
+            return "error"
+        if not claimed:
+            self._report(job_id, "skipped", None, None)
+            return "skipped"  # another worker is running it or already ran this interval
+
+        started_at = datetime.now(timezone.utc)
+        started = time.perf_counter()
+        status, error = "ok", None
+        try:
+            db.autocommit = False
+            fn(db)
+        except Exception as e:
+            status, error = "error", str(e)
+            print(f"❌ Job {job_id} failed: {e}")
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            lag_ms = (started_at - scheduled_at).total_seconds() * 1000 if scheduled_at else None
+            try:
+                db.rollback()  # drop anything the job left open
+                db.autocommit = True
+                with db.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO job_runs
+                            (job_id, worker, scheduled_at, started_at, finished_at, duration_ms, lag_ms, status, error)
+                        VALUES (%s, %s, %s, %s, now(), %s, %s, %s, %s)
+                    """, (job_id, self.worker_id, scheduled_at, started_at, duration_ms, lag_ms, status, error))
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (advisory_key(job_id),))
+            except Exception as e:
+                print(f"❌ Job {job_id}: failed to record run: {e}")
+                # Closing the session is the surest way to release the lock.
+                db.close()
+            self._report(job_id, status, duration_ms, lag_ms)
+        return status
+
+    def _report(self, job_id, status, duration_ms, lag_ms):
+        if self.on_run is None:
+            return
+        try:
+            self.on_run(job_id, status, duration_ms, lag_ms)
+        except Exception as e:
+            print(f"⚠️ Job {job_id}: on_run hook failed: {e}")
+
+    def start(self):
+        self.scheduler.start()
+
+    def shutdown(self):
+        self.scheduler.shutdown(wait=True)  # let an in-flight run finish and unlock
+        with self.lock:
+            for db in self.connections.values():
+                db.close()
+            self.connections.clear()
+
+
+def recent_runs(cursor, job_id=None, limit=50):
+    cursor.execute("""
+        SELECT job_id, worker, scheduled_at, started_at, finished_at, duration_ms, lag_ms, status, error
+        FROM job_runs
+        WHERE %s::text IS NULL OR job_id = %s
+        ORDER BY started_at DESC
+        LIMIT %s
+    """, (job_id, job_id, limit))
+    columns = ["job_id", "worker", "scheduled_at", "started_at", "finished_at",
+               "duration_ms", "lag_ms", "status", "error"]
+    runs = []
+    for row in cursor.fetchall():
+        run = dict(zip(columns, row))
+        for key in ("scheduled_at", "started_at", "finished_at"):
+            if run[key] is not None:
+                run[key] = run[key].isoformat()
+        runs.append(run)
+    return runs
@@ -1,22 +1,126 @@
-from fastapi import FastAPI, HTTPException, Query, Request, Body
-from fastapi.responses import RedirectResponse
-from typing import Optional
+from fastapi import FastAPI, HTTPException, Query, Request, Body, BackgroundTasks
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
+from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import psycopg2
-from sentence_transformers import SentenceTransformer
+from psycopg2.extras import execute_values
 import numpy as np
 import json
+import base64
 import uuid
 import os
-from apscheduler.schedulers.background import BackgroundScheduler
+import time
+import hmac
+import threading
 from supabase import create_client, Client
-from pydantic import BaseModel
-from datetime import datetime
+from pydantic import BaseModel, Field
+from datetime import datetime, timezone
+from gemini_client import GeminiClient, GeminiError
+from agent import ToolRunner, run_agent
+from rules import RuleEngine
+from contact_index import ContactIndex, SCOPE as CONTACTS_SCOPE
+from dedup import NearDuplicates, distinct_matches, DEFAULT_OVERFETCH
+from conditional import DataVersions, GMAIL_SCOPE, CALENDAR_SCOPE, tasks_scope, not_modified
+from embeddings import Embedder, DEFAULT_MODEL, make_loader
+from jobs import JobCoordinator, recent_runs
+from recency import Recency, GMAIL_TIMESTAMP, CALENDAR_TIMESTAMP
+from gmail_push import GmailPush, PushError
+from ingest import gmail_thread_record, contact_record, event_record
+from reindex import Reindexer, ReindexError, JOB_ID as REINDEX_JOB
+from token_store import TokenStore, TokenError
+from write_behind import WriteBehind
+import db
+import export
+import metrics
+import profiling
+import recency
 
 from dotenv import load_dotenv
 load_dotenv()
 
 app = FastAPI()
+# Lets a profiled request find the worker thread its endpoint runs on.
+app.router.route_class = profiling.ProfiledRoute
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    in_progress = metrics.REQUESTS_IN_PROGRESS.labels(request.method)
+    in_progress.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        in_progress.dec()
+        metrics.REQUEST_LATENCY.labels(request.method, metrics.route_label(request), status).observe(
+            time.perf_counter() - started
+        )
+
+
+# ---------- PROFILING ----------
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+profile_store = profiling.ProfileStore(os.getenv("PROFILE_DIR", "profiles"), keep=int(os.getenv("PROFILE_KEEP", "50")))
+
+def is_admin(request: Request):
+    token = request.headers.get("X-Admin-Token") or request.query_params.get("admin_token") or ""
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin routes are disabled (set ADMIN_TOKEN)")
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    """`X-Profile: speedscope|collapsed` (or `?profile=`) plus the admin token
+    samples this one request; the response names the stored profile."""
+    fmt = request.headers.get("X-Profile") or request.query_params.get("profile")
+    if not fmt or not is_admin(request):
+        return await call_next(request)
+    fmt = fmt if fmt in profiling.FORMATS else "speedscope"
+    with profiling.RequestProfile(PROFILE_INTERVAL) as profile:
+        response = await call_next(request)
+    name = profile_store.save(profile.sampler, f"{request.method} {request.url.path}", fmt)
+    response.headers["X-Profile-Name"] = name
+    response.headers["X-Profile-Url"] = f"/admin/profiles/{name}"
+    response.headers["X-Profile-Samples"] = str(profile.sampler.samples)
+    return response
+
+@app.post("/admin/profile")
+def profile_process(request: Request, seconds: float = Query(10.0, gt=0),
+                    format: str = Query("speedscope"), interval_ms: Optional[float] = Query(None, gt=0)):
+    """Sample every thread in this worker for `seconds` (capped by PROFILE_MAX_SECONDS)."""
+    require_admin(request)
+    if format not in profiling.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(profiling.FORMATS)}")
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+    interval = interval_ms / 1000 if interval_ms else PROFILE_INTERVAL
+    sampler = profiling.Sampler(interval, exclude={threading.get_ident()}).start()
+    time.sleep(seconds)
+    sampler.stop()
+    name = profile_store.save(sampler, f"process-{os.getpid()}", format, by_thread=True)
+    return {"name": name, "url": f"/admin/profiles/{name}", "samples": sampler.samples,
+            "seconds": round(sampler.duration, 2), "pid": os.getpid()}
+
+@app.get("/admin/profiles")
+def list_profiles(request: Request):
+    require_admin(request)
+    return {"profiles": profile_store.list()}
+
+@app.get("/admin/profiles/{name}")
+def get_profile(name: str, request: Request):
+    require_admin(request)
+    path = profile_store.path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    media_type = "application/json" if name.endswith(".json") else "text/plain"
+    return FileResponse(path, media_type=media_type, filename=name)
 
 # Supabase
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
@@ -31,34 +135,231 @@ HUBSPOT_CLIENT_ID = os.environ.get("HUBSPOT_CLIENT_ID")
 HUBSPOT_CLIENT_SECRET = os.environ.get("HUBSPOT_CLIENT_SECRET")
 HUBSPOT_REDIRECT_URI = os.environ.get("HUBSPOT_REDIRECT_URI")
 # ---------- Gemini ----------
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_EMBED_URL = "https://generativelanguage.googleapis.com/v1beta/models/embedding-001:embedContent"
-GEMINI_CHAT_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-pro:generateContent"
+gemini = GeminiClient.from_env()
+metrics.instrument_session(gemini.session, "gemini")
+
+# ---------- Upstream API bases (overridable for local fakes) ----------
+GMAIL_API_BASE = os.getenv("GMAIL_API_BASE", "https://gmail.googleapis.com")
+CALENDAR_API_BASE = os.getenv("CALENDAR_API_BASE", "https://www.googleapis.com")
+HUBSPOT_API_BASE = os.getenv("HUBSPOT_API_BASE", "https://api.hubapi.com")
+
+# Shared session for direct upstream calls; latency is recorded per host.
+http = metrics.instrument_session(requests.Session())
 
 
 # ---------- PostgreSQL Connection (Vector DB) ----------
 
 
-conn = psycopg2.connect(
-    host=os.getenv("PG_HOST"),
-    database=os.getenv("PG_NAME"),
-    user=os.getenv("PG_USER"),
-    password=os.getenv("PG_PASSWORD"),
-    port=os.getenv("PG_PORT", "5432")
-)
+conn = db.connect()
 cursor = conn.cursor()
 
 
-# ---------- Embedding Model ----------
-model = SentenceTransformer("all-MiniLM-L6-v2")
+# ---------- OAuth Token Store ----------
+GOOGLE_TOKEN_URL = os.getenv("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")
+HUBSPOT_TOKEN_URL = os.getenv("HUBSPOT_TOKEN_URL", "https://api.hubapi.com/oauth/v1/token")
+
+token_store = TokenStore(
+    db.connect,
+    providers={
+        "google": {"token_url": GOOGLE_TOKEN_URL, "client_id": GOOGLE_CLIENT_ID,
+                   "client_secret": GOOGLE_CLIENT_SECRET},
+        "hubspot": {"token_url": HUBSPOT_TOKEN_URL, "client_id": HUBSPOT_CLIENT_ID,
+                    "client_secret": HUBSPOT_CLIENT_SECRET, "redirect_uri": HUBSPOT_REDIRECT_URI},
+    },
+    refresh_ahead=float(os.getenv("TOKEN_REFRESH_AHEAD", "300")),
+)
+metrics.instrument_session(token_store.session, "oauth")
+token_store.ensure_schema(cursor)
+conn.commit()
+token_store.start()
 
 
-scheduler = BackgroundScheduler()
+# ---------- Data Versions (conditional GET) ----------
+data_versions = DataVersions(max_staleness=float(os.getenv("DATA_VERSION_MAX_STALENESS", "2")))
+data_versions.ensure_schema(cursor)
+conn.commit()
+
+def bump_task_versions(cur, rows):
+    for email in {row[1] for row in rows}:
+        data_versions.bump(cur, tasks_scope(email))
+
+def conditional_headers(request, scopes, as_of=None):
+    """(headers, not_modified) for a read endpoint; no headers if versions can't be read."""
+    try:
+        headers = data_versions.validators(cursor, scopes, request, as_of)
+    except Exception as e:
+        conn.rollback()
+        print(f"⚠️ Data version lookup failed: {e}")
+        return {}, False
+    return headers, not_modified(request, headers)
+
+
+# ---------- Write-Behind Buffer ----------
+write_behind = WriteBehind(
+    db.connect,
+    max_batch=int(os.getenv("WRITE_BEHIND_MAX_BATCH", "500")),
+    flush_interval=float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.5")),
+    spill_path=os.getenv("WRITE_BEHIND_SPILL_PATH", "write_behind_spill.jsonl"),
+    enabled=os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true",
+)
+write_behind.register("chat_history", ("user_email", "message", "reply"))
+write_behind.register("user_tasks", ("id", "user_email", "instruction", "created_at"),
+                      on_write=bump_task_versions)
+write_behind.register("user_instructions", ("id", "user_email", "instruction"),
+                      on_flush=lambda: rule_engine.invalidate())
+write_behind.start()
+
+
+# ---------- HubSpot Contact Index ----------
+contact_index = ContactIndex(max_staleness=float(os.getenv("CONTACT_INDEX_MAX_STALENESS", "30")))
+contact_index.ensure_schema(cursor)
+conn.commit()
+try:
+    print(f"👥 Contact index loaded with {contact_index.load(cursor)} emails")
+except Exception as e:
+    conn.rollback()
+    print(f"⚠️ Contact index load failed, falling back to DB lookups: {e}")
+
+
+# ---------- Embedding Model ----------
+# EMBEDDING_MODEL only seeds a fresh database; after that the active model is
+# embedding_state's, changed with POST /embeddings/reindex. EMBEDDING_MODE
+# decides where the weights live (see gunicorn.conf.py and embed_server.py).
+embedder = Embedder(db.connect, os.getenv("EMBEDDING_MODEL", DEFAULT_MODEL),
+                    loader=make_loader(os.getenv("EMBEDDING_MODE", "local"), os.getenv("EMBEDDING_SOCKET")),
+                    max_staleness=float(os.getenv("EMBEDDING_MODEL_MAX_STALENESS", "2")))
+embedder.ensure_schema(cursor)
+conn.commit()
+embedder.model()  # load before the first request
+
+# Near-duplicate Gmail threads reuse one vector and are collapsed in results.
+dedup = NearDuplicates(max_distance=int(os.getenv("GMAIL_DEDUP_MAX_DISTANCE", "3")))
+dedup.ensure_schema(cursor)
+conn.commit()
+# ANN candidates fetched per Gmail result, so collapsing groups still leaves k.
+GMAIL_DEDUP_OVERFETCH = int(os.getenv("GMAIL_DEDUP_OVERFETCH", str(DEFAULT_OVERFETCH)))
+
+# Recency-aware ranking (recency.py): on for requests with ?recency=true, or
+# for all of them with RETRIEVAL_RECENCY=true; RECENCY_* set the defaults.
+recency.ensure_schema(cursor)
+conn.commit()
+RECENCY = Recency.from_env()
+RETRIEVAL_RECENCY = os.getenv("RETRIEVAL_RECENCY", "false").lower() == "true"
+
+def recency_policy(enabled=None, window_days=None, half_life_days=None):
+    """The Recency settings for a request, or None to rank by similarity alone."""
+    if not (RETRIEVAL_RECENCY if enabled is None else enabled):
+        return None
+    return RECENCY.with_overrides(half_life_days=half_life_days, window_days=window_days)
+
+def recency_now():
+    """The clock recency scores are computed against: the current hour, so
+    results (and their ETags) only change hourly unless the data does."""
+    return datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+def gmail_matches_sql(select, k, policy=None, now=None, vector="q.vec"):
+    """(SQL, params) for the k best Gmail threads near `vector`, one per
+    near-duplicate group: `select` over thread_id, subject, snippet,
+    message_at, distance, score and duplicates, best first. A recency policy
+    limits the candidates to its window and ranks them by decayed distance."""
+    if policy is None:
+        where, params, score, candidates = "TRUE", (), "distance", k * GMAIL_DEDUP_OVERFETCH
+    else:
+        where, params = policy.window(GMAIL_TIMESTAMP, now)
+        score = policy.score(GMAIL_TIMESTAMP, now)
+        candidates = policy.candidate_count(k, k * GMAIL_DEDUP_OVERFETCH)
+    matches = distinct_matches(("thread_id", "subject", "snippet", GMAIL_TIMESTAMP), vector, where, score)
+    return f"SELECT {select} FROM {matches} g ORDER BY score LIMIT %s", (*params, candidates, k)
+
+def calendar_matches_sql(select, k, policy=None, now=None, vector="q.vec"):
+    """Like gmail_matches_sql for calendar_events (event_id, summary,
+    description, start_at, distance, score)."""
+    if policy is None:
+        where, params, score, candidates = "TRUE", (), "distance", k
+    else:
+        where, params = policy.window(CALENDAR_TIMESTAMP, now)
+        score = policy.score(CALENDAR_TIMESTAMP, now)
+        candidates = policy.candidate_count(k)
+    return f"""
+        SELECT {select} FROM (
+            SELECT *, {score} AS score FROM (
+                SELECT event_id, summary, description, {CALENDAR_TIMESTAMP}, embedding <=> {vector} AS distance
+                FROM calendar_events
+                WHERE {where}
+                ORDER BY embedding <=> {vector}
+                LIMIT %s
+            ) candidates
+        ) c
+        ORDER BY score LIMIT %s""", (*params, candidates, k)
+
 
 # ---------- Helper Functions ----------
 def serialize_embedding(embedding):
     return embedding.tolist() if isinstance(embedding, np.ndarray) else embedding
 
+def store_gmail_threads(cur, details, operation="gmail_store"):
+    """Embed and store Gmail API thread details; near-duplicates of a stored
+    (or earlier) thread reuse its vector. Returns (threads, vectors reused)."""
+    with metrics.stage(operation, "dedup"):
+        records = dedup.assign(cur, [gmail_thread_record(d) for d in details])
+    fresh = [r for r in records if r["canonical"] is None]
+    if fresh:
+        with metrics.stage(operation, "embed"):
+            embeddings, model_name = embedder.embed([r["notes"] for r in fresh])
+        metrics.ROWS_EMBEDDED.labels("gmail").inc(len(fresh))
+    with metrics.stage(operation, "insert"):
+        if fresh:
+            execute_values(cur, """
+                INSERT INTO gmail_threads (thread_id, subject, snippet, message_at, embedding, embedding_model,
+                                           simhash, canonical_thread_id)
+                VALUES %s
+                ON CONFLICT (thread_id) DO NOTHING
+            """, [(r["thread_id"], r["subject"], r["snippet"], r["message_at"], serialize_embedding(e), model_name,
+                   r["simhash"], r["thread_id"]) for r, e in zip(fresh, embeddings)])
+            dedup.index(cur, fresh)
+        reused = dedup.insert_duplicates(cur, records)
+        data_versions.bump(cur, GMAIL_SCOPE)
+    metrics.EMBEDDINGS_REUSED.labels("gmail").inc(reused)
+    metrics.ROWS_INGESTED.labels("gmail").inc(len(records))
+    return len(records), reused
+
+def google_access_token(email=None):
+    email = email or token_store.default_email("google")
+    if email:
+        return token_store.get(email, "google")
+    token = os.getenv("GMAIL_ACCESS_TOKEN")
+    if not token:
+        raise TokenError("No Google account connected (complete /auth/url first)")
+    return token
+
+def require_email_access(request, email, provider):
+    """Only admins may name an arbitrary stored account; anyone else is limited
+    to the default account the background jobs already sync."""
+    if not is_admin(request) and email != token_store.default_email(provider):
+        raise HTTPException(status_code=403, detail="?email= requires the admin token for this account")
+
+def invalidate_google_token(email=None, token=None):
+    """Drop an access token Google answered 401 for; the next lookup refreshes it."""
+    email = email or token_store.default_email("google")
+    if email:
+        token_store.invalidate(email, "google", token)
+
+def resolve_token(request, token, email, provider):
+    """An explicit ?token= wins; otherwise use the stored authorization for ?email=."""
+    if token:
+        return token
+    if email:
+        require_email_access(request, email, provider)
+        return token_store.get(email, provider)
+    return None
+
+def build_chat_prompt(prompt, gmail_matches, hubspot_matches):
+    gmail_context = [f"Subject: {g[0]}\nSnippet: {g[1]}" + (f"\nDate: {str(g[2])[:10]}" if g[2] else "")
+                     for g in gmail_matches]
+    hubspot_context = [f"Name: {c[0]} ({c[1]})\nNotes: {c[2]}" for c in hubspot_matches]
+    full_context = "\n\n".join(gmail_context + hubspot_context)
+    return f"""You are a helpful financial AI assistant. Use the context below to answer the user query.\n\nContext:\n{full_context}\n\nUser Query: {prompt}"""
+
 
 # ---------- Routes ----------
 @app.get("/")
@@ -74,122 +375,306 @@ def get_gmail_thread(thread_id: str, token: str = Query(...)):
     return data[0]
 
 @app.get("/gmail/ingest")
-def ingest_gmail(token: Optional[str] = Query(None)):
+def ingest_gmail(request: Request, token: Optional[str] = Query(None), email: Optional[str] = Query(None)):
+    try:
+        token = resolve_token(request, token, email, "google")
+    except TokenError as e:
+        return {"error": str(e)}
     if not token:
-        return {"error": "Missing access_token (provide via ?token=ACCESS_TOKEN)"}
+        return {"error": "Missing access_token (provide via ?token=ACCESS_TOKEN or ?email=)"}
 
-    threads = requests.get(
-        "https://gmail.googleapis.com/gmail/v1/users/me/threads",
-        headers={"Authorization": f"Bearer {token}"},
-        params={"maxResults": 10}
-    ).json().get("threads", [])
+    with metrics.stage("gmail_ingest", "list"):
+        threads = http.get(
+            f"{GMAIL_API_BASE}/gmail/v1/users/me/threads",
+            headers={"Authorization": f"Bearer {token}"},
+            params={"maxResults": 10}
+        ).json().get("threads", [])
 
-    inserted = 0
+    details = []
     for t in threads:
-        thread_id = t["id"]
-        detail = requests.get(
-            f"https://gmail.googleapis.com/gmail/v1/users/me/threads/{thread_id}",
-            headers={"Authorization": f"Bearer {token}"}
-        ).json()
-
-        headers = detail.get("messages", [])[0].get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"].lower() == "subject"), "No Subject")
-        snippet = detail.get("snippet", "")
-        notes = f"Subject: {subject}\nSnippet: {snippet}"
-        embedding = serialize_embedding(model.encode(notes))
-
-        try:
-            cursor.execute("""
-                INSERT INTO gmail_threads (thread_id, subject, snippet, embedding)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (thread_id) DO NOTHING
-            """, (thread_id, subject, snippet, embedding))
-            inserted += 1
-        except Exception as e:
-            print(f"❌ Gmail insert failed: {e}")
-            conn.rollback()
+        with metrics.stage("gmail_ingest", "fetch"):
+            details.append(http.get(
+                f"{GMAIL_API_BASE}/gmail/v1/users/me/threads/{t['id']}",
+                headers={"Authorization": f"Bearer {token}"}
+            ).json())
 
-    conn.commit()
-    return {"message": f"✅ Ingested {inserted} Gmail threads into Supabase."}
+    # One dedup lookup and one encode call for the whole page.
+    try:
+        inserted, reused = store_gmail_threads(cursor, details, operation="gmail_ingest") if details else (0, 0)
+        with metrics.stage("gmail_ingest", "commit"):
+            conn.commit()
+    except Exception as e:
+        print(f"❌ Gmail insert failed: {e}")
+        conn.rollback()
+        return {"error": f"Gmail insert failed: {e}"}
+    return {"message": f"✅ Ingested {inserted} Gmail threads into Supabase.", "embeddings_reused": reused}
 
 @app.get("/gmail/search")
-def search_gmail(query: str = Query(...)):
-    q_embedding = model.encode(query).tolist()
-    cursor.execute("""
-        SELECT thread_id, subject, snippet
-        FROM gmail_threads
-        ORDER BY embedding <=> %s::vector
-        LIMIT 5
-    """, (q_embedding,))
+def search_gmail(request: Request, response: Response, query: str = Query(...),
+                 recency: Optional[bool] = Query(None), window_days: Optional[float] = Query(None, ge=0),
+                 half_life_days: Optional[float] = Query(None, gt=0)):
+    policy = recency_policy(recency, window_days, half_life_days)
+    now = recency_now() if policy else None
+    headers, unchanged = conditional_headers(request, [GMAIL_SCOPE], as_of=now)
+    if unchanged:
+        conn.commit()
+        return Response(status_code=304, headers=headers)
+    q_embedding = embedder.encode_query(cursor, query).tolist()
+    sql, params = gmail_matches_sql("thread_id, subject, snippet, message_at, duplicates, score", 5, policy, now)
+    cursor.execute(f"""
+        SELECT m.thread_id, m.subject, m.snippet, m.message_at, m.duplicates, m.score
+        FROM (SELECT %s::vector AS vec) q
+        CROSS JOIN LATERAL ({sql}) m
+        ORDER BY m.score
+    """, (q_embedding, *params))
     results = cursor.fetchall()
-    return {"results": [
-        {"thread_id": r[0], "subject": r[1], "snippet": r[2]} for r in results
-    ]}
-
-@app.post("/chat")
-def chat_with_gemini(prompt: str = Query(..., min_length=1), email: str = Query("test@example.com")):
+    response.headers.update(headers)
+    body = {"results": [
+        {"thread_id": r[0], "subject": r[1], "snippet": r[2],
+         "message_at": r[3].isoformat() if r[3] else None, "duplicates": r[4],
+         **({"score": round(float(r[5]), 4)} if policy else {})} for r in results
+    ], "duplicates_collapsed": sum(r[4] for r in results)}
+    if policy:
+        body["recency"] = policy.describe()
+    return body
+
+def retrieve_chat_context(prompt, operation="chat", policy=None):
     # --- Embed query ---
-    q_embedding = model.encode(prompt).tolist()
+    with metrics.stage(operation, "embed"):
+        q_embedding = embedder.encode_query(cursor, prompt).tolist()
 
     # --- Gmail context ---
-    cursor.execute("""
-        SELECT subject, snippet
-        FROM gmail_threads
-        ORDER BY embedding <=> %s::vector
-        LIMIT 5
-    """, (q_embedding,))
-    gmail_matches = cursor.fetchall()
-    gmail_context = [f"Subject: {g[0]}\nSnippet: {g[1]}" for g in gmail_matches]
+    with metrics.stage(operation, "gmail_query"):
+        sql, params = gmail_matches_sql("subject, snippet, message_at, score", 5, policy)
+        cursor.execute(f"""
+            SELECT m.subject, m.snippet, m.message_at
+            FROM (SELECT %s::vector AS vec) q
+            CROSS JOIN LATERAL ({sql}) m
+            ORDER BY m.score
+        """, (q_embedding, *params))
+        gmail_matches = cursor.fetchall()
 
     # --- HubSpot context ---
-    cursor.execute("""
-        SELECT name, email, notes
-        FROM hubspot_contacts
-        ORDER BY embedding <=> %s::vector
-        LIMIT 5
-    """, (q_embedding,))
-    hubspot_matches = cursor.fetchall()
-    hubspot_context = [f"Name: {c[0]} ({c[1]})\nNotes: {c[2]}" for c in hubspot_matches]
+    with metrics.stage(operation, "hubspot_query"):
+        cursor.execute("""
+            SELECT name, email, notes
+            FROM hubspot_contacts
+            ORDER BY embedding <=> %s::vector
+            LIMIT 5
+        """, (q_embedding,))
+        hubspot_matches = cursor.fetchall()
+    return gmail_matches, hubspot_matches
 
-    # --- Combine all context ---
-    full_context = "\n\n".join(gmail_context + hubspot_context)
-    full_prompt = f"""You are a helpful financial AI assistant. Use the context below to answer the user query.\n\nContext:\n{full_context}\n\nUser Query: {prompt}"""
+@app.post("/chat")
+def chat_with_gemini(
+    prompt: str = Query(..., min_length=1),
+    email: str = Query("test@example.com"),
+    agent: bool = Query(False),
+    idempotency_key: Optional[str] = Query(None),
+    recency: Optional[bool] = Query(None),
+    window_days: Optional[float] = Query(None, ge=0),
+    half_life_days: Optional[float] = Query(None, gt=0),
+):
+    # --- Retrieve context and combine ---
+    gmail_matches, hubspot_matches = retrieve_chat_context(
+        prompt, policy=recency_policy(recency, window_days, half_life_days))
+    full_prompt = build_chat_prompt(prompt, gmail_matches, hubspot_matches)
 
     # --- Call Gemini ---
-    headers = {
-        "Content-Type": "application/json",
-        "X-goog-api-key": GEMINI_API_KEY
-    }
-    payload = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": full_prompt}
-                ]
-            }
-        ]
-    }
-    response = requests.post(GEMINI_API_URL, headers=headers, data=json.dumps(payload))
-
-    if response.status_code != 200:
-        return {"error": "Gemini API failed", "details": response.json()}
+    tool_calls = None
+    if agent:
+        # Without a client-supplied key, idempotency only spans this request's loop.
+        scope = f"{email}:{idempotency_key or uuid.uuid4()}"
+        try:
+            with metrics.stage("chat", "agent"):
+                message, tool_calls = run_agent(
+                    gemini, full_prompt, tool_runner, TOOL_SCHEMAS, scope, max_steps=AGENT_MAX_STEPS
+                )
+        except GeminiError as e:
+            return {"error": "Gemini API failed", "details": e.details or str(e)}
+    else:
+        try:
+            with metrics.stage("chat", "gemini"):
+                response = gemini.generate(full_prompt)
+        except GeminiError as e:
+            return {"error": "Gemini API failed", "details": e.details or str(e)}
 
-    try:
-        message = response.json()["candidates"][0]["content"]["parts"][0]["text"]
-    except:
-        message = "[⚠️ Gemini response parse error]"
+        try:
+            message = response["candidates"][0]["content"]["parts"][0]["text"]
+        except:
+            message = "[⚠️ Gemini response parse error]"
 
     # --- Save chat history ---
+    with metrics.stage("chat", "history"):
+        write_behind.enqueue("chat_history", (email, prompt, message))
+
+    if tool_calls is not None:
+        return {"response": message, "tool_calls": tool_calls}
+    return {"response": message}
+
+
+@app.post("/chat/stream")
+def chat_stream(prompt: str = Query(..., min_length=1), email: str = Query("test@example.com"),
+                recency: Optional[bool] = Query(None), window_days: Optional[float] = Query(None, ge=0),
+                half_life_days: Optional[float] = Query(None, gt=0)):
+    """Like /chat, but the reply is streamed as plain text chunks as Gemini produces them."""
+    gmail_matches, hubspot_matches = retrieve_chat_context(
+        prompt, operation="chat_stream", policy=recency_policy(recency, window_days, half_life_days))
+    full_prompt = build_chat_prompt(prompt, gmail_matches, hubspot_matches)
     try:
-        cursor.execute("""
-            INSERT INTO chat_history (user_email, message, reply)
-            VALUES (%s, %s, %s)
-        """, (email, prompt, message))
+        with metrics.stage("chat_stream", "gemini_first_byte"):
+            chunks = gemini.stream(full_prompt)
+    except GeminiError as e:
+        return {"error": "Gemini API failed", "details": e.details or str(e)}
+
+    def relay():
+        parts = []
+        started = time.perf_counter()
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+        except Exception as e:
+            print(f"❌ Gemini stream interrupted: {e}")
+            yield "\n[⚠️ Response interrupted]"
+        finally:
+            metrics.STAGE_LATENCY.labels("chat_stream", "gemini_stream").observe(time.perf_counter() - started)
+            if parts:
+                write_behind.enqueue("chat_history", (email, prompt, "".join(parts)))
+
+    return StreamingResponse(relay(), media_type="text/plain; charset=utf-8",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ---------- CHAT HISTORY ----------
+# Older messages are paged newest-first by (created_at, id), like /tasks/list.
+cursor.execute("""
+    ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now();
+    ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS id bigserial;
+    CREATE INDEX IF NOT EXISTS chat_history_user_created_idx ON chat_history (user_email, created_at DESC, id DESC);
+""")
+conn.commit()
+
+@app.get("/chat/history")
+def chat_history(email: str = Query(...), limit: int = Query(20, ge=1, le=200),
+                 cursor_token: Optional[str] = Query(None, alias="cursor"),
+                 before: Optional[datetime] = Query(None)):
+    """One page of past exchanges, newest first. `before` bounds the first page
+    (e.g. to the start of the current session); `cursor` continues from a page."""
+    conditions, params = ["user_email = %s"], [email]
+    if cursor_token:
+        conditions.append("(created_at, id) < (%s, %s)")
+        params.extend(decode_task_cursor(cursor_token))
+    elif before:
+        conditions.append("created_at < %s")
+        params.append(before)
+    try:
+        cursor.execute(f"""
+            SELECT id, message, reply, created_at
+            FROM chat_history
+            WHERE {' AND '.join(conditions)}
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s
+        """, (*params, limit + 1))
+        rows = cursor.fetchall()
         conn.commit()
-    except:
+    except Exception as e:
         conn.rollback()
+        return {"error": str(e)}
+    page, more = rows[:limit], len(rows) > limit
+    return {
+        "history": [
+            {"message": r[1], "reply": r[2], "created_at": r[3].isoformat()} for r in page
+        ],
+        "next_cursor": encode_task_cursor(page[-1][3], page[-1][0]) if more else None,
+    }
 
-    return {"response": message}
+
+# ---------- BATCH CHAT ----------
+CHAT_BATCH_MAX_PROMPTS = int(os.getenv("CHAT_BATCH_MAX_PROMPTS", "100"))
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+
+class ChatBatchInput(BaseModel):
+    prompts: List[str]
+    email: str = "test@example.com"
+    concurrency: Optional[int] = None
+    recency: Optional[bool] = None
+    window_days: Optional[float] = Field(None, ge=0)
+    half_life_days: Optional[float] = Field(None, gt=0)
+
+def retrieve_context_batch(embeddings, k=5, policy=None):
+    """Top-k Gmail and HubSpot matches for every query vector in one round trip."""
+    vectors = [str(serialize_embedding(e)) for e in embeddings]
+    gmail_sql, gmail_params = gmail_matches_sql(
+        "'gmail' AS source, subject AS a, snippet AS b, message_at::text AS c, score", k, policy)
+    cursor.execute(f"""
+        SELECT q.idx, m.source, m.a, m.b, m.c
+        FROM unnest(%s::vector[]) WITH ORDINALITY AS q(vec, idx)
+        CROSS JOIN LATERAL (
+            ({gmail_sql})
+            UNION ALL
+            (SELECT 'hubspot', name, email, notes,
+                    embedding <=> q.vec
+             FROM hubspot_contacts
+             ORDER BY embedding <=> q.vec
+             LIMIT %s)
+        ) m
+        ORDER BY q.idx, m.source, m.score
+    """, (vectors, *gmail_params, k))
+
+    contexts = [{"gmail": [], "hubspot": []} for _ in vectors]
+    for idx, source, a, b, c in cursor.fetchall():
+        row = (a, b, c)
+        contexts[idx - 1][source].append(row)
+    return contexts
+
+@app.post("/chat/batch")
+def chat_batch(batch: ChatBatchInput = Body(...)):
+    prompts = batch.prompts
+    if not prompts:
+        return {"results": []}
+    if len(prompts) > CHAT_BATCH_MAX_PROMPTS:
+        return {"error": f"Too many prompts (max {CHAT_BATCH_MAX_PROMPTS})"}
+    if any(not p.strip() for p in prompts):
+        return {"error": "Prompts must be non-empty"}
+
+    # --- Embed all prompts at once, retrieve all contexts in one query ---
+    with metrics.stage("chat_batch", "embed"):
+        embeddings = embedder.encode_query(cursor, prompts)
+    try:
+        with metrics.stage("chat_batch", "retrieve"):
+            contexts = retrieve_context_batch(
+                embeddings, policy=recency_policy(batch.recency, batch.window_days, batch.half_life_days))
+    except Exception as e:
+        conn.rollback()
+        return {"error": f"Context retrieval failed: {e}"}
+
+    # --- Call Gemini concurrently, keep results in input order ---
+    def answer(i):
+        full_prompt = build_chat_prompt(prompts[i], contexts[i]["gmail"], contexts[i]["hubspot"])
+        try:
+            with metrics.stage("chat_batch", "gemini"):
+                message = gemini.generate_text(full_prompt)
+            return {"index": i, "status": "ok", "response": message}
+        except GeminiError as e:
+            return {"index": i, "status": "error", "error": str(e), "details": e.details}
+        except Exception as e:
+            # A malformed response must not fail the whole batch.
+            return {"index": i, "status": "error", "error": f"{type(e).__name__}: {e}"}
+
+    workers = max(1, min(batch.concurrency or CHAT_BATCH_CONCURRENCY, CHAT_BATCH_CONCURRENCY, len(prompts)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(answer, range(len(prompts))))
+
+    # --- Save chat history ---
+    history = [(batch.email, prompts[r["index"]], r["response"]) for r in results if r["status"] == "ok"]
+    write_behind.enqueue_many("chat_history", history)
+
+    return {
+        "results": results,
+        "succeeded": len(history),
+        "failed": len(results) - len(history),
+    }
 
 
 # ---------- GOOGLE OAUTH ----------
@@ -219,7 +704,7 @@ def google_auth_callback(code: str):
         "Content-Type": "application/x-www-form-urlencoded"
     }
 
-    token_response = requests.post(token_url, data=data, headers=headers)
+    token_response = http.post(token_url, data=data, headers=headers)
 
     if token_response.status_code != 200:
         return {"error": "Failed to retrieve token", "detail": token_response.text}
@@ -231,7 +716,7 @@ def google_auth_callback(code: str):
         return {"error": "Missing ID token"}
 
     # Get user profile
-    userinfo = requests.get(
+    userinfo = http.get(
         "https://www.googleapis.com/oauth2/v3/userinfo",
         headers={"Authorization": f"Bearer {tokens['access_token']}"}
     )
@@ -241,6 +726,13 @@ def google_auth_callback(code: str):
 
     profile = userinfo.json()
 
+    # Keep the refresh token so ingest and background jobs can mint access tokens.
+    if profile.get("email"):
+        try:
+            token_store.save(profile["email"], "google", tokens)
+        except Exception as e:
+            print(f"⚠️ Failed to store Google tokens: {e}")
+
     return {
         "tokens": tokens,
         "profile": profile
@@ -263,8 +755,8 @@ def hubspot_callback(request: Request):
     if not code:
         return {"error": "Missing code"}
 
-    tokens = requests.post(
-        "https://api.hubapi.com/oauth/v1/token",
+    tokens = http.post(
+        HUBSPOT_TOKEN_URL,
         data={
             "grant_type": "authorization_code",
             "client_id": HUBSPOT_CLIENT_ID,
@@ -275,24 +767,43 @@ def hubspot_callback(request: Request):
         headers={"Content-Type": "application/x-www-form-urlencoded"}
     ).json()
 
-    contacts = requests.get(
-        "https://api.hubapi.com/crm/v3/objects/contacts",
+    if "access_token" not in tokens:
+        return {"error": "Failed to retrieve HubSpot access token", "detail": tokens}
+
+    # Token metadata names the HubSpot user the authorization belongs to.
+    info = http.get(f"{HUBSPOT_API_BASE}/oauth/v1/access-tokens/{tokens['access_token']}")
+    hubspot_user = info.json().get("user") if info.status_code == 200 else None
+    if hubspot_user:
+        try:
+            token_store.save(hubspot_user, "hubspot", tokens)
+        except Exception as e:
+            print(f"⚠️ Failed to store HubSpot tokens: {e}")
+
+    contacts = http.get(
+        f"{HUBSPOT_API_BASE}/crm/v3/objects/contacts",
         headers={"Authorization": f"Bearer {tokens['access_token']}"}
     ).json()
 
-    return {"hubspot_tokens": tokens, "hubspot_contacts": contacts}
+    return {"hubspot_tokens": tokens, "hubspot_user": hubspot_user, "hubspot_contacts": contacts}
 
 # ---------- HUBSPOT INGEST ----------
 from fastapi import Query
 
 @app.get("/hubspot/ingest")
-def ingest_contacts(token: str = Query(...)):
+def ingest_contacts(request: Request, token: Optional[str] = Query(None), email: Optional[str] = Query(None)):
+    try:
+        token = resolve_token(request, token, email, "hubspot")
+    except TokenError as e:
+        return {"error": str(e)}
+    if not token:
+        return {"error": "Missing access_token (provide via ?token=ACCESS_TOKEN or ?email=)"}
     headers = {"Authorization": f"Bearer {token}"}
 
-    res = requests.get(
-        "https://api.hubapi.com/crm/v3/objects/contacts",
-        headers=headers
-    )
+    with metrics.stage("hubspot_ingest", "list"):
+        res = http.get(
+            f"{HUBSPOT_API_BASE}/crm/v3/objects/contacts",
+            headers=headers
+        )
 
     try:
         res.raise_for_status()
@@ -303,38 +814,62 @@ def ingest_contacts(token: str = Query(...)):
     contacts = res.json().get("results", [])
     print(f"🔍 Fetched {len(contacts)} contacts from HubSpot")
     inserted = 0
+    ingested_emails = []
 
     for contact in contacts:
-        props = contact.get("properties", {})
-        name = f"{props.get('firstname', '')} {props.get('lastname', '')}".strip()
-        email = props.get("email", "")
-        notes = f"Name: {name}, Email: {email}"
-
-        if not email:
-            print(f"⚠️ Skipping contact without email: {props}")
+        record = contact_record(contact)
+        if record is None:
+            print(f"⚠️ Skipping contact without email: {contact.get('properties', {})}")
             continue
 
-        embedding = serialize_embedding(model.encode(notes))
+        with metrics.stage("hubspot_ingest", "embed"):
+            embedding, model_name = embedder.embed(record["notes"])
+        metrics.ROWS_EMBEDDED.labels("hubspot").inc()
 
+        # A savepoint per row: a failed insert must not undo the earlier ones.
+        cursor.execute("SAVEPOINT hubspot_contact")
         try:
-            cursor.execute("""
-                INSERT INTO hubspot_contacts (hubspot_id, name, email, notes, embedding)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (hubspot_id) DO NOTHING
-            """, (contact["id"], name, email, notes, embedding))
-            inserted += 1
+            with metrics.stage("hubspot_ingest", "insert"):
+                cursor.execute("""
+                    INSERT INTO hubspot_contacts (hubspot_id, name, email, notes, embedding, embedding_model)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (hubspot_id) DO NOTHING
+                """, (record["hubspot_id"], record["name"], record["email"], record["notes"],
+                      serialize_embedding(embedding), model_name))
+            if cursor.rowcount:
+                inserted += 1
+                ingested_emails.append(record["email"])
+            cursor.execute("RELEASE SAVEPOINT hubspot_contact")
         except Exception as e:
             print(f"❌ HubSpot insert failed: {e}")
-            conn.rollback()
+            cursor.execute("ROLLBACK TO SAVEPOINT hubspot_contact")
 
-    conn.commit()
+    contact_index.add(ingested_emails, cursor)
+    with metrics.stage("hubspot_ingest", "commit"):
+        conn.commit()
+    data_versions.forget(CONTACTS_SCOPE)
+    metrics.ROWS_INGESTED.labels("hubspot").inc(inserted)
     return {"message": f"✅ Ingested {inserted} contacts into Supabase."}
 
 
+@app.post("/hubspot/contacts/lookup")
+def lookup_contacts(emails: List[str] = Body(..., embed=True)):
+    try:
+        known = contact_index.existing(cursor, emails)
+    except Exception as e:
+        conn.rollback()
+        return {"error": str(e)}
+    return {"results": {email: email in known for email in emails}, "index": contact_index.stats()}
+
+
 # ---------- SEARCH ----------
 @app.get("/search")
-def semantic_search(query: str = Query(...)):
-    q_embedding = model.encode(query).tolist()
+def semantic_search(request: Request, response: Response, query: str = Query(...)):
+    headers, unchanged = conditional_headers(request, [CONTACTS_SCOPE])
+    if unchanged:
+        conn.commit()
+        return Response(status_code=304, headers=headers)
+    q_embedding = embedder.encode_query(cursor, query).tolist()
     cursor.execute("""
         SELECT hubspot_id, name, email, notes
         FROM hubspot_contacts
@@ -342,83 +877,114 @@ def semantic_search(query: str = Query(...)):
         LIMIT 5
     """, (q_embedding,))
     results = cursor.fetchall()
+    response.headers.update(headers)
     return {"results": [
         {"id": r[0], "name": r[1], "email": r[2], "notes": r[3]} for r in results
     ]}
 
-# ---------- GMAIL INGEST ----------
-@app.get("/gmail/ingest")
-def ingest_gmail(token: Optional[str] = Query(None)):
-    if not token:
-        return {"error": "Missing access_token (provide via ?token=ACCESS_TOKEN)"}
-
-    threads = requests.get(
-        "https://gmail.googleapis.com/gmail/v1/users/me/threads",
-        headers={"Authorization": f"Bearer {token}"},
-        params={"maxResults": 10}
-    ).json().get("threads", [])
-
-    inserted = 0
-    for t in threads:
-        thread_id = t["id"]
-        detail = requests.get(
-            f"https://gmail.googleapis.com/gmail/v1/users/me/threads/{thread_id}",
-            headers={"Authorization": f"Bearer {token}"}
-        ).json()
-        headers = detail.get("messages", [])[0].get("payload", {}).get("headers", [])
-        subject = next((h["value"] for h in headers if h["name"].lower() == "subject"), "No Subject")
-        snippet = detail.get("snippet", "")
-        notes = f"Subject: {subject}\nSnippet: {snippet}"
-        embedding = serialize_embedding(model.encode(notes))
-
-        try:
-            cursor.execute("""
-                INSERT INTO gmail_threads (thread_id, subject, snippet, embedding)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (thread_id) DO NOTHING
-            """, (thread_id, subject, snippet, embedding))
-            inserted += 1
-        except Exception as e:
-            print(f"❌ Gmail insert failed: {e}")
-            conn.rollback()
-
-    conn.commit()
-    return {"message": f"✅ Ingested {inserted} Gmail threads into Supabase."}
+# One branch per source: a function of (k, recency policy, now) giving the
+# SQL of its (source, id, a, b, c, distance, score) rows and its parameters,
+# and how a row is returned. Contacts have no timestamp to rank by.
+SEARCH_SCOPES = {"gmail": GMAIL_SCOPE, "hubspot": CONTACTS_SCOPE, "calendar": CALENDAR_SCOPE}
+SEARCH_SOURCES = {
+    "gmail": (lambda k, policy, now: gmail_matches_sql(
+                  "'gmail' AS source, thread_id AS id, subject AS a, snippet AS b, message_at::text AS c, "
+                  "distance, score", k, policy, now),
+              lambda r: {"thread_id": r[0], "subject": r[1], "snippet": r[2], "message_at": r[3]}),
+    "hubspot": (lambda k, policy, now: (
+                    "SELECT 'hubspot' AS source, hubspot_id::text AS id, name AS a, email AS b, notes AS c, "
+                    "embedding <=> q.vec AS distance, embedding <=> q.vec AS score "
+                    "FROM hubspot_contacts ORDER BY embedding <=> q.vec LIMIT %s", (k,)),
+                lambda r: {"id": r[0], "name": r[1], "email": r[2], "notes": r[3]}),
+    "calendar": (lambda k, policy, now: calendar_matches_sql(
+                     "'calendar' AS source, event_id AS id, summary AS a, description AS b, start_at::text AS c, "
+                     "distance, score", k, policy, now),
+                 lambda r: {"event_id": r[0], "summary": r[1], "description": r[2], "start_at": r[3]}),
+}
 
-@app.get("/gmail/search")
-def search_gmail(query: str = Query(...)):
-    q_embedding = model.encode(query).tolist()
-    cursor.execute("""
-        SELECT thread_id, subject, snippet
-        FROM gmail_threads
-        ORDER BY embedding <=> %s::vector
-        LIMIT 5
-    """, (q_embedding,))
-    results = cursor.fetchall()
-    return {"results": [
-        {"thread_id": r[0], "subject": r[1], "snippet": r[2]} for r in results
-    ]}
+@app.get("/search/all")
+def search_all(request: Request, response: Response,
+               query: str = Query(..., min_length=1), k: int = Query(5, ge=1, le=50),
+               sources: str = Query(",".join(SEARCH_SOURCES)),
+               recency: Optional[bool] = Query(None), window_days: Optional[float] = Query(None, ge=0),
+               half_life_days: Optional[float] = Query(None, gt=0)):
+    """Embed the query once and return the top-k of every source from a single query."""
+    names = [s.strip() for s in sources.split(",") if s.strip()]
+    unknown = [s for s in names if s not in SEARCH_SOURCES]
+    if unknown or not names:
+        raise HTTPException(status_code=400, detail=f"sources must be a subset of {', '.join(SEARCH_SOURCES)}")
+
+    policy = recency_policy(recency, window_days, half_life_days)
+    now = recency_now() if policy else None
+    headers, unchanged = conditional_headers(request, [SEARCH_SCOPES[name] for name in names], as_of=now)
+    if unchanged:
+        conn.commit()
+        return Response(status_code=304, headers=headers)
+    with metrics.stage("search_all", "embed"):
+        vector = str(embedder.encode_query(cursor, query).tolist())
+    branches = [SEARCH_SOURCES[name][0](k, policy, now) for name in names]
+    try:
+        with metrics.stage("search_all", "query"):
+            cursor.execute(f"""
+                SELECT m.source, m.id, m.a, m.b, m.c, m.distance, m.score
+                FROM (SELECT %s::vector AS vec) q
+                CROSS JOIN LATERAL ({" UNION ALL ".join(f"({sql})" for sql, _ in branches)}) m
+                ORDER BY m.source, m.score
+            """, (vector, *(p for _, params in branches for p in params)))
+            rows = cursor.fetchall()
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return {"error": f"Search failed: {e}"}
+
+    results = {name: [] for name in names}
+    for source, *row, distance, score in rows:
+        results[source].append({**SEARCH_SOURCES[source][1](row), "distance": round(float(distance), 4),
+                                **({"score": round(float(score), 4)} if policy else {})})
+    response.headers.update(headers)
+    body = {"query": query, "results": results}
+    if policy:
+        body["recency"] = policy.describe()
+    return body
+
+# ---------- EXPORT ----------
+@app.get("/admin/export/{table}")
+def stream_export(table: str, request: Request, batch_size: int = Query(5000, ge=100, le=50000)):
+    """Stream a table and its embeddings as an Arrow IPC stream (for larger
+    or file-based exports use `python export.py`)."""
+    require_admin(request)
+    try:
+        chunks = export.arrow_stream(db.connect, table, batch_size)
+    except export.ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(chunks, media_type="application/vnd.apache.arrow.stream",
+                             headers={"Content-Disposition": f'attachment; filename="{table}.arrows"'})
 
 # ---------- CALENDAR INGEST ----------
 
 import traceback
 
 @app.get("/calendar/ingest")
-def ingest_calendar(token: Optional[str] = Query(None)):
+def ingest_calendar(request: Request, token: Optional[str] = Query(None), email: Optional[str] = Query(None)):
+    try:
+        token = resolve_token(request, token, email, "google")
+    except TokenError as e:
+        return {"error": str(e)}
     if not token:
-        return {"error": "Missing access_token (provide via ?token=ACCESS_TOKEN)"}
+        return {"error": "Missing access_token (provide via ?token=ACCESS_TOKEN or ?email=)"}
     
     try:
-        response = requests.get(
-            "https://www.googleapis.com/calendar/v3/calendars/primary/events",
-            headers={"Authorization": f"Bearer {token}"},
-            params={
-                "maxResults": 10,
-                "singleEvents": True,
-                "orderBy": "startTime",
-                "timeMin": datetime.utcnow().isoformat() + "Z"
-            }
-        )
+        with metrics.stage("calendar_ingest", "list"):
+            response = http.get(
+                f"{CALENDAR_API_BASE}/calendar/v3/calendars/primary/events",
+                headers={"Authorization": f"Bearer {token}"},
+                params={
+                    "maxResults": 10,
+                    "singleEvents": True,
+                    "orderBy": "startTime",
+                    "timeMin": datetime.utcnow().isoformat() + "Z"
+                }
+            )
 
         if response.status_code != 200:
             return {"error": f"Failed to fetch events: {response.text}"}
@@ -428,20 +994,24 @@ def ingest_calendar(token: Optional[str] = Query(None)):
 
         inserted = 0
         for event in events:
-            event_id = event.get("id")
-            summary = event.get("summary", "No Title")
-            description = event.get("description", "")
-            notes = f"Summary: {summary}\nDescription: {description}"
-            embedding = serialize_embedding(model.encode(notes))  # ❗ check this line
-
-            cursor.execute("""
-                INSERT INTO calendar_events (event_id, summary, description, embedding)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (event_id) DO NOTHING
-            """, (event_id, summary, description, embedding))
+            record = event_record(event)
+            with metrics.stage("calendar_ingest", "embed"):
+                embedding, model_name = embedder.embed(record["notes"])
+            metrics.ROWS_EMBEDDED.labels("calendar").inc()
+
+            with metrics.stage("calendar_ingest", "insert"):
+                cursor.execute("""
+                    INSERT INTO calendar_events (event_id, summary, description, start_at, embedding, embedding_model)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (event_id) DO NOTHING
+                """, (record["event_id"], record["summary"], record["description"], record["start_at"],
+                      serialize_embedding(embedding), model_name))
             inserted += 1
 
-        conn.commit()
+        with metrics.stage("calendar_ingest", "commit"):
+            data_versions.bump(cursor, CALENDAR_SCOPE)
+            conn.commit()
+        metrics.ROWS_INGESTED.labels("calendar").inc(inserted)
         return {"message": f"✅ Ingested {inserted} calendar events into Supabase."}
 
     except Exception as e:
@@ -451,97 +1021,167 @@ def ingest_calendar(token: Optional[str] = Query(None)):
 
 
 
-# ---------- CHAT ----------
-@app.post("/chat")
-def chat_with_gemini(prompt: str = Query(..., min_length=1)):
-    headers = {
-        "Content-Type": "application/json",
-        "X-goog-api-key": GEMINI_API_KEY
-    }
-    payload = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": prompt}
-                ]
-            }
-        ]
-    }
-
-    response = requests.post(GEMINI_API_URL, headers=headers, data=json.dumps(payload))
-    if response.status_code != 200:
-        return {"error": "Gemini API call failed", "details": response.json()}
-
-    try:
-        message = response.json()["candidates"][0]["content"]["parts"][0]["text"]
-    except Exception:
-        message = "[⚠️ Failed to parse Gemini response]"
-    return {"response": message}
-
 # ---------- TASK MEMORY ----------
+# Tasks are listed newest first with keyset pagination: the cursor is the
+# (created_at, id) of the last row on the previous page, so every page is an
+# index range scan on (user_email, created_at, id) regardless of depth.
+TASKS_PAGE_SIZE = int(os.getenv("TASKS_PAGE_SIZE", "50"))
+TASKS_MAX_PAGE_SIZE = int(os.getenv("TASKS_MAX_PAGE_SIZE", "500"))
+TASKS_MAX_BULK = int(os.getenv("TASKS_MAX_BULK", "1000"))
+
+cursor.execute("""
+    CREATE INDEX IF NOT EXISTS user_tasks_user_created_idx
+        ON user_tasks (user_email, created_at DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS user_tasks_user_status_created_idx
+        ON user_tasks (user_email, status, created_at DESC, id DESC);
+""")
+conn.commit()
+
 class TaskInput(BaseModel):
     instruction: str
 
+class TaskBulkInput(BaseModel):
+    instructions: List[str]
+
+class TaskIdsInput(BaseModel):
+    task_ids: List[str]
+
+def encode_task_cursor(created_at, task_id):
+    raw = json.dumps([created_at.isoformat(), str(task_id)]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_task_cursor(value):
+    try:
+        created_at, task_id = json.loads(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+        return datetime.fromisoformat(created_at), task_id
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+
 @app.post("/tasks/store")
 def store_task(email: str = Query(...), task: TaskInput = Body(...)):
+    """Queues the task for write-behind: the returned id is provisional until
+    the next flush (WRITE_BEHIND_FLUSH_INTERVAL). /tasks/store/bulk writes
+    synchronously."""
+    task_id = str(uuid.uuid4())
+    # created_at is taken now, not at flush time, so list order matches submission order.
+    write_behind.enqueue("user_tasks", (task_id, email, task.instruction, datetime.now(timezone.utc).isoformat()))
+    return {"message": "✅ Task stored successfully", "id": task_id, "pending": True}
+
+@app.post("/tasks/store/bulk")
+def store_tasks(email: str = Query(...), tasks: TaskBulkInput = Body(...)):
+    instructions = [i for i in tasks.instructions if i and i.strip()]
+    if len(instructions) > TASKS_MAX_BULK:
+        return {"error": f"Too many tasks (max {TASKS_MAX_BULK})"}
+    if not instructions:
+        return {"message": "✅ Stored 0 tasks", "ids": []}
     try:
-        cursor.execute("""
+        rows = execute_values(cursor, """
             INSERT INTO user_tasks (id, user_email, instruction)
-            VALUES (%s, %s, %s)
-        """, (str(uuid.uuid4()), email, task.instruction))
+            VALUES %s
+            RETURNING id
+        """, [(str(uuid.uuid4()), email, i) for i in instructions], page_size=len(instructions), fetch=True)
+        data_versions.bump(cursor, tasks_scope(email))
         conn.commit()
-        return {"message": "✅ Task stored successfully"}
+        return {"message": f"✅ Stored {len(rows)} tasks", "ids": [str(r[0]) for r in rows]}
     except Exception as e:
         conn.rollback()
         return {"error": str(e)}
 
 @app.get("/tasks/list")
-def list_tasks(email: str = Query(...)):
+def list_tasks(request: Request, response: Response, email: str = Query(...), status: Optional[str] = Query(None),
+               limit: int = Query(TASKS_PAGE_SIZE, ge=1), cursor_token: Optional[str] = Query(None, alias="cursor")):
+    headers, unchanged = conditional_headers(request, [tasks_scope(email)])
+    if unchanged:
+        conn.commit()
+        return Response(status_code=304, headers=headers)
+    limit = min(limit, TASKS_MAX_PAGE_SIZE)
+    conditions, params = ["user_email = %s"], [email]
+    if status:
+        conditions.append("status = %s")
+        params.append(status)
+    if cursor_token:
+        conditions.append("(created_at, id) < (%s, %s)")
+        params.extend(decode_task_cursor(cursor_token))
     try:
-        cursor.execute("""
+        # One extra row tells us whether there is another page.
+        cursor.execute(f"""
             SELECT id, instruction, status, created_at
             FROM user_tasks
-            WHERE user_email = %s
-            ORDER BY created_at DESC
-        """, (email,))
+            WHERE {' AND '.join(conditions)}
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s
+        """, (*params, limit + 1))
         rows = cursor.fetchall()
+        conn.commit()
+        page, more = rows[:limit], len(rows) > limit
+        response.headers.update(headers)
         return {
             "tasks": [
                 {"id": r[0], "instruction": r[1], "status": r[2], "created_at": r[3].isoformat()}
-                for r in rows
-            ]
+                for r in page
+            ],
+            "next_cursor": encode_task_cursor(page[-1][3], page[-1][0]) if more else None,
         }
     except Exception as e:
+        conn.rollback()
         return {"error": str(e)}
 
 @app.post("/tasks/mark-done")
 def mark_task_done(task_id: str = Query(...)):
     try:
-        cursor.execute("""
-            UPDATE user_tasks
-            SET status = 'done'
-            WHERE id = %s
-        """, (task_id,))
+        for attempt in range(2):
+            cursor.execute("""
+                UPDATE user_tasks
+                SET status = 'done'
+                WHERE id = %s
+                RETURNING user_email
+            """, (task_id,))
+            emails = {row[0] for row in cursor.fetchall()}
+            if emails or attempt:
+                break
+            # A task stored a moment ago may still be queued here.
+            conn.rollback()
+            write_behind.flush()
+        for email in emails:
+            data_versions.bump(cursor, tasks_scope(email))
         conn.commit()
+        if not emails:
+            return {"error": f"Task {task_id} not found (a task just stored by another worker "
+                             "is written within WRITE_BEHIND_FLUSH_INTERVAL seconds)"}
         return {"message": "✅ Task marked as done"}
     except Exception as e:
         conn.rollback()
         return {"error": str(e)}
 
-# ---------- INSTRUCTION MEMORY ----------
-@app.post("/instructions/store")
-def store_instruction(email: str = Query(...), instruction: str = Body(...)):
+@app.post("/tasks/mark-done/bulk")
+def mark_tasks_done(email: str = Query(...), tasks: TaskIdsInput = Body(...)):
+    if len(tasks.task_ids) > TASKS_MAX_BULK:
+        return {"error": f"Too many tasks (max {TASKS_MAX_BULK})"}
+    if not tasks.task_ids:
+        return {"message": "✅ Marked 0 tasks as done", "updated": 0}
     try:
+        # A tuple renders as untyped literals, so this matches text and uuid ids alike.
         cursor.execute("""
-            INSERT INTO user_instructions (id, user_email, instruction)
-            VALUES (%s, %s, %s)
-        """, (str(uuid.uuid4()), email, instruction))
+            UPDATE user_tasks
+            SET status = 'done'
+            WHERE user_email = %s AND id IN %s AND status IS DISTINCT FROM 'done'
+        """, (email, tuple(tasks.task_ids)))
+        updated = cursor.rowcount
+        if updated:
+            data_versions.bump(cursor, tasks_scope(email))
         conn.commit()
-        return {"message": "✅ Instruction saved"}
+        return {"message": f"✅ Marked {updated} tasks as done", "updated": updated}
     except Exception as e:
         conn.rollback()
         return {"error": str(e)}
 
+# ---------- INSTRUCTION MEMORY ----------
+@app.post("/instructions/store")
+def store_instruction(email: str = Query(...), instruction: str = Body(...)):
+    # The rule engine is invalidated once the row is flushed.
+    write_behind.enqueue("user_instructions", (str(uuid.uuid4()), email, instruction))
+    return {"message": "✅ Instruction saved"}
+
 # ---------- TOOL-CALLING ----------
 def send_email(recipient: str, subject: str, body: str):
     print(f"📧 Email sent to {recipient}: {subject}\n{body}")
@@ -553,6 +1193,8 @@ def create_event(title: str, time: str, attendees: list):
 
 def create_contact(name: str, email: str):
     print(f"👤 Contact created: {name} ({email})")
+    # Local only: the row reaches hubspot_contacts (and other workers) on the next ingest.
+    contact_index.add([email])
     return True
 
 TOOL_MAP = {
@@ -561,6 +1203,56 @@ TOOL_MAP = {
     "create_contact": create_contact
 }
 
+# Gemini function-calling declarations for TOOL_MAP (used by /chat?agent=true)
+TOOL_SCHEMAS = [
+    {
+        "name": "send_email",
+        "description": "Send an email on the advisor's behalf.",
+        "parameters": {
+            "type": "OBJECT",
+            "properties": {
+                "recipient": {"type": "STRING", "description": "Recipient email address"},
+                "subject": {"type": "STRING"},
+                "body": {"type": "STRING"},
+            },
+            "required": ["recipient", "subject", "body"],
+        },
+    },
+    {
+        "name": "create_event",
+        "description": "Create a calendar event.",
+        "parameters": {
+            "type": "OBJECT",
+            "properties": {
+                "title": {"type": "STRING"},
+                "time": {"type": "STRING", "description": "Start time in ISO 8601"},
+                "attendees": {"type": "ARRAY", "items": {"type": "STRING"}, "description": "Attendee emails"},
+            },
+            "required": ["title", "time", "attendees"],
+        },
+    },
+    {
+        "name": "create_contact",
+        "description": "Create a contact in HubSpot.",
+        "parameters": {
+            "type": "OBJECT",
+            "properties": {
+                "name": {"type": "STRING"},
+                "email": {"type": "STRING"},
+            },
+            "required": ["name", "email"],
+        },
+    },
+]
+
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", "4"))
+tool_runner = ToolRunner(
+    TOOL_MAP,
+    max_workers=int(os.getenv("AGENT_TOOL_WORKERS", "4")),
+    default_timeout=float(os.getenv("AGENT_TOOL_TIMEOUT", "10")),
+    timeouts={"send_email": 15.0, "create_event": 10.0, "create_contact": 10.0},
+)
+
 @app.post("/tools/call")
 def call_tool(tool: str = Query(...), args: dict = Body(...)):
     if tool not in TOOL_MAP:
@@ -572,66 +1264,208 @@ def call_tool(tool: str = Query(...), args: dict = Body(...)):
         return {"error": str(e)}
     
     #CHECK_ONGOING_INSTRUCTION
-def check_ongoing_instructions():
-    results = []
+rule_engine = RuleEngine(
+    GMAIL_API_BASE,
+    token_provider=google_access_token,
+    token_invalidator=invalidate_google_token,
+    actions={"create_contact": create_contact},
+    fetch_concurrency=int(os.getenv("RULES_FETCH_CONCURRENCY", "8")),
+    contact_index=contact_index,
+)
+metrics.instrument_session(rule_engine.session, "gmail")
+rule_engine.ensure_schema(cursor)
+conn.commit()
+
+def check_ongoing_instructions(db_conn=None, prefetched=None):
+    logs, stats = rule_engine.run(db_conn or conn, prefetched)
+    print(f"⚙️ Instruction check: {stats}")
+    return logs
+
+
+
+# ✅ SCHEDULER SETUP — one scheduler per process, one runner per tick across workers
+jobs = JobCoordinator(db.connect, on_run=metrics.observe_job)
+jobs.ensure_schema(cursor)
+conn.commit()
+jobs.add_interval_job("check_ongoing_instructions", check_ongoing_instructions, minutes=2)
+
+# Re-embedding into another model: a no-op tick unless one was requested.
+max_reindex_rate = os.getenv("REINDEX_MAX_ROWS_PER_SEC")
+reindexer = Reindexer(
+    embedder,
+    cpu_share=float(os.getenv("REINDEX_CPU_SHARE", "0.5")),
+    max_rows_per_sec=float(max_reindex_rate) if max_reindex_rate else None,
+    db_latency_target=float(os.getenv("REINDEX_DB_LATENCY_TARGET", "0.25")),
+)
+jobs.add_interval_job(REINDEX_JOB, reindexer.run, minutes=1)
+if os.getenv("SCHEDULER_ENABLED", "true").lower() != "false":
+    jobs.start()
+
+# ---------- GMAIL PUSH (Pub/Sub) ----------
+GMAIL_PUSH_TOKEN = os.getenv("GMAIL_PUSH_TOKEN")
+GMAIL_PUBSUB_TOPIC = os.getenv("GMAIL_PUBSUB_TOPIC")
+
+def run_rules_on_pushed_threads(details):
+    """Queued (with its prefetched details) if a rule run is already in progress."""
+    return jobs.run_now(
+        "check_ongoing_instructions",
+        lambda db_conn: check_ongoing_instructions(db_conn, prefetched=details),
+    )
+
+gmail_push = GmailPush(
+    db.connect,
+    GMAIL_API_BASE,
+    token_provider=google_access_token,
+    token_invalidator=invalidate_google_token,
+    store_threads=store_gmail_threads,
+    on_threads=run_rules_on_pushed_threads,
+)
+metrics.instrument_session(gmail_push.session, "gmail")
+gmail_push.ensure_schema(cursor)
+conn.commit()
+
+@app.post("/gmail/push")
+def gmail_push_webhook(background_tasks: BackgroundTasks, envelope: dict = Body(...),
+                       token: Optional[str] = Query(None)):
+    # Without a shared token anyone could trigger a sync of any stored mailbox.
+    if not GMAIL_PUSH_TOKEN:
+        raise HTTPException(status_code=403, detail="Gmail push is disabled (set GMAIL_PUSH_TOKEN)")
+    if not hmac.compare_digest((token or "").encode(), GMAIL_PUSH_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid push token")
     try:
-        cursor.execute("SELECT user_email, instruction FROM user_instructions")
-        instructions = cursor.fetchall()
+        accepted = gmail_push.accept(envelope)
+    except PushError as e:
+        # Acknowledge malformed messages so Pub/Sub does not redeliver them forever.
+        return {"status": "ignored", "error": str(e)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to record push: {e}")
+    if accepted is None:
+        return {"status": "duplicate"}
+    background_tasks.add_task(gmail_push.handle, *accepted)
+    return {"status": "accepted"}
+
+@app.post("/gmail/watch")
+def gmail_watch(request: Request, email: str = Query(...)):
+    require_email_access(request, email, "google")
+    if not GMAIL_PUBSUB_TOPIC:
+        return {"error": "GMAIL_PUBSUB_TOPIC is not configured"}
+    try:
+        return gmail_push.watch(email, GMAIL_PUBSUB_TOPIC)
+    except Exception as e:
+        return {"error": f"Gmail watch failed: {e}"}
 
-        for email, instruction in instructions:
-            cursor.execute("""
-                SELECT thread_id, subject, snippet
-                FROM gmail_threads
-                WHERE created_at >= NOW() - INTERVAL '1 hour'
-            """)
-            threads = cursor.fetchall()
-
-            for thread_id, subject, snippet in threads:
-                token = "your_token_here"
-                detail = requests.get(
-                    f"https://gmail.googleapis.com/gmail/v1/users/me/threads/{thread_id}",
-                    headers={"Authorization": f"Bearer {token}"}
-                ).json()
-
-                messages = detail.get("messages", [])
-                if not messages:
-                    results.append(f"⚠️ No messages found in thread {thread_id}")
-                    continue
-
-                headers = messages[0].get("payload", {}).get("headers", [])
-                from_header = next((h["value"] for h in headers if h["name"].lower() == "from"), "")
-                import re
-                match = re.search(r'(?:"?([^"]*)"?\s)?<?([\w\.-]+@[\w\.-]+)>?', from_header)
-                name = match.group(1) or "Unknown"
-                sender_email = match.group(2) if match else None
-
-                if not sender_email:
-                    continue
-
-                cursor.execute("SELECT 1 FROM hubspot_contacts WHERE email = %s", (sender_email,))
-                exists = cursor.fetchone()
-
-                if not exists and "not in hubspot" in instruction.lower():
-                    results.append(f"⚡ Instruction matched: {instruction}")
-                    create_contact(name, sender_email)
-                    results.append(f"👤 Contact created: {name} ({sender_email})")
-                else:
-                    results.append(f"✅ {sender_email} already in HubSpot or instruction didn't match")
+@app.get("/gmail/push/stats")
+def gmail_push_stats():
+    return gmail_push.stats
+
+@app.get("/gmail/dedup/stats")
+def gmail_dedup_stats(top: int = Query(10, ge=1, le=100)):
+    """Near-duplicate groups, vectors reused instead of embedded, and the largest groups."""
+    try:
+        report = dedup.report(cursor, top)
+        conn.commit()
     except Exception as e:
-        results.append(f"❌ Error: {str(e)}")
-    return results
+        conn.rollback()
+        return {"error": str(e)}
+    return report
+
+@app.on_event("shutdown")
+def shutdown_scheduler():
+    reindexer.stop()  # returns after its current batch; progress is committed
+    jobs.shutdown()
+    token_store.stop()
+    write_behind.shutdown()
+    tool_runner.shutdown()
+    embedder.close()
+
+# ---------- EMBEDDING RE-INDEX ----------
+@app.get("/embeddings/status")
+def embeddings_status():
+    try:
+        status = reindexer.status(cursor)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return {"error": str(e)}
+    return {**status, "serving_model": embedder.active_model()}
 
+@app.post("/admin/embeddings/reindex")
+def start_reindex(request: Request, background_tasks: BackgroundTasks, model: str = Query(..., min_length=1)):
+    """Re-embed everything with `model` in the background, then switch to it."""
+    require_admin(request)
+    try:
+        status = reindexer.request(cursor, model)
+        conn.commit()
+    except ReindexError as e:
+        conn.rollback()
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=400, detail=f"Cannot re-index with {model}: {e}")
+    background_tasks.add_task(jobs.run_now, REINDEX_JOB, reindexer.run)
+    return status
+
+@app.post("/admin/embeddings/reindex/pause")
+def pause_reindex(request: Request):
+    """Stop after the current batch; POST /admin/embeddings/reindex with the same model resumes."""
+    require_admin(request)
+    paused = reindexer.pause(cursor)
+    conn.commit()
+    return {"paused": paused}
+
+@app.post("/admin/embeddings/reindex/cancel")
+def cancel_reindex(request: Request):
+    require_admin(request)
+    try:
+        reindexer.cancel(cursor)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=409, detail=f"Cancel failed (is a batch holding the table?): {e}")
+    return reindexer.status(cursor)
 
+@app.get("/write-behind/stats")
+def write_behind_stats():
+    return write_behind.metrics()
 
-# ✅ SCHEDULER SETUP — 
-scheduler = BackgroundScheduler()
-scheduler.add_job(check_ongoing_instructions, "interval", minutes=2)
-scheduler.start()
+@app.get("/scheduler/runs")
+def scheduler_runs(job_id: Optional[str] = Query(None), limit: int = Query(50, le=500)):
+    try:
+        return {"runs": recent_runs(cursor, job_id, limit)}
+    except Exception as e:
+        conn.rollback()
+        return {"error": str(e)}
 
 @app.get("/simulate/instruction-check")
 def simulate_instruction_check():
     logs = check_ongoing_instructions()
-    return {"message": "✅ Instruction check completed", "logs": logs}
+    return {"message": "✅ Instruction check completed", "logs": logs, "stats": rule_engine.last_stats}
+
+
+# ---------- METRICS ----------
+metrics.register_callbacks({
+    "db_connections": ("Connections opened by this process, by transaction state", db.connection_states),
+    "write_behind_queue": ("Write-behind queue depth and oldest pending age (s)", lambda: {
+        "depth": len(write_behind.pending),
+        "oldest_pending_seconds": write_behind.metrics()["oldest_pending_s"],
+    }),
+    "write_behind_rows": ("Write-behind row totals", lambda: {
+        k: write_behind.stats[k] for k in ("enqueued", "flushed", "spilled", "rejected")
+    }),
+    "contact_index_size": ("Emails in the in-process HubSpot contact index", lambda: len(contact_index.emails)),
+    "oauth_token_cache": ("Cached access tokens and refresh counters", lambda: {
+        "cached": len(token_store.cache), **token_store.stats,
+    }),
+    "gemini_circuit_open": ("1 while the Gemini circuit breaker is open",
+                            lambda: int(gemini.breaker.state != gemini.breaker.CLOSED)),
+    "embedding_reindex_rows_per_sec": ("Throughput of the last re-index batch (this worker)",
+                                       lambda: reindexer.rate or 0),
+})
+
+@app.get("/metrics")
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
 
 
 if __name__ == "__main__":
@@ -652,23 +1486,3 @@ def connect_hubspot():
         f"&scope=crm.objects.contacts.read%20crm.objects.contacts.write"
     )
     return RedirectResponse(url)
-
-@app.get("/hubspot/callback")
-def hubspot_callback(code: str):
-    token_url = "https://api.hubapi.com/oauth/v1/token"
-    data = {
-        "grant_type": "authorization_code",
-        "client_id": HUBSPOT_CLIENT_ID,
-        "client_secret": HUBSPOT_CLIENT_SECRET,
-        "redirect_uri": HUBSPOT_REDIRECT_URI,
-        "code": code,
-    }
-
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    response = requests.post(token_url, data=data, headers=headers)
-
-    if response.status_code == 200:
-        access_token = response.json().get("access_token")
-        return {"message": "✅ HubSpot connected", "access_token": access_token}
-    else:
-        return {"error": "Failed to retrieve HubSpot access token"}
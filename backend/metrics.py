@@ -0,0 +1,127 @@
+import os
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+# ---------- Prometheus Metrics ----------
+# Everything recorded on the request path is a pre-declared counter or
+# histogram (a lock and a bucket increment per observation). Gauges that are
+# expensive or belong to other components are computed at scrape time by
+# collectors instead. Outbound HTTP latency comes from `response.elapsed` via
+# a requests response hook, so clients need no code changes to be measured.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency by route",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "Requests currently being handled", ["method"])
+STAGE_LATENCY = Histogram(
+    "stage_duration_seconds", "Latency of named stages inside an operation",
+    ["operation", "stage"], buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds", "Outbound HTTP latency (time to response headers)",
+    ["upstream", "status"], buckets=LATENCY_BUCKETS,
+)
+ROWS_INGESTED = Counter("rows_ingested_total", "Rows written by ingest paths", ["source"])
+ROWS_EMBEDDED = Counter("rows_embedded_total", "Texts encoded into embeddings", ["source"])
+EMBEDDINGS_REUSED = Counter("embeddings_reused_total", "Rows stored with a near-duplicate's vector instead of "
+                            "being encoded", ["source"])
+JOB_DURATION = Histogram(
+    "scheduler_job_duration_seconds", "Scheduled job run time", ["job_id", "status"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+JOB_LAG = Histogram(
+    "scheduler_job_lag_seconds", "Delay between a job's scheduled tick and its start", ["job_id"],
+    buckets=(0.01, 0.1, 0.5, 1, 5, 15, 60),
+)
+JOB_SKIPPED = Counter("scheduler_job_skipped_total", "Ticks skipped because another worker held the lock", ["job_id"])
+
+
+@contextmanager
+def stage(operation, name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(operation, name).observe(time.perf_counter() - started)
+
+
+def observe_job(job_id, status, duration_ms, lag_ms):
+    """`on_run` hook for JobCoordinator."""
+    if status == "skipped":
+        JOB_SKIPPED.labels(job_id).inc()
+        return
+    JOB_DURATION.labels(job_id, status).observe(duration_ms / 1000)
+    if lag_ms is not None:
+        JOB_LAG.labels(job_id).observe(max(0.0, lag_ms / 1000))
+
+
+def instrument_session(session, upstream=None):
+    """Record every response on `session`, labelled `upstream` (or the URL's host)."""
+    def hook(response, *args, **kwargs):
+        name = upstream or urlsplit(response.url).hostname or "unknown"
+        UPSTREAM_LATENCY.labels(name, f"{response.status_code // 100}xx").observe(
+            response.elapsed.total_seconds()
+        )
+        return response
+
+    session.hooks["response"].append(hook)
+    return session
+
+
+def route_label(request):
+    """The route template (`/threads/{thread_id}`) rather than the raw path, to bound cardinality."""
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class CallbackCollector:
+    """Gauges read from live objects at scrape time. `callbacks` maps a metric
+    name to (help, fn); fn returns a number or a {label_value: number} dict
+    (exposed with a single `label` label)."""
+
+    def __init__(self, callbacks, label="kind"):
+        self.callbacks = callbacks
+        self.label = label
+
+    def collect(self):
+        for name, (doc, fn) in self.callbacks.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if isinstance(value, dict):
+                family = GaugeMetricFamily(name, doc, labels=[self.label])
+                for key, v in value.items():
+                    if v is not None:
+                        family.add_metric([str(key)], float(v))
+            else:
+                if value is None:
+                    continue
+                family = GaugeMetricFamily(name, doc, value=float(value))
+            yield family
+
+
+def register_callbacks(callbacks, label="kind"):
+    REGISTRY.register(CallbackCollector(callbacks, label))
+
+
+def render():
+    """(body, content_type) for the /metrics endpoint. Under a multi-process
+    server set PROMETHEUS_MULTIPROC_DIR so every worker's samples are merged
+    (scrape-time callback gauges then only reflect the answering worker)."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,230 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from fastapi.routing import APIRoute
+
+# ---------- Sampling Profiler ----------
+# A background thread snapshots `sys._current_frames()` every few milliseconds
+# and counts identical stacks, so the profiled code runs unmodified and the
+# cost is paid by the sampler, not the request. A single request is profiled
+# by sampling only the worker thread running its endpoint (ProfiledRoute
+# registers it); the whole process is profiled by sampling every thread for a
+# fixed window. Results are written as speedscope JSON or collapsed stacks
+# (flamegraph.pl / speedscope both read the latter).
+
+FORMATS = {"speedscope": ".speedscope.json", "collapsed": ".collapsed.txt"}
+
+_active = contextvars.ContextVar("active_profile", default=None)
+
+
+class Sampler:
+    def __init__(self, interval=0.005, threads=None, exclude=()):
+        """`threads` is a set of thread idents to sample (it may grow while
+        running); None samples every thread but the sampler and `exclude`."""
+        self.interval = interval
+        self.threads = threads
+        self.exclude = set(exclude)
+        self.counts = Counter()
+        self.samples = 0
+        self.started = None
+        self.duration = 0.0
+        self.names = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _thread_names(self):
+        self.names = {t.ident: t.name for t in threading.enumerate()}
+
+    def _sample(self, own):
+        frames = sys._current_frames()
+        for ident, frame in frames.items():
+            if ident == own or ident in self.exclude or (self.threads is not None and ident not in self.threads):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack.reverse()
+            if ident not in self.names:
+                self._thread_names()
+            self.counts[(self.names.get(ident, str(ident)), tuple(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        own = threading.get_ident()
+        self._thread_names()
+        next_at = time.perf_counter()
+        while not self.stop_event.is_set():
+            self._sample(own)
+            next_at += self.interval
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                self.stop_event.wait(delay)
+            else:
+                next_at = time.perf_counter()  # fell behind; don't burst to catch up
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.duration = time.perf_counter() - self.started
+        return self
+
+
+def frame_label(frame):
+    name, filename, line = frame
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def to_collapsed(sampler, by_thread=False):
+    lines = []
+    for (thread, stack), count in sampler.counts.most_common():
+        frames = [frame_label(f) for f in stack]
+        if by_thread:
+            frames.insert(0, thread)
+        lines.append(f"{';'.join(frames)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def to_speedscope(sampler, name):
+    frames, index = [], {}
+    profiles = {}
+    for (thread, stack), count in sampler.counts.items():
+        ids = []
+        for frame in stack:
+            if frame not in index:
+                index[frame] = len(frames)
+                frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+            ids.append(index[frame])
+        profile = profiles.setdefault(thread, {"samples": [], "weights": []})
+        profile["samples"].append(ids)
+        profile["weights"].append(count * sampler.interval)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "backend.profiling",
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": thread,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(p["weights"]),
+                "samples": p["samples"],
+                "weights": p["weights"],
+            }
+            for thread, p in profiles.items()
+        ],
+    }
+
+
+class ProfileStore:
+    NAME_RE = re.compile(r"^[\w.-]+$")
+
+    def __init__(self, directory="profiles", keep=50):
+        self.directory = directory
+        self.keep = keep
+
+    def save(self, sampler, label, fmt="speedscope", by_thread=False):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown profile format '{fmt}' (use {', '.join(FORMATS)})")
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r"[^\w-]+", "_", label).strip("_")[:60] or "profile"
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{uuid.uuid4().hex[:6]}{FORMATS[fmt]}"
+        with open(os.path.join(self.directory, name), "w", encoding="utf-8") as f:
+            if fmt == "speedscope":
+                json.dump(to_speedscope(sampler, label), f)
+            else:
+                f.write(to_collapsed(sampler, by_thread=by_thread))
+        self.prune()
+        return name
+
+    def prune(self):
+        files = self.list()
+        for entry in files[self.keep:]:
+            try:
+                os.remove(os.path.join(self.directory, entry["name"]))
+            except FileNotFoundError:
+                pass
+
+    def list(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append({"name": name, "bytes": stat.st_size, "modified": stat.st_mtime})
+        return sorted(entries, key=lambda e: e["modified"], reverse=True)
+
+    def path(self, name):
+        """Path of a stored profile, or None (also for anything path-like)."""
+        if not self.NAME_RE.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+
+# --- per-request profiling ---
+
+class RequestProfile:
+    def __init__(self, interval):
+        self.threads = set()
+        self.sampler = Sampler(interval, self.threads)
+
+    def __enter__(self):
+        self.token = _active.set(self)
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.sampler.stop()
+        _active.reset(self.token)
+
+
+def attach_current_thread(fn):
+    """Wrap an endpoint so a profiled request adds its worker thread to the sampler."""
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_inner(*args, **kwargs):
+            profile = _active.get()
+            if profile is not None:
+                profile.threads.add(threading.get_ident())
+            return await fn(*args, **kwargs)
+        return async_inner
+
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        profile = _active.get()
+        if profile is None:
+            return fn(*args, **kwargs)
+        ident = threading.get_ident()
+        profile.threads.add(ident)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.threads.discard(ident)  # the pool thread moves on to other requests
+    return inner
+
+
+class ProfiledRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, attach_current_thread(endpoint), **kwargs)
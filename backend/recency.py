@@ -0,0 +1,84 @@
+import math
+import os
+from datetime import datetime, timedelta, timezone
+
+# ---------- Recency-Aware Retrieval ----------
+# Ranking by `embedding <=> query` alone treats a two-year-old email like
+# last week's. In recency mode a query:
+#   1. optionally restricts rows to a time window around now, a range scan
+#      on the btree timestamp index (message_at / start_at) rather than the
+#      whole table;
+#   2. takes the `candidates` nearest of those rows (the ANN index's job);
+#   3. re-ranks only the candidates by
+#          distance + weight * (1 - 2^(-|age| / half_life))
+#      i.e. cosine distance plus a penalty growing from 0 (now) to `weight`
+#      (long ago). The decay rate and "now" are folded into constants once per
+#      query, so the database evaluates one exp() per candidate.
+# Rows without a timestamp get the full penalty. |age| makes upcoming
+# calendar events as relevant as recent ones.
+
+SCHEMA = """
+ALTER TABLE gmail_threads ADD COLUMN IF NOT EXISTS message_at timestamptz;
+ALTER TABLE calendar_events ADD COLUMN IF NOT EXISTS start_at timestamptz;
+CREATE INDEX IF NOT EXISTS gmail_threads_message_at_idx ON gmail_threads (message_at);
+CREATE INDEX IF NOT EXISTS calendar_events_start_at_idx ON calendar_events (start_at);
+"""
+
+GMAIL_TIMESTAMP = "message_at"
+CALENDAR_TIMESTAMP = "start_at"
+
+
+def ensure_schema(cursor):
+    cursor.execute(SCHEMA)
+
+
+class Recency:
+    def __init__(self, half_life_days=30.0, weight=0.2, window_days=None, candidates=50):
+        if half_life_days <= 0:
+            raise ValueError("half_life_days must be positive")
+        self.half_life_days = float(half_life_days)
+        self.weight = float(weight)
+        self.window_days = float(window_days) if window_days else None
+        self.candidates = int(candidates)
+
+    @classmethod
+    def from_env(cls):
+        window = os.getenv("RECENCY_WINDOW_DAYS")
+        return cls(
+            half_life_days=float(os.getenv("RECENCY_HALF_LIFE_DAYS", "30")),
+            weight=float(os.getenv("RECENCY_WEIGHT", "0.2")),
+            window_days=float(window) if window else None,
+            candidates=int(os.getenv("RECENCY_CANDIDATES", "50")),
+        )
+
+    def with_overrides(self, half_life_days=None, window_days=None, weight=None):
+        """A copy with per-request settings; window_days=0 removes the window."""
+        return Recency(
+            half_life_days=half_life_days or self.half_life_days,
+            weight=self.weight if weight is None else weight,
+            window_days=self.window_days if window_days is None else window_days,
+            candidates=self.candidates,
+        )
+
+    def describe(self):
+        return {"half_life_days": self.half_life_days, "weight": self.weight,
+                "window_days": self.window_days, "candidates": self.candidates}
+
+    def window(self, column, now=None):
+        """(SQL condition, params) limiting `column` to the window, or ("TRUE", ())."""
+        if not self.window_days:
+            return "TRUE", ()
+        now = now or datetime.now(timezone.utc)
+        span = timedelta(days=self.window_days)
+        return f"{column} BETWEEN %s AND %s", (now - span, now + span)
+
+    def score(self, column, now=None):
+        """SQL expression ranking a candidate (needs `distance` in scope); lower is better.
+        Only literals derived from floats are inlined."""
+        now = now or datetime.now(timezone.utc)
+        rate = math.log(2) / (self.half_life_days * 86400)
+        return (f"distance + {self.weight!r} * (1 - COALESCE(exp(-abs(extract(epoch FROM {column}) - "
+                f"{now.timestamp()!r}) * {rate!r}), 0))")
+
+    def candidate_count(self, k, minimum=0):
+        return max(self.candidates, k, minimum)
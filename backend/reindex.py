@@ -0,0 +1,439 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+from psycopg2 import errors
+
+from conditional import CALENDAR_SCOPE, GMAIL_SCOPE
+from contact_index import SCOPE as CONTACTS_SCOPE, bump_version
+from embeddings import STATE_SCOPE, TABLES, read_state
+from ingest import copy_buffer
+
+# ---------- Background Re-indexing ----------
+# Re-embeds every row with a target model into a shadow column
+# (embedding_next, tagged embedding_next_model) while reads and writes carry
+# on against `embedding`:
+#   backfill  keyset pass over each table in primary-key order
+#   catchup   rows written by the app since (still untagged for the target)
+#   indexing  every index on `embedding` is rebuilt CONCURRENTLY on the shadow
+#   switch    one transaction locks the tables, embeds the last stragglers and
+#             renames embedding -> embedding_prev, embedding_next -> embedding
+#   repair    rows a not-yet-refreshed worker wrote with the old model
+# Progress is committed with every batch, so a stopped run resumes where it
+# left off. Each batch is throttled: encoding may use at most `cpu_share` of
+# wall time, and the batch shrinks when database writes exceed
+# `db_latency_target`. Run it through JobCoordinator (one runner across
+# workers) or this module's CLI.
+
+JOB_ID = "embedding_reindex"
+SWITCH_MAX_STRAGGLERS = 500
+SEARCH_SCOPES = (GMAIL_SCOPE, CONTACTS_SCOPE, CALENDAR_SCOPE)
+
+# A row whose vector the app rewrites (an upsert with new text) must be
+# re-embedded for the target as well.
+INVALIDATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION embedding_next_invalidate() RETURNS trigger AS $$
+BEGIN
+    NEW.embedding_next_model := NULL;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+class ReindexError(Exception):
+    pass
+
+
+def embedding_indexes(cursor, table, column):
+    """(name, definition, valid) of the indexes on `table`.`column`."""
+    cursor.execute("""
+        SELECT i.relname, pg_get_indexdef(x.indexrelid), x.indisvalid
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = ANY(x.indkey)
+        WHERE x.indrelid = %s::regclass AND a.attname = %s
+    """, (table, column))
+    return cursor.fetchall()
+
+
+def drop_trigger(cursor, table):
+    cursor.execute(f"DROP TRIGGER IF EXISTS {table}_embedding_next ON {table}")
+
+
+def key_type(cursor, table, key):
+    cursor.execute("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attname = %s
+    """, (table, key))
+    return cursor.fetchone()[0]
+
+
+class Reindexer:
+    def __init__(self, embedder, batch_size=256, min_batch=32, max_batch=2048, cpu_share=0.5,
+                 max_rows_per_sec=None, db_latency_target=0.25, encode_batch_size=64):
+        self.embedder = embedder
+        self.batch_size = batch_size
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.cpu_share = cpu_share
+        self.max_rows_per_sec = max_rows_per_sec
+        self.db_latency_target = db_latency_target
+        self.encode_batch_size = encode_batch_size
+        self.stop_event = threading.Event()
+        self.rate = None
+
+    # --- control: any worker, state lives in the database ---
+
+    def request(self, cursor, model):
+        """Start (or resume) re-indexing into `model`. The caller commits."""
+        state = read_state(cursor)
+        if state["status"] in ("reindexing", "paused") and state["target_model"] not in (None, model):
+            raise ReindexError(f"A re-index to {state['target_model']} is {state['status']}; cancel it first")
+        if state["target_model"] is None and model == state["active_model"]:
+            raise ReindexError(f"{model} is already the active model")
+        if state["target_model"] != model:
+            dims = self.embedder.dims(model)  # also fails fast on an unknown model
+            cursor.execute(INVALIDATE_FUNCTION)
+            for table in TABLES:
+                drop_trigger(cursor, table)
+                # The previous model's vectors are kept until the next re-index starts.
+                cursor.execute(f"""
+                    ALTER TABLE {table}
+                        DROP COLUMN IF EXISTS embedding_prev,
+                        DROP COLUMN IF EXISTS embedding_prev_model,
+                        DROP COLUMN IF EXISTS embedding_next,
+                        DROP COLUMN IF EXISTS embedding_next_model
+                """)
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN embedding_next vector({int(dims)}), "
+                               f"ADD COLUMN embedding_next_model text")
+                cursor.execute(f"""
+                    CREATE TRIGGER {table}_embedding_next BEFORE UPDATE OF embedding ON {table}
+                    FOR EACH ROW WHEN (NEW.embedding IS DISTINCT FROM OLD.embedding)
+                    EXECUTE FUNCTION embedding_next_invalidate()
+                """)
+            cursor.execute("DELETE FROM embedding_reindex_progress")
+            for table in TABLES:
+                cursor.execute("""
+                    INSERT INTO embedding_reindex_progress (table_name, target_model, total)
+                    SELECT %s, %s, greatest(reltuples, 0)::bigint FROM pg_class WHERE oid = %s::regclass
+                """, (table, model, table))
+            cursor.execute("""
+                UPDATE embedding_state
+                SET target_model = %s, target_dims = %s, started_at = now(), rows_per_sec = NULL
+            """, (model, dims))
+        cursor.execute("UPDATE embedding_state SET status = 'reindexing', error = NULL, updated_at = now()")
+        return self.status(cursor)
+
+    def pause(self, cursor):
+        cursor.execute("""
+            UPDATE embedding_state SET status = 'paused', updated_at = now() WHERE status = 'reindexing'
+        """)
+        return cursor.rowcount > 0
+
+    def cancel(self, cursor):
+        """Abandon the re-index and drop the shadow columns (and their indexes)."""
+        for table in TABLES:
+            drop_trigger(cursor, table)
+            cursor.execute(f"ALTER TABLE {table} DROP COLUMN IF EXISTS embedding_next, "
+                           f"DROP COLUMN IF EXISTS embedding_next_model")
+        cursor.execute("DELETE FROM embedding_reindex_progress")
+        cursor.execute("""
+            UPDATE embedding_state
+            SET status = 'idle', target_model = NULL, target_dims = NULL, rows_per_sec = NULL,
+                error = NULL, updated_at = now()
+        """)
+
+    def status(self, cursor):
+        state = read_state(cursor)
+        cursor.execute("""
+            SELECT table_name, phase, done, total, updated_at FROM embedding_reindex_progress ORDER BY table_name
+        """)
+        tables = {
+            name: {"phase": phase, "done": done, "total": total, "updated_at": updated_at.isoformat()}
+            for name, phase, done, total, updated_at in cursor.fetchall()
+        }
+        remaining = sum(max((t["total"] or 0) - t["done"], 0) for t in tables.values() if t["phase"] == "backfill")
+        total = sum(max(t["total"] or 0, t["done"]) for t in tables.values())
+        done = sum(t["done"] for t in tables.values())
+        rate = state["rows_per_sec"]
+        for key in ("started_at", "switched_at", "updated_at"):
+            if state[key] is not None:
+                state[key] = state[key].isoformat()
+        return {
+            **state,
+            "tables": tables,
+            "progress": round(done / total, 4) if total else None,
+            # Row totals are planner estimates until a table's backfill finishes.
+            "eta_seconds": round(remaining / rate) if rate and state["status"] == "reindexing" else None,
+        }
+
+    def stop(self):
+        """Make a running `run` return after its current batch (e.g. on shutdown)."""
+        self.stop_event.set()
+
+    # --- worker ---
+
+    def run(self, db):
+        """Advance a requested re-index as far as possible. Meant to run under
+        JobCoordinator's lock on its dedicated connection."""
+        with db.cursor() as cur:
+            state = read_state(cur)
+        db.rollback()
+        if state is None or state["status"] != "reindexing":
+            return
+        model = state["target_model"]
+        self.embedder.model(model)
+        try:
+            for phase in ("backfill", "catchup"):
+                for table in TABLES:
+                    if not self.fill(db, table, model, phase):
+                        return
+            self.build_indexes(db)
+            for _ in range(5):
+                if not all(self.fill(db, table, model, "catchup") for table in TABLES):
+                    return
+                if self.switch(db, model):
+                    break
+            else:
+                raise ReindexError("Writes kept outpacing the final catch-up; will retry on the next run")
+            # A worker that has not yet seen the switch may still write old-model rows.
+            if self.stop_event.wait(self.embedder.max_staleness * 2 + 1):
+                return
+            for table in TABLES:
+                self.fill(db, table, model, "repair")
+        except Exception as e:
+            db.rollback()
+            with db.cursor() as cur:
+                cur.execute("UPDATE embedding_state SET error = %s, updated_at = now()", (str(e),))
+            db.commit()
+            raise
+
+    def fill(self, db, table, model, phase):
+        """Embed rows of `table` not yet tagged `model`; False if stopped or paused."""
+        spec = TABLES[table]
+        key = spec["key"]
+        column, tag = ("embedding", "embedding_model") if phase == "repair" else ("embedding_next", "embedding_next_model")
+        with db.cursor() as cur:
+            cast = key_type(cur, table, key)
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS reindex_stage (key text, embedding vector)")
+            cur.execute("SELECT phase, last_key FROM embedding_reindex_progress WHERE table_name = %s", (table,))
+            row = cur.fetchone()
+        db.commit()
+        if phase == "backfill" and row and row[0] != "backfill":
+            return True  # finished on an earlier run
+        last_key = row[1] if row and phase == "backfill" else None
+
+        while True:
+            if self.stop_event.is_set() or not self.still_requested(db, phase):
+                return False
+            with db.cursor() as cur:
+                keyset = f"AND {key} > %s::{cast}" if last_key is not None else ""
+                cur.execute(f"""
+                    SELECT {key}::text, {', '.join(spec['columns'])} FROM {table}
+                    WHERE {tag} IS DISTINCT FROM %s {keyset}
+                    ORDER BY {key}
+                    LIMIT %s
+                """, (model, *([last_key] if last_key is not None else []), self.batch_size))
+                rows = cur.fetchall()
+                if not rows:
+                    if phase == "backfill":
+                        cur.execute("""
+                            UPDATE embedding_reindex_progress SET phase = 'catchup', total = done, updated_at = now()
+                            WHERE table_name = %s
+                        """, (table,))
+                    db.commit()
+                    return True
+
+                started = time.perf_counter()
+                vectors = np.asarray(self.embedder.encode(
+                    [spec["text"](*r[1:]) for r in rows], model=model, batch_size=self.encode_batch_size,
+                    convert_to_numpy=True, show_progress_bar=False,
+                ), dtype=np.float32)
+                encode_s = time.perf_counter() - started
+
+                started = time.perf_counter()
+                self.write(cur, table, key, cast, column, tag, model, [r[0] for r in rows], vectors)
+                last_key = rows[-1][0]
+                cur.execute("""
+                    UPDATE embedding_reindex_progress
+                    SET done = done + %s, last_key = CASE WHEN %s THEN %s ELSE last_key END, updated_at = now()
+                    WHERE table_name = %s
+                """, (len(rows), phase == "backfill", last_key, table))
+                self.record_rate(cur, len(rows), encode_s + time.perf_counter() - started)
+                db.commit()
+                db_s = time.perf_counter() - started
+            if phase != "backfill":
+                last_key = None  # the rows just written no longer match, so start over each batch
+            self.throttle(len(rows), encode_s, db_s)
+
+    def write(self, cur, table, key, cast, column, tag, model, keys, vectors):
+        cur.copy_expert("COPY reindex_stage (key, embedding) FROM STDIN WITH (FORMAT binary)",
+                        copy_buffer([[k] for k in keys], vectors))
+        cur.execute(f"""
+            UPDATE {table} t SET {column} = s.embedding, {tag} = %s
+            FROM reindex_stage s WHERE t.{key} = s.key::{cast}
+        """, (model,))
+        cur.execute("TRUNCATE reindex_stage")
+
+    def still_requested(self, db, phase):
+        if phase == "repair":
+            return True
+        with db.cursor() as cur:
+            cur.execute("SELECT status FROM embedding_state")
+            status = cur.fetchone()[0]
+        db.commit()
+        return status == "reindexing"
+
+    def record_rate(self, cur, rows, seconds):
+        if seconds <= 0:
+            return
+        rate = rows / seconds
+        self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+        cur.execute("UPDATE embedding_state SET rows_per_sec = %s, updated_at = now()", (self.rate,))
+
+    def throttle(self, rows, encode_s, db_s):
+        delay = 0.0
+        if 0 < self.cpu_share < 1:
+            delay = encode_s * (1 - self.cpu_share) / self.cpu_share
+        if db_s > self.db_latency_target:
+            self.batch_size = max(self.min_batch, self.batch_size // 2)
+            delay = max(delay, db_s)
+        elif db_s < self.db_latency_target / 2:
+            self.batch_size = min(self.max_batch, int(self.batch_size * 1.5))
+        if self.max_rows_per_sec:
+            delay = max(delay, rows / self.max_rows_per_sec - encode_s - db_s)
+        if delay > 0:
+            self.stop_event.wait(delay)
+
+    def build_indexes(self, db):
+        """Recreate every index on `embedding` against `embedding_next` (named `<index>_next`)."""
+        db.autocommit = True  # CREATE INDEX CONCURRENTLY can't run in a transaction
+        try:
+            with db.cursor() as cur:
+                cur.execute("UPDATE embedding_reindex_progress SET phase = 'indexing', updated_at = now()")
+                for table in TABLES:
+                    shadow = {name: valid for name, _, valid in embedding_indexes(cur, table, "embedding_next")}
+                    for name, definition, _ in embedding_indexes(cur, table, "embedding"):
+                        target = f"{name}_next"
+                        if shadow.get(target) is False:
+                            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {target}")  # interrupted build
+                        elif target in shadow:
+                            continue
+                        print(f"🧠 Building {target}")
+                        cur.execute(definition
+                                    .replace(f"INDEX {name} ON", f"INDEX CONCURRENTLY {target} ON", 1)
+                                    .replace("(embedding ", "(embedding_next ", 1))
+        finally:
+            db.autocommit = False
+
+    def switch(self, db, model):
+        """Swap the shadow columns in; False if too many rows still need embedding."""
+        with db.cursor() as cur:
+            cur.execute("SET LOCAL lock_timeout = '10s'")
+            try:
+                cur.execute(f"LOCK TABLE {', '.join(TABLES)} IN ACCESS EXCLUSIVE MODE")
+            except errors.LockNotAvailable:
+                db.rollback()  # busy; catch up and try again
+                return False
+            stragglers = {}
+            for table, spec in TABLES.items():
+                cur.execute(f"""
+                    SELECT {spec['key']}::text, {', '.join(spec['columns'])} FROM {table}
+                    WHERE embedding_next_model IS DISTINCT FROM %s LIMIT %s
+                """, (model, SWITCH_MAX_STRAGGLERS + 1))
+                stragglers[table] = cur.fetchall()
+            if sum(len(rows) for rows in stragglers.values()) > SWITCH_MAX_STRAGGLERS:
+                db.rollback()
+                return False
+            for table, rows in stragglers.items():
+                if rows:
+                    spec = TABLES[table]
+                    vectors = np.asarray(self.embedder.encode(
+                        [spec["text"](*r[1:]) for r in rows], model=model, convert_to_numpy=True,
+                        show_progress_bar=False,
+                    ), dtype=np.float32)
+                    self.write(cur, table, spec["key"], key_type(cur, table, spec["key"]),
+                               "embedding_next", "embedding_next_model", model, [r[0] for r in rows], vectors)
+
+            for table in TABLES:
+                indexes = [name for name, _, _ in embedding_indexes(cur, table, "embedding")]
+                drop_trigger(cur, table)
+                cur.execute(f"ALTER TABLE {table} DROP COLUMN IF EXISTS embedding_prev, "
+                            f"DROP COLUMN IF EXISTS embedding_prev_model")
+                for old, new in (("embedding", "embedding_prev"), ("embedding_model", "embedding_prev_model"),
+                                 ("embedding_next", "embedding"), ("embedding_next_model", "embedding_model")):
+                    cur.execute(f"ALTER TABLE {table} RENAME COLUMN {old} TO {new}")
+                cur.execute(f"ALTER TABLE {table} ALTER COLUMN embedding_model SET DEFAULT %s", (model,))
+                for name in indexes:
+                    cur.execute(f"ALTER INDEX {name} RENAME TO {name}_prev")
+                    cur.execute(f"ALTER INDEX IF EXISTS {name}_next RENAME TO {name}")
+            cur.execute("""
+                UPDATE embedding_state
+                SET previous_model = active_model, active_model = target_model, target_model = NULL,
+                    target_dims = NULL, status = 'idle', switched_at = now(), updated_at = now()
+            """)
+            cur.execute("UPDATE embedding_reindex_progress SET phase = 'switched', updated_at = now()")
+            # Search results change with the vectors; invalidate cached ETags too.
+            for scope in (STATE_SCOPE, *SEARCH_SCOPES):
+                bump_version(cur, scope)
+        db.commit()
+        self.embedder.refresh()
+        print(f"🧠 Switched embeddings to {model}")
+        return True
+
+
+def main():
+    from jobs import advisory_key
+
+    from embeddings import Embedder
+
+    parser = argparse.ArgumentParser(description="Re-embed every row with another model, then switch to it.")
+    parser.add_argument("--dsn", default=None, help="libpq DSN; defaults to the backend's PG_* environment")
+    parser.add_argument("--model", default=None, help="target model; omit to resume or report")
+    parser.add_argument("--status", action="store_true", help="print progress and exit")
+    parser.add_argument("--cancel", action="store_true", help="abandon the re-index in progress")
+    parser.add_argument("--cpu-share", type=float, default=0.5, help="max share of wall time spent encoding")
+    parser.add_argument("--max-rows-per-sec", type=float, default=None)
+    parser.add_argument("--db-latency-target", type=float, default=0.25, help="seconds per batch write")
+    args = parser.parse_args()
+
+    if args.dsn:
+        import psycopg2
+
+        def connect():
+            return psycopg2.connect(args.dsn)
+    else:
+        from db import connect  # backend/db.py, from the PG_* environment
+
+    db = connect()
+    embedder = Embedder(connect)
+    reindexer = Reindexer(embedder, cpu_share=args.cpu_share, max_rows_per_sec=args.max_rows_per_sec,
+                          db_latency_target=args.db_latency_target)
+    with db.cursor() as cur:
+        embedder.ensure_schema(cur)
+        if args.cancel:
+            reindexer.cancel(cur)
+        elif args.model:
+            reindexer.request(cur, args.model)
+        db.commit()
+        if args.status or args.cancel:
+            print(reindexer.status(cur))
+            return
+        # Same lock as the app's job, so at most one re-index runs anywhere.
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (advisory_key(JOB_ID),))
+        if not cur.fetchone()[0]:
+            print("⚠️ A re-index is already running elsewhere")
+            return
+    db.commit()
+    try:
+        reindexer.run(db)
+    except KeyboardInterrupt:
+        print("⏸️ Interrupted; rerun to resume")
+    with db.cursor() as cur:
+        print(reindexer.status(cur))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import execute_values
+import requests
+from requests.adapters import HTTPAdapter
+
+# ---------- Instruction Rule Engine ----------
+# Instructions are compiled once into rules and cached until user_instructions
+# changes. Each run only looks at threads newer than a persisted watermark,
+# fetches each of them from Gmail once, checks every sender against HubSpot in
+# a single query and then evaluates all rules in memory.
+#
+# created_at is stamped when the inserting transaction starts, so a long
+# transaction can commit rows behind the watermark. Each run re-reads an
+# `overlap` window below it and skips threads already recorded as seen. A
+# thread whose fetch fails transiently (including auth errors) is left unseen
+# and the watermark stops at it, so the next run retries it.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instruction_engine_state (
+    id integer PRIMARY KEY,
+    last_created_at timestamptz,
+    last_thread_id text
+);
+CREATE TABLE IF NOT EXISTS instruction_engine_seen (
+    thread_id text PRIMARY KEY,
+    created_at timestamptz NOT NULL
+);
+"""
+
+SENDER_RE = re.compile(r'(?:"?([^"<]*?)"?\s)?<?([\w\.\+-]+@[\w\.-]+)>?')
+
+
+class Rule:
+    def __init__(self, id, user_email, instruction):
+        self.id = id
+        self.user_email = user_email
+        self.instruction = instruction
+        text = instruction.lower()
+        # The only behaviour the scheduler has ever supported: create a contact
+        # for senders that are not in HubSpot yet.
+        self.sender_not_in_hubspot = "not in hubspot" in text
+        self.action = "create_contact" if self.sender_not_in_hubspot else None
+
+    @property
+    def supported(self):
+        return self.action is not None
+
+    def matches(self, thread):
+        if self.sender_not_in_hubspot and thread["in_hubspot"]:
+            return False
+        return True
+
+
+def parse_sender(from_header):
+    match = SENDER_RE.search(from_header or "")
+    if not match:
+        return None, None
+    return (match.group(1) or "").strip() or "Unknown", match.group(2)
+
+
+def retryable(error):
+    """Network errors, auth failures (401/403: an expired or revoked token that
+    a reconnect fixes), 429 and 5xx are worth another try; other 4xx (a
+    deleted thread) will fail the same way next run."""
+    response = getattr(error, "response", None)
+    status = response.status_code if response is not None else None
+    return status is None or status in (401, 403, 429) or status >= 500
+
+
+class RunStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.rules = 0
+        self.threads = 0
+        self.gmail_fetches = 0
+        self.gmail_failures = 0
+        self.db_queries = 0
+        self.actions = 0
+        self.rules_recompiled = False
+
+    def as_dict(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "rules": self.rules,
+            "rules_recompiled": self.rules_recompiled,
+            "threads": self.threads,
+            "gmail_fetches": self.gmail_fetches,
+            "gmail_failures": self.gmail_failures,
+            "db_queries": self.db_queries,
+            "actions": self.actions,
+            "duration_ms": round(elapsed * 1000, 2),
+            "threads_per_sec": round(self.threads / elapsed, 2) if elapsed else None,
+        }
+
+
+class RuleEngine:
+    def __init__(self, gmail_api_base, token_provider, actions, fetch_concurrency=8,
+                 initial_lookback="1 hour", overlap="5 minutes", batch_limit=500, contact_index=None,
+                 token_invalidator=None):
+        self.gmail_api_base = gmail_api_base
+        self.contact_index = contact_index
+        self.token_provider = token_provider
+        self.token_invalidator = token_invalidator
+        self.actions = actions
+        self.fetch_concurrency = fetch_concurrency
+        self.initial_lookback = initial_lookback
+        self.overlap = overlap
+        self.batch_limit = batch_limit
+        self.rules = []
+        self.fingerprint = None
+        self.lock = threading.Lock()
+        self.last_stats = None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=fetch_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def ensure_schema(self, cursor):
+        cursor.execute(SCHEMA)
+
+    def invalidate(self):
+        self.fingerprint = None
+
+    def load_rules(self, cursor, stats):
+        cursor.execute("""
+            SELECT count(*), md5(coalesce(string_agg(id::text || ':' || instruction, '|' ORDER BY id), ''))
+            FROM user_instructions
+        """)
+        stats.db_queries += 1
+        fingerprint = cursor.fetchone()
+        if fingerprint != self.fingerprint:
+            cursor.execute("SELECT id, user_email, instruction FROM user_instructions")
+            stats.db_queries += 1
+            self.rules = [Rule(*row) for row in cursor.fetchall()]
+            self.fingerprint = fingerprint
+            stats.rules_recompiled = True
+        return [r for r in self.rules if r.supported]
+
+    def new_threads(self, cursor, stats):
+        cursor.execute("SELECT last_created_at, last_thread_id FROM instruction_engine_state WHERE id = 1")
+        stats.db_queries += 1
+        state = cursor.fetchone()
+        if state and state[0] is not None:
+            cursor.execute(f"""
+                SELECT t.thread_id, t.created_at
+                FROM gmail_threads t
+                WHERE t.created_at > %s - INTERVAL '{self.overlap}'
+                  AND NOT EXISTS (SELECT 1 FROM instruction_engine_seen s WHERE s.thread_id = t.thread_id)
+                ORDER BY t.created_at, t.thread_id
+                LIMIT %s
+            """, (state[0], self.batch_limit))
+        else:
+            cursor.execute(f"""
+                SELECT t.thread_id, t.created_at
+                FROM gmail_threads t
+                WHERE t.created_at >= NOW() - INTERVAL '{self.initial_lookback}'
+                  AND NOT EXISTS (SELECT 1 FROM instruction_engine_seen s WHERE s.thread_id = t.thread_id)
+                ORDER BY t.created_at, t.thread_id
+                LIMIT %s
+            """, (self.batch_limit,))
+        stats.db_queries += 1
+        return cursor.fetchall()
+
+    def save_watermark(self, cursor, created_at, thread_id):
+        cursor.execute("""
+            INSERT INTO instruction_engine_state (id, last_created_at, last_thread_id)
+            VALUES (1, %s, %s)
+            ON CONFLICT (id) DO UPDATE
+            SET last_created_at = GREATEST(instruction_engine_state.last_created_at, EXCLUDED.last_created_at),
+                last_thread_id = EXCLUDED.last_thread_id
+        """, (created_at, thread_id))
+        # Threads below the overlap window are never read again.
+        cursor.execute(f"""
+            DELETE FROM instruction_engine_seen
+            WHERE created_at < (SELECT last_created_at FROM instruction_engine_state WHERE id = 1)
+                               - INTERVAL '{self.overlap}'
+        """)
+
+    def mark_seen(self, cursor, rows):
+        if rows:
+            execute_values(cursor, """
+                INSERT INTO instruction_engine_seen (thread_id, created_at) VALUES %s
+                ON CONFLICT (thread_id) DO NOTHING
+            """, rows)
+
+    def fetch_thread(self, thread_id, token):
+        for attempt in range(2):
+            response = self.session.get(
+                f"{self.gmail_api_base}/gmail/v1/users/me/threads/{thread_id}",
+                headers={"Authorization": f"Bearer {token}"},
+                params={"format": "metadata", "metadataHeaders": "From"},
+                timeout=(3.05, 15),
+            )
+            # Revoked server-side: drop the cached token and retry once with a fresh one.
+            if response.status_code != 401 or self.token_invalidator is None or attempt:
+                break
+            self.token_invalidator(None, token)
+            token = self.token_provider()
+        response.raise_for_status()
+        return response.json()
+
+    def fetch_senders(self, thread_ids, stats, logs, prefetched=None):
+        prefetched = prefetched or {}
+        missing = [t for t in thread_ids if t not in prefetched]
+        token = self.token_provider() if missing else None
+
+        def fetch(thread_id):
+            try:
+                return thread_id, self.fetch_thread(thread_id, token), None
+            except Exception as e:
+                return thread_id, None, e
+
+        senders, retry = {}, set()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.fetch_concurrency, len(missing) or 1))) as pool:
+            fetched = list(pool.map(fetch, missing))
+        stats.gmail_fetches += len(missing)
+        results = fetched + [(t, prefetched[t], None) for t in thread_ids if t in prefetched]
+        for thread_id, detail, error in results:
+            if error is not None:
+                stats.gmail_failures += 1
+                logs.append(f"❌ Failed to fetch thread {thread_id}: {error}")
+                if retryable(error):
+                    retry.add(thread_id)
+                continue
+            messages = detail.get("messages", [])
+            if not messages:
+                logs.append(f"⚠️ No messages found in thread {thread_id}")
+                continue
+            headers = messages[0].get("payload", {}).get("headers", [])
+            from_header = next((h["value"] for h in headers if h["name"].lower() == "from"), "")
+            name, sender_email = parse_sender(from_header)
+            if sender_email:
+                senders[thread_id] = (name, sender_email)
+        return senders, retry
+
+    def existing_contacts(self, cursor, emails, stats):
+        if not emails:
+            return set()
+        if self.contact_index is not None:
+            return self.contact_index.existing(cursor, emails)
+        cursor.execute("SELECT email FROM hubspot_contacts WHERE email = ANY(%s)", (list(emails),))
+        stats.db_queries += 1
+        return {row[0] for row in cursor.fetchall()}
+
+    def process_threads(self, cursor, rules, thread_ids, stats, logs, prefetched=None):
+        """Fetch `thread_ids` once (unless already `prefetched`) and evaluate every rule against them.
+        Returns the threads whose fetch should be retried."""
+        senders, retry = self.fetch_senders(thread_ids, stats, logs, prefetched)
+        known = self.existing_contacts(cursor, {email for _, email in senders.values()}, stats)
+        stats.threads += len(thread_ids)
+
+        for thread_id in thread_ids:
+            if thread_id not in senders:
+                continue
+            name, sender_email = senders[thread_id]
+            thread = {"thread_id": thread_id, "name": name, "sender_email": sender_email,
+                      "in_hubspot": sender_email in known}
+            matched = False
+            for rule in rules:
+                if not rule.matches(thread):
+                    continue
+                matched = True
+                logs.append(f"⚡ Instruction matched: {rule.instruction}")
+                self.actions[rule.action](name, sender_email)
+                stats.actions += 1
+                if rule.action == "create_contact":
+                    known.add(sender_email)
+                    thread["in_hubspot"] = True
+                    logs.append(f"👤 Contact created: {name} ({sender_email})")
+            if not matched:
+                logs.append(f"✅ {sender_email} already in HubSpot or instruction didn't match")
+        return retry
+
+    def run(self, conn, prefetched=None):
+        """One pass over new threads. `prefetched` maps thread_id -> Gmail thread
+        detail for threads the caller already has (e.g. from a push sync).
+        Returns (logs, stats)."""
+        stats = RunStats()
+        logs = []
+        # Runs triggered from the scheduler and from /simulate must not interleave.
+        with self.lock:
+            try:
+                with conn.cursor() as cursor:
+                    rules = self.load_rules(cursor, stats)
+                    stats.rules = len(rules)
+                    rows = self.new_threads(cursor, stats)
+                    retry = set()
+                    if rows and rules:
+                        retry = self.process_threads(cursor, rules, [r[0] for r in rows], stats, logs, prefetched)
+                    if rows:
+                        self.mark_seen(cursor, [r for r in rows if r[0] not in retry])
+                        # Stop at the first thread to retry; seen threads past it are skipped next run.
+                        last_thread_id, last_created_at = next((r for r in rows if r[0] in retry), rows[-1])
+                        self.save_watermark(cursor, last_created_at, last_thread_id)
+                        stats.db_queries += 3
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logs.append(f"❌ Error: {str(e)}")
+        self.last_stats = stats.as_dict()
+        return logs, self.last_stats
@@ -0,0 +1,281 @@
+import threading
+import time
+
+import requests
+
+# ---------- OAuth Token Store ----------
+# Refresh tokens from the Google and HubSpot callbacks are persisted per user.
+# Access tokens are cached in memory and refreshed ahead of expiry by a
+# background thread, so request handlers and scheduled jobs get a valid token
+# without waiting on a token exchange. A worker that finds a fresh token in
+# the table adopts it instead of exchanging again; the exchange itself runs
+# outside any lock, and only the read and the write touch the connection.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS oauth_tokens (
+    user_email text NOT NULL,
+    provider text NOT NULL,
+    refresh_token text NOT NULL,
+    access_token text,
+    expires_at timestamptz,
+    scope text,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_email, provider)
+)
+"""
+
+
+class TokenError(Exception):
+    pass
+
+
+class CachedToken:
+    def __init__(self, access_token, expires_at):
+        self.access_token = access_token
+        self.expires_at = expires_at  # unix seconds
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+
+class TokenStore:
+    def __init__(self, connect, providers, refresh_ahead=300.0, check_interval=60.0, timeout=(3.05, 15)):
+        """`providers` maps a name to {"token_url", "client_id", "client_secret"[, "redirect_uri"]}."""
+        self.connect = connect
+        self.providers = providers
+        self.refresh_ahead = refresh_ahead
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.cache = {}
+        self.inflight = set()
+        self.key_locks = {}
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.db = None
+        self.session = requests.Session()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = {"hits": 0, "refreshes": 0, "refresh_failures": 0, "adopted": 0}
+
+    def ensure_schema(self, cursor):
+        cursor.execute(SCHEMA)
+
+    def connection(self):
+        if self.db is None or self.db.closed:
+            self.db = self.connect()
+        return self.db
+
+    def key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    # --- persistence ---
+
+    def save(self, email, provider, tokens):
+        """Store the result of an authorization-code (or refresh) exchange."""
+        if provider not in self.providers:
+            raise TokenError(f"Unknown provider '{provider}'")
+        expires_at = time.time() + int(tokens.get("expires_in", 3600))
+        with self.db_lock:
+            db = self.connection()
+            try:
+                with db.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO oauth_tokens (user_email, provider, refresh_token, access_token, expires_at, scope)
+                        VALUES (%s, %s, %s, %s, to_timestamp(%s), %s)
+                        ON CONFLICT (user_email, provider) DO UPDATE
+                        SET refresh_token = COALESCE(NULLIF(EXCLUDED.refresh_token, ''), oauth_tokens.refresh_token),
+                            access_token = EXCLUDED.access_token,
+                            expires_at = EXCLUDED.expires_at,
+                            scope = COALESCE(EXCLUDED.scope, oauth_tokens.scope),
+                            updated_at = now()
+                    """, (email, provider, tokens.get("refresh_token") or "", tokens["access_token"],
+                          expires_at, tokens.get("scope")))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        self._remember(email, provider, tokens["access_token"], expires_at)
+
+    def default_email(self, provider):
+        """The most recently connected account, for single-mailbox background jobs."""
+        with self.db_lock:
+            db = self.connection()
+            try:
+                with db.cursor() as cur:
+                    cur.execute("""
+                        SELECT user_email FROM oauth_tokens WHERE provider = %s
+                        ORDER BY updated_at DESC LIMIT 1
+                    """, (provider,))
+                    row = cur.fetchone()
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        return row[0] if row else None
+
+    # --- access ---
+
+    def get(self, email, provider):
+        """A valid access token. Only blocks if nothing usable is cached."""
+        key = (email, provider)
+        entry = self.cache.get(key)
+        if entry and entry.remaining() > self.refresh_ahead:
+            self.stats["hits"] += 1
+            return entry.access_token
+        if entry and entry.remaining() > 30:
+            # Still usable: hand it out and refresh in the background.
+            self.stats["hits"] += 1
+            with self.lock:
+                start = key not in self.inflight
+                self.inflight.add(key)
+            if start:
+                threading.Thread(target=self._refresh_quietly, args=key, daemon=True).start()
+            return entry.access_token
+        return self.refresh(email, provider)
+
+    def invalidate(self, email, provider, access_token=None):
+        """Forget a token the provider rejected (401) so the next `get` exchanges
+        a new one. With `access_token`, only that token is dropped: callers that
+        raced on the same 401 do not discard the replacement."""
+        key = (email, provider)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry and access_token in (None, entry.access_token):
+                del self.cache[key]
+        # Expire the stored copy too, or refresh would adopt it again.
+        with self.db_lock:
+            db = self.connection()
+            try:
+                with db.cursor() as cur:
+                    cur.execute("""
+                        UPDATE oauth_tokens SET expires_at = now()
+                        WHERE user_email = %s AND provider = %s
+                          AND (%s IS NULL OR access_token = %s) AND expires_at > now()
+                    """, (email, provider, access_token, access_token))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+    def _refresh_quietly(self, email, provider):
+        try:
+            self.refresh(email, provider)
+        except Exception as e:
+            print(f"⚠️ Token refresh failed for {email} ({provider}): {e}")
+        finally:
+            with self.lock:
+                self.inflight.discard((email, provider))
+
+    def refresh(self, email, provider):
+        key = (email, provider)
+        lock = self.key_lock(key)
+        with lock:
+            # Someone else may have refreshed while we waited on the lock.
+            entry = self.cache.get(key)
+            if entry and entry.remaining() > self.refresh_ahead:
+                return entry.access_token
+            try:
+                token = self._refresh_stored(email, provider)
+            except Exception:
+                self.stats["refresh_failures"] += 1
+                raise
+            return token
+
+    def _refresh_stored(self, email, provider):
+        # db_lock guards the shared connection only; the token exchange runs
+        # without it so one slow provider never stalls every other lookup.
+        refresh_token, access_token, expires_at = self._read(email, provider)
+
+        # Another worker already refreshed it: adopt instead of exchanging again.
+        if access_token and expires_at and float(expires_at) - time.time() > self.refresh_ahead:
+            self.stats["adopted"] += 1
+            self._remember(email, provider, access_token, float(expires_at))
+            return access_token
+
+        tokens = self.exchange(provider, refresh_token)
+        new_expiry = time.time() + int(tokens.get("expires_in", 3600))
+        self._write(email, provider, tokens, new_expiry)
+        self.stats["refreshes"] += 1
+        self._remember(email, provider, tokens["access_token"], new_expiry)
+        return tokens["access_token"]
+
+    def _read(self, email, provider):
+        with self.db_lock:
+            db = self.connection()
+            try:
+                with db.cursor() as cur:
+                    cur.execute("""
+                        SELECT refresh_token, access_token, extract(epoch FROM expires_at)
+                        FROM oauth_tokens WHERE user_email = %s AND provider = %s
+                    """, (email, provider))
+                    row = cur.fetchone()
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        if not row:
+            raise TokenError(f"No {provider} authorization stored for {email}")
+        return row
+
+    def _write(self, email, provider, tokens, expires_at):
+        # Workers that raced through the exchange each hold a valid token; the
+        # row keeps whichever lives longest.
+        with self.db_lock:
+            db = self.connection()
+            try:
+                with db.cursor() as cur:
+                    cur.execute("""
+                        UPDATE oauth_tokens
+                        SET access_token = %s, expires_at = to_timestamp(%s),
+                            refresh_token = COALESCE(%s, refresh_token), updated_at = now()
+                        WHERE user_email = %s AND provider = %s
+                          AND (expires_at IS NULL OR expires_at < to_timestamp(%s))
+                    """, (tokens["access_token"], expires_at, tokens.get("refresh_token"), email, provider,
+                          expires_at))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+    def _remember(self, email, provider, access_token, expires_at):
+        with self.lock:
+            self.cache[(email, provider)] = CachedToken(access_token, expires_at)
+
+    def exchange(self, provider, refresh_token):
+        config = self.providers[provider]
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "client_id": config["client_id"],
+            "client_secret": config["client_secret"],
+        }
+        if config.get("redirect_uri"):
+            data["redirect_uri"] = config["redirect_uri"]
+        response = self.session.post(config["token_url"], data=data, timeout=self.timeout,
+                                     headers={"Content-Type": "application/x-www-form-urlencoded"})
+        if response.status_code != 200:
+            raise TokenError(f"{provider} token refresh failed: {response.status_code} {response.text}")
+        return response.json()
+
+    # --- refresh-ahead loop ---
+
+    def refresh_due(self):
+        due = [key for key, entry in list(self.cache.items()) if entry.remaining() <= self.refresh_ahead]
+        for email, provider in due:
+            self._refresh_quietly(email, provider)
+        return len(due)
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        def loop():
+            while not self.stop_event.wait(self.check_interval):
+                self.refresh_due()
+
+        self.thread = threading.Thread(target=loop, name="token-refresh", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,345 @@
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+# ---------- Write-Behind Buffer ----------
+# Append-only writes from the request path (chat history, tasks, instructions)
+# are queued in memory and flushed by a background thread with one
+# execute_values per table, when enough rows are pending or the oldest row has
+# waited `flush_interval`. Failed flushes are retried with backoff on a fresh
+# connection; if the database stays unreachable the batch is spilled to a
+# JSONL file that is replayed on the next start. Rows the database rejects
+# outright go to a `.rejected` file instead of blocking the queue.
+#
+# Workers on a host share the spill file. Appends and the start-up claim are
+# serialized by an flock on `<spill>.lock`: a starting worker moves the spill
+# file (and the replay files of workers that died before finishing theirs)
+# into a `.replay.<pid>` file of its own, so every spilled row is replayed by
+# exactly one process.
+
+
+class Table:
+    def __init__(self, name, columns, conflict=None, on_flush=None, on_write=None):
+        self.name = name
+        self.columns = columns
+        self.on_flush = on_flush
+        self.on_write = on_write
+        self.sql = f"INSERT INTO {name} ({', '.join(columns)}) VALUES %s"
+        if conflict:
+            self.sql += f" {conflict}"
+
+
+class WriteBehind:
+    def __init__(self, connect, max_batch=500, flush_interval=0.5, max_pending=50000,
+                 max_retries=5, spill_path="write_behind_spill.jsonl", enabled=True):
+        self.connect = connect
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.spill_path = spill_path
+        self.enabled = enabled
+        self.tables = {}
+        self.pending = []  # (table, row, enqueued_at)
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.db = None
+        self.thread = None
+        self.stopping = False
+        self.replay_path = None  # this process's claimed spill rows, until flushed
+        self.stats = {
+            "enqueued": 0, "flushed": 0, "flushes": 0, "failures": 0, "retries": 0,
+            "spilled": 0, "rejected": 0, "replayed": 0,
+            "last_flush_ms": None, "max_flush_ms": 0.0, "total_flush_ms": 0.0,
+        }
+
+    def register(self, name, columns, conflict=None, on_flush=None, on_write=None):
+        """`on_write(cursor, rows)` runs in the inserting transaction;
+        `on_flush` is called after rows for this table have been committed."""
+        self.tables[name] = Table(name, columns, conflict, on_flush, on_write)
+
+    def connection(self):
+        if self.db is None or self.db.closed:
+            self.db = self.connect()
+        return self.db
+
+    # --- producer side ---
+
+    def enqueue(self, table, row):
+        self.enqueue_many(table, [row])
+
+    def enqueue_many(self, table, rows):
+        if table not in self.tables:
+            raise KeyError(f"Table '{table}' is not registered for write-behind")
+        rows = [tuple(r) for r in rows]
+        if not rows:
+            return
+        now = time.monotonic()
+        with self.cond:
+            # Back-pressure: if the flusher can't keep up, wait rather than grow without bound.
+            while self.enabled and not self.stopping and len(self.pending) >= self.max_pending:
+                self.cond.notify_all()
+                self.cond.wait(timeout=self.flush_interval)
+            self.pending.extend((table, row, now) for row in rows)
+            self.stats["enqueued"] += len(rows)
+            if len(self.pending) >= self.max_batch:
+                self.cond.notify_all()
+        if not self.enabled or self.thread is None:
+            self.flush()
+
+    # --- flushing ---
+
+    def _take(self):
+        with self.cond:
+            batch, self.pending = self.pending, []
+            self.cond.notify_all()
+        return batch
+
+    def flush(self):
+        """Write everything currently queued. Returns the number of rows written."""
+        with self.flush_lock:
+            batch = self._take()
+            if not batch:
+                return 0
+            by_table = {}
+            for table, row, _ in batch:
+                by_table.setdefault(table, []).append(row)
+            started = time.perf_counter()
+            written = self._write_with_retry(by_table)
+            if self.replay_path:
+                # Every replayed row is now either written, rejected or spilled again.
+                try:
+                    os.remove(self.replay_path)
+                except FileNotFoundError:
+                    pass
+                self.replay_path = None
+            elapsed = (time.perf_counter() - started) * 1000
+            self.stats["flushes"] += 1
+            self.stats["flushed"] += written
+            self.stats["last_flush_ms"] = round(elapsed, 2)
+            self.stats["max_flush_ms"] = max(self.stats["max_flush_ms"], round(elapsed, 2))
+            self.stats["total_flush_ms"] += elapsed
+            return written
+
+    def _write(self, by_table):
+        db = self.connection()
+        try:
+            with db.cursor() as cur:
+                for name, rows in by_table.items():
+                    table = self.tables[name]
+                    execute_values(cur, table.sql, rows, page_size=self.max_batch)
+                    if table.on_write:
+                        table.on_write(cur, rows)
+            db.commit()
+        except Exception:
+            if not db.closed:
+                db.rollback()
+            raise
+
+    def _write_with_retry(self, by_table):
+        total = sum(len(rows) for rows in by_table.values())
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._write(by_table)
+                self._flushed(by_table)
+                return total
+            except (psycopg2.DataError, psycopg2.IntegrityError, psycopg2.ProgrammingError) as e:
+                # Retrying won't help; find the offending rows.
+                self.stats["failures"] += 1
+                print(f"⚠️ Write-behind batch rejected ({e}), retrying row by row")
+                return self._write_rows(by_table)
+            except Exception as e:
+                self.stats["failures"] += 1
+                if attempt == self.max_retries:
+                    print(f"❌ Write-behind flush failed after {attempt + 1} attempts: {e}")
+                    self._spill(by_table, self.spill_path)
+                    self.stats["spilled"] += total
+                    return 0
+                self.stats["retries"] += 1
+                self._reset_connection()
+                time.sleep(min(5.0, 0.1 * 2 ** attempt))
+        return 0
+
+    def _write_rows(self, by_table):
+        rows = [(name, row) for name, table_rows in by_table.items() for row in table_rows]
+        written, rejected = {}, {}
+        for i, (name, row) in enumerate(rows):
+            try:
+                self._write({name: [row]})
+                written.setdefault(name, []).append(row)
+            except (psycopg2.DataError, psycopg2.IntegrityError, psycopg2.ProgrammingError) as e:
+                print(f"❌ Write-behind rejected a {name} row: {e}")
+                rejected.setdefault(name, []).append(row)
+            except Exception as e:
+                # Lost the database part way through: keep the rest for replay.
+                print(f"❌ Write-behind flush failed: {e}")
+                remaining = {}
+                for n, r in rows[i:]:
+                    remaining.setdefault(n, []).append(r)
+                self._spill(remaining, self.spill_path)
+                self.stats["spilled"] += len(rows) - i
+                self._reset_connection()
+                break
+        if rejected:
+            self._spill(rejected, self.spill_path + ".rejected")
+            self.stats["rejected"] += sum(len(r) for r in rejected.values())
+        if written:
+            self._flushed(written)
+        return sum(len(r) for r in written.values())
+
+    def _flushed(self, by_table):
+        for name in by_table:
+            callback = self.tables[name].on_flush
+            if callback:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"⚠️ Write-behind on_flush for {name} failed: {e}")
+
+    def _reset_connection(self):
+        try:
+            if self.db is not None and not self.db.closed:
+                self.db.close()
+        except Exception:
+            pass
+        self.db = None
+
+    # --- spill file ---
+
+    @contextmanager
+    def _spill_lock(self):
+        with open(self.spill_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _spill(self, by_table, path):
+        if not path:
+            return
+        with self._spill_lock(), open(path, "a", encoding="utf-8") as f:
+            for name, rows in by_table.items():
+                for row in rows:
+                    f.write(json.dumps({"table": name, "row": list(row)}, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _orphaned_replays(self):
+        """Replay files whose process is gone (crashed before its first flush)."""
+        orphans = []
+        for path in glob.glob(glob.escape(self.spill_path) + ".replay*"):
+            suffix = path[len(self.spill_path) + len(".replay"):]
+            if not suffix:
+                orphans.append(path)  # from before per-process replay files
+            elif suffix[1:].isdigit() and not process_alive(int(suffix[1:])):
+                orphans.append(path)
+        return orphans
+
+    def replay_spill(self):
+        """Queue rows left behind by previous processes. They are claimed into
+        this process's replay file, deleted once its rows have been flushed."""
+        if not self.spill_path:
+            return 0
+        replay_path = f"{self.spill_path}.replay.{os.getpid()}"
+        with self._spill_lock():
+            sources = [p for p in [self.spill_path, *self._orphaned_replays()] if os.path.exists(p)]
+            if not sources:
+                return 0
+            with open(replay_path, "a", encoding="utf-8") as dst:
+                for source in sources:
+                    with open(source, encoding="utf-8") as src:
+                        dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            for source in sources:
+                os.remove(source)
+        count = 0
+        with open(replay_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry["table"] in self.tables:
+                    with self.cond:
+                        self.pending.append((entry["table"], tuple(entry["row"]), time.monotonic()))
+                    count += 1
+        self.replay_path = replay_path
+        self.stats["replayed"] += count
+        return count
+
+    # --- background thread ---
+
+    def start(self):
+        if self.thread is not None or not self.enabled:
+            return
+        replayed = self.replay_spill()
+        if replayed:
+            print(f"♻️ Write-behind replaying {replayed} spilled rows")
+
+        def loop():
+            while True:
+                with self.cond:
+                    while not self.stopping and not self._due():
+                        self.cond.wait(timeout=self._wait_time())
+                    stopping = self.stopping
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"❌ Write-behind flush error: {e}")
+                if stopping:
+                    return
+
+        self.thread = threading.Thread(target=loop, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def _due(self):
+        if not self.pending:
+            return False
+        return len(self.pending) >= self.max_batch or time.monotonic() - self.pending[0][2] >= self.flush_interval
+
+    def _wait_time(self):
+        if not self.pending:
+            return self.flush_interval
+        return max(0.01, self.flush_interval - (time.monotonic() - self.pending[0][2]))
+
+    def shutdown(self, timeout=30.0):
+        """Stop the flusher after writing (or spilling) everything still queued."""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        # Anything enqueued after the thread exited, or if it never started.
+        self.flush()
+        self._reset_connection()
+
+    def metrics(self):
+        with self.cond:
+            depth = len(self.pending)
+            oldest = time.monotonic() - self.pending[0][2] if self.pending else None
+        flushes = self.stats["flushes"]
+        return {
+            **{k: v for k, v in self.stats.items() if k != "total_flush_ms"},
+            "enabled": self.enabled,
+            "queue_depth": depth,
+            "oldest_pending_s": round(oldest, 3) if oldest is not None else None,
+            "avg_flush_ms": round(self.stats["total_flush_ms"] / flushes, 2) if flushes else None,
+        }
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -1,6 +1,8 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
+from collections import OrderedDict
 from datetime import datetime
 import time
 import re
@@ -156,6 +158,14 @@ st.markdown("""
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "chat_window" not in st.session_state:
+    st.session_state.chat_window = 20
+if "session_started" not in st.session_state:
+    st.session_state.session_started = datetime.utcnow().isoformat() + "Z"
+if "history_cursor" not in st.session_state:
+    st.session_state.history_cursor = None
+if "history_exhausted" not in st.session_state:
+    st.session_state.history_exhausted = False
 if "user_email" not in st.session_state:
     st.session_state.user_email = "saitej13sai@gmail.com"
 if "access_token" not in st.session_state:
@@ -164,22 +174,88 @@ if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
 
 # Helper functions
+# (connect, read) seconds; chat and ingest calls can legitimately take a while.
+REQUEST_TIMEOUT = (3.05, 120)
+
+@st.cache_resource
+def backend_session():
+    """One keep-alive connection pool shared by every rerun and browser session."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 def make_request(endpoint, method="GET", params=None, data=None):
     """Make API request to backend"""
     try:
         url = f"{BACKEND_URL}{endpoint}"
+        session = backend_session()
         if method == "GET":
-            response = requests.get(url, params=params)
+            response = session.get(url, params=params, timeout=REQUEST_TIMEOUT)
         elif method == "POST":
             if data:
-                response = requests.post(url, params=params, json=data)
+                response = session.post(url, params=params, json=data, timeout=REQUEST_TIMEOUT)
             else:
-                response = requests.post(url, params=params)
+                response = session.post(url, params=params, timeout=REQUEST_TIMEOUT)
         
         if response.status_code == 200:
             return response.json()
         else:
             return {"error": f"Request failed: {response.status_code}"}
+    except requests.Timeout:
+        return {"error": "Backend did not respond in time"}
+    except Exception as e:
+        return {"error": str(e)}
+
+CACHED_BODIES = 256
+
+def cached_bodies():
+    """This browser session's response bodies by (url, ETag), least recently used first."""
+    return st.session_state.setdefault("cached_bodies", OrderedDict())
+
+def cached_body(url_key, etag):
+    bodies = cached_bodies()
+    body = bodies.get((url_key, etag))
+    if body is not None:
+        bodies.move_to_end((url_key, etag))
+    return body
+
+def store_body(url_key, etag, body):
+    bodies = cached_bodies()
+    bodies[(url_key, etag)] = body
+    bodies.move_to_end((url_key, etag))
+    while len(bodies) > CACHED_BODIES:
+        bodies.popitem(last=False)
+
+def make_cached_request(endpoint, params=None):
+    """GET with If-None-Match, serving the body from cache on 304"""
+    params = params or {}
+    url_key = f"{endpoint}?{sorted(params.items())}"
+    etags = st.session_state.setdefault("etags", {})
+    try:
+        url = f"{BACKEND_URL}{endpoint}"
+        session = backend_session()
+        etag = etags.get(url_key)
+        headers = {"If-None-Match": etag} if etag else {}
+        response = session.get(url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            body = cached_body(url_key, etag)
+            if body is not None:
+                return body
+            # Evicted from the cache: fetch the body again unconditionally.
+            response = session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+
+        if response.status_code != 200:
+            return {"error": f"Request failed: {response.status_code}"}
+        body = response.json()
+        etag = response.headers.get("ETag")
+        if etag and "error" not in body:
+            etags[url_key] = etag
+            store_body(url_key, etag, body)
+        return body
+    except requests.Timeout:
+        return {"error": "Backend did not respond in time"}
     except Exception as e:
         return {"error": str(e)}
 
@@ -194,14 +270,86 @@ def display_message(message, is_user=False):
     </div>
     """, unsafe_allow_html=True)
 
-def simulate_typing(text, placeholder):
-    """Simulate typing effect"""
-    displayed_text = ""
-    for char in text:
-        displayed_text += char
-        placeholder.markdown(f'<div class="assistant-message thinking-animation">{displayed_text}▊</div>', unsafe_allow_html=True)
-        time.sleep(0.02)
-    placeholder.markdown(f'<div class="assistant-message">{text}</div>', unsafe_allow_html=True)
+# Only the newest CHAT_WINDOW messages are rendered on each rerun, and at most
+# MAX_STORED_MESSAGES are kept in session state; older ones are paged back in
+# from /chat/history on demand, starting before the oldest message held.
+CHAT_WINDOW = 20
+MAX_STORED_MESSAGES = 200
+STREAM_RENDER_INTERVAL = 0.05
+
+def utc_now():
+    return datetime.utcnow().isoformat() + "Z"
+
+def append_message(role, content, created_at=None):
+    """Add a message to the session, dropping the oldest beyond MAX_STORED_MESSAGES"""
+    st.session_state.messages.append({"role": role, "content": content, "created_at": created_at or utc_now()})
+    overflow = len(st.session_state.messages) - MAX_STORED_MESSAGES
+    if overflow > 0:
+        del st.session_state.messages[:overflow]
+        # The dropped messages are still in the backend's chat history; the
+        # cursor points past them, so page again from the oldest one held.
+        st.session_state.history_cursor = None
+        st.session_state.history_exhausted = False
+
+def load_older_messages():
+    """Widen the rendered window, fetching a page of history when it runs out"""
+    st.session_state.chat_window += CHAT_WINDOW
+    messages = st.session_state.messages
+    if st.session_state.chat_window <= len(messages) or st.session_state.history_exhausted:
+        return
+    # Each history entry is two messages; never load more than fits.
+    room = (MAX_STORED_MESSAGES - len(messages)) // 2
+    if room < 1:
+        st.info(f"Only the latest {MAX_STORED_MESSAGES} messages are kept in this session.")
+        return
+    params = {"email": st.session_state.user_email, "limit": min(CHAT_WINDOW // 2, room)}
+    if st.session_state.history_cursor:
+        params["cursor"] = st.session_state.history_cursor
+    else:
+        params["before"] = (messages[0].get("created_at") if messages else None) or st.session_state.session_started
+    result = make_request("/chat/history", params=params)
+    if "error" in result:
+        st.error(f"Could not load older messages: {result['error']}")
+        return
+    older = []
+    for entry in reversed(result.get("history", [])):
+        older.append({"role": "user", "content": entry["message"], "created_at": entry["created_at"]})
+        older.append({"role": "assistant", "content": entry["reply"], "created_at": entry["created_at"]})
+    messages[:0] = older
+    st.session_state.history_cursor = result.get("next_cursor")
+    st.session_state.history_exhausted = not st.session_state.history_cursor
+
+def stream_chat(prompt, placeholder):
+    """Stream a /chat/stream reply into `placeholder`, returning the full text"""
+    try:
+        response = backend_session().post(
+            f"{BACKEND_URL}/chat/stream",
+            params={"prompt": prompt, "email": st.session_state.user_email},
+            stream=True, timeout=REQUEST_TIMEOUT,
+        )
+    except requests.Timeout:
+        return "❌ Error: Backend did not respond in time"
+    except Exception as e:
+        return f"❌ Error: {e}"
+    with response:
+        if response.status_code != 200:
+            return f"❌ Error: Request failed: {response.status_code}"
+        if response.headers.get("content-type", "").startswith("application/json"):
+            result = response.json()
+            return f"❌ Error: {result.get('error', result)}"
+        response.encoding = "utf-8"
+        text, last_render = "", 0.0
+        try:
+            for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+                text += chunk
+                # Re-rendering markdown per chunk is the expensive part; cap it at ~20/s.
+                if time.monotonic() - last_render >= STREAM_RENDER_INTERVAL:
+                    placeholder.markdown(f'<div class="assistant-message"><strong>🤖</strong> {text}▊</div>', unsafe_allow_html=True)
+                    last_render = time.monotonic()
+        except requests.RequestException as e:
+            text += f"\n[⚠️ Connection lost: {e}]"
+    placeholder.markdown(f'<div class="assistant-message"><strong>🤖</strong> {text}</div>', unsafe_allow_html=True)
+    return text or "[⚠️ Empty response]"
 
 # Sidebar
 with st.sidebar:
@@ -242,7 +390,7 @@ with st.sidebar:
     with st.expander("📧 Gmail", expanded=False):
         if st.button("📥 Ingest Gmail"):
             if st.session_state.access_token:
-                result = make_request("/gmail/ingest", params={"token": st.session_state.access_token})
+                result = make_request("/gmail/ingest", params={"token": st.session_state.access_token, "email": st.session_state.user_email})
                 if "error" not in result:
                     st.success(result["message"])
                 else:
@@ -254,7 +402,7 @@ with st.sidebar:
     with st.expander("📅 Calendar", expanded=False):
         if st.button("📥 Ingest Calendar"):
             if st.session_state.access_token:
-                result = make_request("/calendar/ingest", params={"token": st.session_state.access_token})
+                result = make_request("/calendar/ingest", params={"token": st.session_state.access_token, "email": st.session_state.user_email})
                 if "error" not in result:
                     st.success(result["message"])
                 else:
@@ -307,7 +455,7 @@ if st.button("✅ Authenticate HubSpot"):
 # Step 3: Ingest contacts if authenticated
 if st.session_state.hubspot_authenticated:
     if st.button("📥 Ingest HubSpot"):
-        result = make_request("/hubspot/ingest", params={"token": st.session_state.hubspot_access_token})
+        result = make_request("/hubspot/ingest", params={"token": st.session_state.hubspot_access_token, "email": st.session_state.user_email})
         if "error" not in result:
             st.success(result["message"])
         else:
@@ -323,22 +471,46 @@ else:
     
     # Task Management
     with st.expander("📋 Task Management", expanded=False):
+        status_filter = st.selectbox("Status", ["all", "pending", "done"], key="task_status_filter")
+        params = {"email": st.session_state.user_email, "limit": 20}
+        if status_filter != "all":
+            params["status"] = status_filter
         if st.button("📋 View Tasks"):
-            result = make_request("/tasks/list", params={"email": st.session_state.user_email})
+            result = make_cached_request("/tasks/list", params=params)
             if "error" not in result:
-                tasks = result.get("tasks", [])
-                st.markdown("**Your Tasks:**")
-                for task in tasks:
-                    status_class = "status-done" if task["status"] == "done" else "status-pending"
-                    st.markdown(f"""
-                    <div class="integration-card">
-                        <strong>{task['instruction']}</strong><br>
-                        <span class="status-badge {status_class}">{task['status']}</span>
-                        <small>{task['created_at']}</small>
-                    </div>
-                    """, unsafe_allow_html=True)
+                st.session_state.tasks = result.get("tasks", [])
+                st.session_state.tasks_cursor = result.get("next_cursor")
             else:
                 st.error(result["error"])
+        if st.session_state.get("tasks_cursor") and st.button("⬇️ Load more"):
+            result = make_cached_request("/tasks/list", params={**params, "cursor": st.session_state.tasks_cursor})
+            if "error" not in result:
+                st.session_state.tasks += result.get("tasks", [])
+                st.session_state.tasks_cursor = result.get("next_cursor")
+            else:
+                st.error(result["error"])
+        if st.session_state.get("tasks"):
+            st.markdown("**Your Tasks:**")
+            for task in st.session_state.tasks:
+                status_class = "status-done" if task["status"] == "done" else "status-pending"
+                st.markdown(f"""
+                <div class="integration-card">
+                    <strong>{task['instruction']}</strong><br>
+                    <span class="status-badge {status_class}">{task['status']}</span>
+                    <small>{task['created_at']}</small>
+                </div>
+                """, unsafe_allow_html=True)
+            pending = [t["id"] for t in st.session_state.tasks if t["status"] != "done"]
+            if pending and st.button(f"✅ Mark {len(pending)} shown tasks done"):
+                result = make_request("/tasks/mark-done/bulk", method="POST",
+                                      params={"email": st.session_state.user_email},
+                                      data={"task_ids": pending})
+                if "error" not in result:
+                    for task in st.session_state.tasks:
+                        task["status"] = "done"
+                    st.success(result.get("message"))
+                else:
+                    st.error(result["error"])
     
     # Ongoing Instructions
 
@@ -412,8 +584,11 @@ with chat_container:
         </div>
         """, unsafe_allow_html=True)
     
-    # Display chat messages
-    for message in st.session_state.messages:
+    # Display the newest messages; older ones load on demand
+    hidden = len(st.session_state.messages) - st.session_state.chat_window
+    if hidden > 0 or (st.session_state.messages and not st.session_state.history_exhausted):
+        st.button("⬆️ Show older messages", key="load_older", on_click=load_older_messages)
+    for message in st.session_state.messages[-st.session_state.chat_window:]:
         display_message(message["content"], message["role"] == "user")
 
 # Chat input
@@ -430,7 +605,7 @@ with st.container():
 # Handle user input
 if send_button and user_input:
     # Add user message to chat
-    st.session_state.messages.append({"role": "user", "content": user_input})
+    append_message("user", user_input)
     
     # Show typing indicator
     with st.container():
@@ -454,39 +629,38 @@ if send_button and user_input:
         # Handle search queries
         search_query = user_input.replace("search", "").strip()
         
-        # Search Gmail
-        gmail_result = make_request("/gmail/search", params={"query": search_query})
-        
-        # Search HubSpot
-        hubspot_result = make_request("/search", params={"query": search_query})
+        # Search Gmail, HubSpot and Calendar in one round trip
+        result = make_cached_request("/search/all", params={"query": search_query, "k": 3})
+        results = result.get("results", {}) if "error" not in result else {}
         
         response = f"🔍 Search results for '{search_query}':\n\n"
         
-        if "error" not in gmail_result and gmail_result.get("results"):
+        if results.get("gmail"):
             response += "📧 **Gmail Results:**\n"
-            for email in gmail_result["results"][:3]:
+            for email in results["gmail"]:
                 response += f"• {email['subject']}\n"
         
-        if "error" not in hubspot_result and hubspot_result.get("results"):
+        if results.get("hubspot"):
             response += "\n👥 **HubSpot Contacts:**\n"
-            for contact in hubspot_result["results"][:3]:
+            for contact in results["hubspot"]:
                 response += f"• {contact['name']} ({contact['email']})\n"
         
-        if not gmail_result.get("results") and not hubspot_result.get("results"):
+        if results.get("calendar"):
+            response += "\n📅 **Calendar Events:**\n"
+            for event in results["calendar"]:
+                response += f"• {event['summary']}\n"
+        
+        if "error" in result:
+            response += f"❌ Search failed: {result['error']}"
+        elif not any(results.values()):
             response += "No results found."
     
     else:
-        # Handle general chat
-        result = make_request("/chat", method="POST", 
-                            params={"prompt": user_input, "email": st.session_state.user_email})
-        
-        if "error" not in result:
-            response = result["response"]
-        else:
-            response = f"❌ Error: {result['error']}"
+        # Handle general chat, rendering the reply as it streams in
+        response = stream_chat(user_input, thinking_placeholder)
     
     # Add assistant response to chat
-    st.session_state.messages.append({"role": "assistant", "content": response})
+    append_message("assistant", response)
     
     # Clear the thinking indicator and rerun to show the new messages
     thinking_placeholder.empty()